@@ -0,0 +1,108 @@
+"""
+Throughput of the sync and async database modes under many concurrent clients.
+Each mode is served by a separate uvicorn process on a temporary database.
+
+    python -m benchmarks.concurrency --clients 200 --requests 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+HOST = '127.0.0.1'
+
+
+def start_server(mode: str, port: int, database: str) -> subprocess.Popen:
+    env = dict(os.environ, DB_MODE=mode, DATABASE_URL=f'sqlite:///{database}')
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', HOST, '--port', str(port), '--log-level', 'warning'],
+        env=env,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get('/docs')
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('Server did not start')
+
+
+async def seed(client: httpx.AsyncClient, messages_count: int = 20) -> int:
+    """
+    Creates start -> messages -> condition -> message -> end workflow through the API.
+    """
+    workflow_id = (await client.post('/create-workflow', json={'name': 'benchmark'})).json()['id']
+    end_id = (await client.post('/node/create-end-node/', json={'workflow_id': workflow_id})).json()['id']
+    yes_id = (await client.post('/node/create-message-node/', json={'workflow_id': workflow_id, 'message_text': 'yes', 'status': 'sent', 'next_node_id': end_id})).json()['id']
+    condition_id = (await client.post('/node/create-condition-node/', json={'workflow_id': workflow_id, 'condition': "status == 'sent'", 'yes_node_id': yes_id, 'no_node_id': end_id})).json()['id']
+    next_id = condition_id
+    for i in range(messages_count):
+        next_id = (await client.post('/node/create-message-node/', json={'workflow_id': workflow_id, 'message_text': f'message {i}', 'status': 'sent', 'next_node_id': next_id})).json()['id']
+    await client.post('/node/create-start-node/', json={'workflow_id': workflow_id, 'next_node_id': next_id})
+    return workflow_id
+
+
+async def client_loop(client: httpx.AsyncClient, workflow_id: int, requests: int, latencies: list, errors: list):
+    for i in range(requests):
+        started = time.perf_counter()
+        if i % 2:
+            response = await client.get(f'/get/{workflow_id}')
+        else:
+            response = await client.post(f'/run-sequence/{workflow_id}')
+        latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+
+async def benchmark(mode: str, port: int, clients: int, requests: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        server = start_server(mode, port, os.path.join(directory, 'benchmark.db'))
+        try:
+            limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+            async with httpx.AsyncClient(base_url=f'http://{HOST}:{port}', limits=limits, timeout=60) as client:
+                await wait_ready(client)
+                workflow_id = await seed(client)
+
+                latencies, errors = [], []
+                started = time.perf_counter()
+                await asyncio.gather(*(client_loop(client, workflow_id, requests, latencies, errors) for _ in range(clients)))
+                elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies.sort()
+    return {
+        'mode': mode,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=20, help='requests per client')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"{'mode':>6} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50, ms':>9} {'p99, ms':>9}")
+    for mode in ('sync', 'async'):
+        result = asyncio.run(benchmark(mode, args.port, args.clients, args.requests))
+        print(f"{result['mode']:>6} {result['requests']:>9} {result['errors']:>7} {result['throughput']:>9.1f} {result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Compares the linear walker of services.executor with the networkx path it replaced.
+
+    python -m benchmarks.executor
+"""
+import time
+import networkx as nx
+from benchmarks.generator import linear_rows
+from services.executor import CompactGraph, CONDITION, walk
+
+SIZES = [100, 1_000, 10_000, 100_000]
+# all-sources shortest_path keeps a path from every node, O(n^2) memory: 100k nodes don`t fit in RAM
+NETWORKX_MAX_SIZE = 10_000
+
+
+def networkx_run(rows, conditions_result):
+    """
+    The former create_and_run_graph path: build the weighted DiGraph and search all shortest paths to the end node.
+    Note that shortest_path was called without `weight`, so the 999 weights were ignored.
+    """
+    G = nx.DiGraph()
+    for row in rows:
+        G.add_node(row[0])
+    for node_id, kind, next_id, yes_id, no_id in rows:
+        if kind == CONDITION:
+            if conditions_result:
+                G.add_edge(node_id, yes_id)
+                G.add_edge(node_id, no_id, weight=999)
+            else:
+                G.add_edge(node_id, yes_id, weight=999)
+                G.add_edge(node_id, no_id)
+        elif next_id is not None:
+            G.add_edge(node_id, next_id)
+    return nx.shortest_path(G, target=rows[-1][0])[rows[0][0]]
+
+
+def walker_run(graph, conditions_result):
+    return walk(graph, 0, lambda index: conditions_result)
+
+
+def measure(func, *args, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    print(f"{'nodes':>8} {'networkx, ms':>14} {'walker, ms':>12} {'speedup':>9}")
+    for size in SIZES:
+        rows, _ = linear_rows(size)
+        graph = CompactGraph(rows)
+        walker_time = measure(walker_run, graph, True)
+
+        if size > NETWORKX_MAX_SIZE:
+            print(f"{size:>8} {'skipped':>14} {walker_time * 1000:>12.3f} {'-':>9}")
+            continue
+
+        assert len(networkx_run(rows, True)) == len(walker_run(graph, True))
+        networkx_time = measure(networkx_run, rows, True, repeat=1 if size >= 10_000 else 5)
+        print(f"{size:>8} {networkx_time * 1000:>14.3f} {walker_time * 1000:>12.3f} {networkx_time / walker_time:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
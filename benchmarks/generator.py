@@ -0,0 +1,132 @@
+from services.executor import START, MESSAGE, CONDITION, END
+
+
+def linear_rows(size: int, condition_every: int = 10) -> tuple:
+    """
+    Generates a linear workflow of about `size` nodes as compact graph rows: start, a chain of
+    message nodes and the end node. After every `condition_every` messages a condition node
+    branches into two message nodes which join back into the chain.
+
+    Returns:
+        tuple: (rows, conditions) where rows are (id, kind, next_id, yes_id, no_id) tuples and
+            conditions maps condition node ids to the id of the checked message node.
+    """
+    rows = [(1, START, 2, None, None)]
+    conditions = {}
+    node_id = 2
+    while node_id < size - 3:
+        for _ in range(condition_every):
+            rows.append((node_id, MESSAGE, node_id + 1, None, None))
+            node_id += 1
+        conditions[node_id] = node_id - 1
+        rows.append((node_id, CONDITION, None, node_id + 1, node_id + 2))
+        rows.append((node_id + 1, MESSAGE, node_id + 3, None, None))
+        rows.append((node_id + 2, MESSAGE, node_id + 3, None, None))
+        node_id += 3
+    rows.append((node_id, END, None, None, None))
+    return rows, conditions
+
+
+def tree_rows(size: int) -> tuple:
+    """
+    Generates a complete binary tree of condition nodes of about `size` nodes. Every condition is
+    preceded by the message node it checks, the "yes" and "no" branches lead to subtrees, and the
+    message nodes at the leaves lead to the end node. The success path goes down one branch.
+
+    Returns:
+        tuple: (rows, conditions), see linear_rows.
+    """
+    depth = max(1, (size // 3).bit_length() - 1)
+    # every inner message node takes 3 ids: its condition and the messages of both branches
+    end_id = 3 * 2 ** depth
+    rows = [(1, START, 2, None, None)]
+    conditions = {}
+    next_id = 3
+    stack = [(2, 0)]  # (message node id, level)
+    while stack:
+        message_id, level = stack.pop()
+        if level == depth:
+            rows.append((message_id, MESSAGE, end_id, None, None))
+            continue
+        condition_id, yes_id, no_id = next_id, next_id + 1, next_id + 2
+        next_id += 3
+        rows.append((message_id, MESSAGE, condition_id, None, None))
+        rows.append((condition_id, CONDITION, None, yes_id, no_id))
+        conditions[condition_id] = message_id
+        stack.append((no_id, level + 1))
+        stack.append((yes_id, level + 1))
+    rows.append((end_id, END, None, None, None))
+    return rows, conditions
+
+
+def fanout_rows(size: int, branch_length: int = 3) -> tuple:
+    """
+    Generates a wide workflow of about `size` nodes: a spine of message and condition nodes where
+    every condition continues the spine on "yes" and opens a side branch of `branch_length` message
+    nodes on "no". All side branches lead to the end node, the success path follows the spine.
+
+    Returns:
+        tuple: (rows, conditions), see linear_rows.
+    """
+    unit = 2 + branch_length
+    units = max(1, (size - 3) // unit)
+    end_id = 3 + units * unit
+    rows = [(1, START, 2, None, None)]
+    conditions = {}
+    for base in range(2, end_id - 1, unit):
+        rows.append((base, MESSAGE, base + 1, None, None))
+        rows.append((base + 1, CONDITION, None, base + unit, base + 2))
+        conditions[base + 1] = base
+        for node_id in range(base + 2, base + unit):
+            rows.append((node_id, MESSAGE, node_id + 1 if node_id + 1 < base + unit else end_id, None, None))
+    rows.append((end_id - 1, MESSAGE, end_id, None, None))
+    rows.append((end_id, END, None, None, None))
+    return rows, conditions
+
+
+SHAPES = {
+    'linear': linear_rows,
+    'tree': tree_rows,
+    'fanout': fanout_rows,
+}
+
+
+def creation_order(rows: list) -> list:
+    """
+    Orders compact graph rows so that every node comes after the nodes it points to, the order in
+    which the nodes can be created one by one with their edges set.
+    """
+    sources = {}
+    pending = {}
+    for row in rows:
+        targets = {target for target in row[2:] if target is not None}
+        pending[row[0]] = len(targets)
+        for target in targets:
+            sources.setdefault(target, []).append(row[0])
+    by_id = {row[0]: row for row in rows}
+    ready = [node_id for node_id, count in pending.items() if not count]
+    ordered = []
+    while ready:
+        node_id = ready.pop()
+        ordered.append(by_id[node_id])
+        for source in sources.get(node_id, ()):
+            pending[source] -= 1
+            if not pending[source]:
+                ready.append(source)
+    return ordered
+
+
+def import_lines(rows: list) -> list:
+    """
+    Converts compact graph rows into node lines of the workflow import (see GraphImport).
+    """
+    kinds = {START: 'start', MESSAGE: 'message', CONDITION: 'condition', END: 'end'}
+    lines = []
+    for node_id, kind, next_id, yes_id, no_id in rows:
+        line = {'ref': node_id, 'node_type': kinds[kind], 'next': next_id, 'yes': yes_id, 'no': no_id}
+        if kind == MESSAGE:
+            line.update(message_text=f'message {node_id}', status='sent')
+        elif kind == CONDITION:
+            line['condition'] = "status == 'sent'"
+        lines.append(line)
+    return lines
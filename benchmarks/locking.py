@@ -0,0 +1,120 @@
+"""
+Readers and writers in separate processes on one SQLite file, with the "default" profile (rollback
+journal) and the "production" profile (WAL and pragmas of database.py). Writers update message
+nodes through NodeService, readers load and run the workflow.
+
+    python -m benchmarks.locking --readers 4 --writers 2 --duration 5
+
+With a short busy timeout (SQLITE_BUSY_TIMEOUT=50) readers of the default profile fail with
+"database is locked" while a writer commits, readers of the production profile never do.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def run_role(role: str, workflow_id: int, duration: float):
+    # imported here: the database is configured from the environment of the child process
+    from database import SessionLocal, ReadSessionLocal
+    from models.workflow import MessageNode
+    from schemas.workflow import MessageNodeSchema
+    from services.node import NodeService
+    from services.workflow import WorkflowServices
+
+    with ReadSessionLocal() as db:
+        message_ids = db.query(MessageNode.id).filter(MessageNode.workflow_id == workflow_id).order_by(MessageNode.id).limit(10).all()
+
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + duration
+    i = 0
+    while time.monotonic() < deadline:
+        i += 1
+        started = time.perf_counter()
+        try:
+            if role == 'writer':
+                with SessionLocal() as db:
+                    node = db.get(MessageNode, message_ids[i % len(message_ids)][0])
+                    data = MessageNodeSchema(workflow_id=workflow_id, message_text=f'update {i}', status=node.status, next_node_id=node.next_node_id)
+                    NodeService.update_node(node_id=node.id, data=data, db=db)
+            else:
+                with ReadSessionLocal() as db:
+                    WorkflowServices.get_workflow(db=db, workflow_id=workflow_id)
+                    WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow_id)
+        except Exception as e:
+            errors.append(type(e).__name__)
+        latencies.append(time.perf_counter() - started)
+    print(json.dumps({'role': role, 'latencies': latencies, 'errors': errors}))
+
+
+def seed() -> int:
+    from database import SessionLocal
+    from migrations import migrate
+    from database import engine
+    from services.importer import GraphImport
+    from benchmarks.generator import linear_rows, import_lines
+
+    migrate(engine)
+    rows, _ = linear_rows(200)
+    with SessionLocal() as db:
+        graph_import = GraphImport(db, {'name': 'locking'})
+        graph_import.add_nodes(import_lines(rows))
+        return graph_import.finish()['id']
+
+
+def spawn(env: dict, *args) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, '-m', 'benchmarks.locking', *args], env=env, stdout=subprocess.PIPE, text=True)
+
+
+def benchmark(profile: str, readers: int, writers: int, duration: float) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DB_PROFILE=profile, DATABASE_URL=f"sqlite:///{os.path.join(directory, 'benchmark.db')}")
+        workflow_id = spawn(env, '--role', 'seed').communicate()[0].strip()
+        processes = [spawn(env, '--role', 'writer', '--workflow', workflow_id, '--duration', str(duration)) for _ in range(writers)]
+        processes += [spawn(env, '--role', 'reader', '--workflow', workflow_id, '--duration', str(duration)) for _ in range(readers)]
+        outputs = [json.loads(process.communicate()[0]) for process in processes]
+
+    result = {'profile': profile}
+    for role in ('reader', 'writer'):
+        latencies = sorted(latency for output in outputs if output['role'] == role for latency in output['latencies'])
+        result[role] = {
+            'ops': len(latencies),
+            'errors': sum(len(output['errors']) for output in outputs if output['role'] == role),
+            'p50_ms': statistics.median(latencies) * 1000 if latencies else 0,
+            'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0,
+            'max_ms': latencies[-1] * 1000 if latencies else 0,
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--role', choices=['seed', 'reader', 'writer'], help=argparse.SUPPRESS)
+    parser.add_argument('--workflow', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role == 'seed':
+        print(seed())
+        return
+    if args.role:
+        run_role(args.role, args.workflow, args.duration)
+        return
+
+    print(f"{'profile':>10} {'role':>7} {'ops':>7} {'errors':>7} {'p50, ms':>9} {'p99, ms':>9} {'max, ms':>9}")
+    for profile in ('default', 'production'):
+        result = benchmark(profile, args.readers, args.writers, args.duration)
+        for role in ('reader', 'writer'):
+            stats = result[role]
+            print(f"{profile:>10} {role:>7} {stats['ops']:>7} {stats['errors']:>7} {stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['max_ms']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Cost of GET /get/{id} for a large workflow: the former path, which loaded polymorphic ORM nodes and
+encoded them with jsonable_encoder into a JSONResponse, against the column query validated by the
+response model and rendered by ORJSONResponse. Runs on a temporary database.
+
+    python -m benchmarks.serialization --nodes 10000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+DIRECTORY = tempfile.TemporaryDirectory()
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(DIRECTORY.name, 'benchmark.db')}"
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import selectinload
+from pydantic import TypeAdapter
+from database import SessionLocal
+from models.workflow import Workflow
+from schemas.workflow import WorkflowSchema
+from services.graph import GraphService
+from services.importer import GraphImport
+from benchmarks.generator import linear_rows, import_lines
+from main import app
+
+
+def measure(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def seed(size: int) -> int:
+    rows, _ = linear_rows(size)
+    with SessionLocal() as db:
+        graph_import = GraphImport(db, {'name': 'serialization'})
+        graph_import.add_nodes(import_lines(rows))
+        return graph_import.finish()['id']
+
+
+def former_load(db, workflow_id: int):
+    db.expire_all()
+    return db.query(Workflow).options(selectinload(Workflow.nodes)).filter(Workflow.id == workflow_id).first()
+
+
+def former_render(workflow):
+    return JSONResponse(jsonable_encoder(workflow)).body
+
+
+def current_render(workflow, adapter: TypeAdapter):
+    # what FastAPI does with a response model: validate, serialize in json mode, render
+    return ORJSONResponse(adapter.dump_python(adapter.validate_python(workflow), mode='json')).body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=10_000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    workflow_id = seed(args.nodes)
+    adapter = TypeAdapter(WorkflowSchema)
+    client = TestClient(app)
+
+    with SessionLocal() as db:
+        former_workflow = former_load(db, workflow_id)
+        current_workflow = GraphService.load_workflow(db, workflow_id)
+        results = [
+            ('former load', measure(lambda: former_load(db, workflow_id), args.repeat)),
+            ('former jsonable_encoder + json', measure(lambda: former_render(former_workflow), args.repeat)),
+            ('column load', measure(lambda: GraphService.load_workflow(db, workflow_id), args.repeat)),
+            ('response model + orjson', measure(lambda: current_render(current_workflow, adapter), args.repeat)),
+        ]
+    results.append(('GET /get/{id} through the app', measure(lambda: client.get(f'/get/{workflow_id}'), args.repeat)))
+
+    print(f"{args.nodes} nodes, {len(client.get(f'/get/{workflow_id}').content)} bytes")
+    for name, elapsed in results:
+        print(f"{name:>32} {elapsed:>9.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
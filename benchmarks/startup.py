@@ -0,0 +1,90 @@
+"""
+Cold start of serve.py on a temporary database: time until the first liveness and readiness answers,
+the startup each worker reports, the latency of the first workflow request and the time to stop
+on SIGTERM.
+
+    python -m benchmarks.startup --workers 1 4
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+HOST = '127.0.0.1'
+
+
+def wait_for(client: httpx.Client, path: str, deadline: float) -> httpx.Response:
+    while time.monotonic() < deadline:
+        try:
+            response = client.get(path)
+            if response.status_code == 200:
+                return response
+        except httpx.TransportError:
+            pass
+        time.sleep(0.005)
+    raise RuntimeError(f'{path} did not answer')
+
+
+def benchmark(workers: int, port: int, timeout: float = 60) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(directory, 'benchmark.db')}")
+        env.pop('READ_DATABASE_URL', None)
+        started = time.monotonic()
+        server = subprocess.Popen(
+            [sys.executable, 'serve.py', '--host', HOST, '--port', str(port), '--workers', str(workers), '--log-level', 'warning'],
+            env=env,
+        )
+        try:
+            with httpx.Client(base_url=f'http://{HOST}:{port}', timeout=timeout) as client:
+                deadline = started + timeout
+                wait_for(client, '/health/live', deadline)
+                live = time.monotonic() - started
+                wait_for(client, '/health/ready', deadline)
+                ready = time.monotonic() - started
+
+                request_started = time.monotonic()
+                workflow_id = client.post('/create-workflow', json={'name': 'startup'}).json()['id']
+                client.get(f'/get/{workflow_id}')
+                first_request = time.monotonic() - request_started
+
+                # connections are spread over the workers, poll until each has answered
+                workers_startup = {}
+                while len(workers_startup) < workers and time.monotonic() < deadline:
+                    with httpx.Client(base_url=f'http://{HOST}:{port}') as fresh:
+                        body = fresh.get('/health/ready').json()
+                    workers_startup[body['pid']] = body['startup_seconds']
+        finally:
+            stopping = time.monotonic()
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+            stop = time.monotonic() - stopping
+
+    return {
+        'workers': workers,
+        'live_ms': live * 1000,
+        'ready_ms': ready * 1000,
+        'worker_startup_ms': max(workers_startup.values()) * 1000,
+        'first_request_ms': first_request * 1000,
+        'stop_ms': stop * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'live, ms':>9} {'ready, ms':>10} {'slowest worker, ms':>19} {'first request, ms':>18} {'stop, ms':>9}")
+    for workers in args.workers:
+        result = benchmark(workers, args.port)
+        print(f"{result['workers']:>8} {result['live_ms']:>9.0f} {result['ready_ms']:>10.0f} {result['worker_startup_ms']:>19.0f} "
+              f"{result['first_request_ms']:>18.1f} {result['stop_ms']:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""
+Benchmark suite over synthetic workflows: linear chains, condition trees and wide fan-out, created
+node by node through NodeService and run through WorkflowServices, on a temporary database.
+For every shape and size it measures the creation throughput, the latency percentiles of cold and
+warm runs, the SQL queries per operation and the peak memory of a cold run, and writes them to a
+JSON file. A previous file given as --baseline is compared with the new results.
+
+    python -m benchmarks.suite --sizes 10 1000 100000 --output benchmark.json
+    python -m benchmarks.suite --baseline benchmark.json --output benchmark-new.json
+
+Workflows above --create-limit nodes are inserted with GraphImport instead of one node at a time,
+their creation is not measured.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+DIRECTORY = tempfile.TemporaryDirectory()
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(DIRECTORY.name, 'benchmark.db')}"
+os.environ.pop('READ_DATABASE_URL', None)
+# the history writer inserts from its own thread, its queries would be counted with the runs
+os.environ['HISTORY_ENABLED'] = 'false'
+
+from sqlalchemy import event
+from database import engine, read_engine, SessionLocal, ReadSessionLocal
+from migrations import migrate
+from schemas.workflow import WorkflowCreateSchema, StartNodeSchema, MessageNodeSchema, ConditionNodeSchema, EndNodeSchema
+from services.executor import START, MESSAGE, CONDITION
+from services.importer import GraphImport
+from services.node import NodeService
+from services.plan import plan_cache
+from services.workflow import WorkflowServices
+from benchmarks.generator import SHAPES, creation_order, import_lines
+
+SIZES = [10, 100, 1_000, 10_000, 100_000]
+# one commit per node: 100k nodes take minutes
+CREATE_LIMIT = 10_000
+# compared with --baseline, changes below this ratio are noise
+THRESHOLD = 0.1
+
+
+class QueryCounter:
+    def __init__(self, *engines):
+        self.count = 0
+        for counted in {id(item): item for item in engines}.values():
+            event.listen(counted, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, *args):
+        self.count += 1
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def create_nodes(rows: list, workflow_id: int) -> dict:
+    """
+    Creates the nodes through NodeService, targets first so that every edge is set on creation.
+    """
+    ids = {}
+    with SessionLocal() as db:
+        for node_id, kind, next_id, yes_id, no_id in creation_order(rows):
+            if kind == START:
+                node = NodeService.create_node('start', StartNodeSchema(workflow_id=workflow_id, next_node_id=ids[next_id]), db)
+            elif kind == MESSAGE:
+                data = MessageNodeSchema(workflow_id=workflow_id, message_text=f'message {node_id}', status='sent', next_node_id=ids[next_id])
+                node = NodeService.create_node('message', data, db)
+            elif kind == CONDITION:
+                data = ConditionNodeSchema(workflow_id=workflow_id, condition="status == 'sent'", yes_node_id=ids[yes_id], no_node_id=ids[no_id])
+                node = NodeService.create_node('condition', data, db)
+            else:
+                node = NodeService.create_node('end', EndNodeSchema(workflow_id=workflow_id), db)
+            ids[node_id] = node.id
+    return ids
+
+
+def import_workflow(rows: list, name: str) -> int:
+    with SessionLocal() as db:
+        graph_import = GraphImport(db, {'name': name})
+        graph_import.add_nodes(import_lines(rows))
+        return graph_import.finish()['id']
+
+
+def run(workflow_id: int) -> dict:
+    with ReadSessionLocal() as db:
+        return WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow_id)
+
+
+def benchmark(shape: str, size: int, runs: int, create_limit: int, counter: QueryCounter) -> dict:
+    rows, _ = SHAPES[shape](size)
+    name = f'{shape}-{size}'
+    result = {'shape': shape, 'size': size, 'nodes': len(rows), 'create': None}
+
+    if len(rows) <= create_limit:
+        with SessionLocal() as db:
+            workflow_id = WorkflowServices.create_workflow(WorkflowCreateSchema(name=name), db).id
+        queries = counter.count
+        started = time.perf_counter()
+        create_nodes(rows, workflow_id)
+        elapsed = time.perf_counter() - started
+        result['create'] = {
+            'seconds': elapsed,
+            'nodes_per_second': len(rows) / elapsed,
+            'queries_per_node': (counter.count - queries) / len(rows),
+        }
+    else:
+        workflow_id = import_workflow(rows, name)
+
+    # cold: the plan is loaded and compiled, warm: served from the plan cache
+    plan_cache.clear()
+    queries = counter.count
+    started = time.perf_counter()
+    path = run(workflow_id)['success_path']
+    cold = time.perf_counter() - started
+    cold_queries = counter.count - queries
+
+    plan_cache.clear()
+    tracemalloc.start()
+    run(workflow_id)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = []
+    queries = counter.count
+    for _ in range(runs):
+        started = time.perf_counter()
+        run(workflow_id)
+        latencies.append(time.perf_counter() - started)
+
+    result['run'] = {
+        'path_length': len(path),
+        'cold_ms': cold * 1000,
+        'cold_queries': cold_queries,
+        'cold_peak_memory_kb': peak / 1024,
+        'runs': runs,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'queries_per_run': (counter.count - queries) / runs,
+    }
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline: dict):
+    """
+    Prints the metrics that changed by more than THRESHOLD against the baseline results.
+    """
+    previous = {(item['shape'], item['size']): item for item in baseline['results']}
+    print(f"\nagainst {baseline.get('commit') or 'baseline'}:")
+    changed = False
+    for item in results:
+        before = previous.get((item['shape'], item['size']))
+        if before is None:
+            continue
+        pairs = [(f'run.{key}', item['run'][key], before['run'][key]) for key in ('cold_ms', 'p50_ms', 'p99_ms', 'queries_per_run', 'cold_peak_memory_kb')]
+        if item['create'] and before['create']:
+            pairs.append(('create.nodes_per_second', item['create']['nodes_per_second'], before['create']['nodes_per_second']))
+        for key, value, old in pairs:
+            if old and abs(value - old) / old > THRESHOLD:
+                changed = True
+                print(f"{item['shape']:>8} {item['size']:>7} {key:>24} {old:>12.3f} -> {value:>12.3f} ({(value - old) / old:+.0%})")
+    if not changed:
+        print(f"no change above {THRESHOLD:.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shapes', nargs='+', choices=list(SHAPES), default=list(SHAPES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--runs', type=int, default=200, help='warm runs per workflow')
+    parser.add_argument('--create-limit', type=int, default=CREATE_LIMIT, help='larger workflows are imported, not created node by node')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    migrate(engine)
+    counter = QueryCounter(engine, read_engine)
+    results = []
+    print(f"{'shape':>8} {'nodes':>7} {'create/s':>9} {'q/node':>7} {'cold, ms':>9} {'p50, ms':>9} {'p99, ms':>9} {'q/run':>6} {'peak, KB':>9}")
+    for shape in args.shapes:
+        for size in args.sizes:
+            result = benchmark(shape, size, args.runs, args.create_limit, counter)
+            results.append(result)
+            create, run_stats = result['create'], result['run']
+            create_rate = f"{create['nodes_per_second']:.0f}" if create else '-'
+            create_queries = f"{create['queries_per_node']:.1f}" if create else '-'
+            print(f"{shape:>8} {result['nodes']:>7} {create_rate:>9} {create_queries:>7} {run_stats['cold_ms']:>9.2f} {run_stats['p50_ms']:>9.3f} "
+                  f"{run_stats['p99_ms']:>9.3f} {run_stats['queries_per_run']:>6.1f} {run_stats['cold_peak_memory_kb']:>9.0f}")
+
+    report = {
+        'commit': git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'runs': args.runs,
+        'create_limit': args.create_limit,
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
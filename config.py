@@ -0,0 +1,80 @@
+import os
+
+
+class Settings:
+    """
+    Application settings, read from environment variables.
+    """
+
+    def __init__(self):
+        # server of serve.py, WEB_CONCURRENCY worker processes
+        self.server_host = os.environ.get('SERVER_HOST', '127.0.0.1')
+        self.server_port = int(os.environ.get('SERVER_PORT', 8000))
+        self.server_workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+        self.server_loop = os.environ.get('SERVER_LOOP', 'auto')  # auto, asyncio or uvloop
+        self.server_http = os.environ.get('SERVER_HTTP', 'auto')  # auto, h11 or httptools
+        self.graceful_timeout = float(os.environ.get('GRACEFUL_TIMEOUT', 30))  # seconds to finish requests on shutdown
+        # serve.py migrates once before starting the workers and turns this off for them
+        self.migrate_on_startup = os.environ.get('MIGRATE_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+
+        self.database_url = os.environ.get('DATABASE_URL', 'sqlite:///./sql_app.db')
+        self.async_database_url = os.environ.get('ASYNC_DATABASE_URL', self.database_url.replace('sqlite://', 'sqlite+aiosqlite://', 1))
+        # "sync" serves the API with blocking sessions in the threadpool, "async" with async sessions on the event loop
+        self.db_mode = os.environ.get('DB_MODE', 'sync')
+        self.db_pool_size = int(os.environ.get('DB_POOL_SIZE', 5))
+        # reads (GET and run endpoints) use their own pool, on a replica if READ_DATABASE_URL is set
+        self.read_database_url = os.environ.get('READ_DATABASE_URL', self.database_url)
+        # SQLite allows one writer at a time, a single pooled writer connection queues writes of a process
+        # instead of retrying on "database is locked"
+        self.db_write_pool_size = int(os.environ.get('DB_WRITE_POOL_SIZE', 1))
+        self.db_pool_timeout = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+
+        # "production" enables WAL and the pragmas below for SQLite, "default" keeps the SQLite defaults
+        self.db_profile = os.environ.get('DB_PROFILE', 'production')
+        self.sqlite_busy_timeout = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # ms
+        self.sqlite_synchronous = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+        self.sqlite_cache_size = int(os.environ.get('SQLITE_CACHE_SIZE', -64000))  # negative is KiB
+        self.sqlite_mmap_size = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+        # write-behind mode: mutations of concurrent requests are committed together in one transaction
+        self.group_commit = os.environ.get('GROUP_COMMIT', 'false').lower() in ('1', 'true', 'yes')
+        self.group_commit_max_batch = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 256))
+        self.group_commit_delay_ms = float(os.environ.get('GROUP_COMMIT_DELAY_MS', 2))
+
+        # structural rules are checked when nodes are written, compiling a plan can skip checking them again
+        self.validate_on_run = os.environ.get('VALIDATE_ON_RUN', 'true').lower() in ('1', 'true', 'yes')
+        # runs submitted to /run-sequence/{workflow_id}/submit: "thread" or "process" pool
+        self.run_queue_executor = os.environ.get('RUN_QUEUE_EXECUTOR', 'thread')
+        self.run_queue_workers = int(os.environ.get('RUN_QUEUE_WORKERS', 2))
+        self.run_queue_max_size = int(os.environ.get('RUN_QUEUE_MAX_SIZE', 1000))  # unfinished jobs per process
+        self.run_result_ttl = float(os.environ.get('RUN_RESULT_TTL', 300))  # seconds
+
+        # run history is buffered in memory and inserted in batches by a background thread
+        self.history_enabled = os.environ.get('HISTORY_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+        self.history_batch_size = int(os.environ.get('HISTORY_BATCH_SIZE', 500))
+        self.history_flush_ms = float(os.environ.get('HISTORY_FLUSH_MS', 200))
+        self.history_buffer_size = int(os.environ.get('HISTORY_BUFFER_SIZE', 10000))  # records above are dropped
+        self.history_retention_days = float(os.environ.get('HISTORY_RETENTION_DAYS', 30))
+        self.history_max_rows = int(os.environ.get('HISTORY_MAX_ROWS', 1000000))
+
+        # request latency, SQL and run phase metrics served at /metrics, per worker process
+        self.metrics_enabled = os.environ.get('METRICS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+        self.plan_cache_size = int(os.environ.get('PLAN_CACHE_SIZE', 256))
+        # node and workflow details served without the database, 0 disables the cache
+        self.read_cache_size = int(os.environ.get('READ_CACHE_SIZE', 10000))
+        self.read_cache_ttl = float(os.environ.get('READ_CACHE_TTL', 60))  # seconds
+        self.read_cache_sync_ms = float(os.environ.get('READ_CACHE_SYNC_MS', 1000))  # changes of other workers are seen within
+        self.rule_cache_size = int(os.environ.get('RULE_CACHE_SIZE', 1024))
+        self.import_chunk_size = int(os.environ.get('IMPORT_CHUNK_SIZE', 1000))
+        self.import_spool_size = int(os.environ.get('IMPORT_SPOOL_SIZE', 8 * 1024 * 1024))  # bytes of an import body kept in memory
+        self.snapshot_chunk_size = int(os.environ.get('SNAPSHOT_CHUNK_SIZE', 10000))  # nodes per block of exported snapshots
+        self.clone_max_copies = int(os.environ.get('CLONE_MAX_COPIES', 10000))  # copies per clone request
+        self.run_batch_chunk_size = int(os.environ.get('RUN_BATCH_CHUNK_SIZE', 500))
+        self.run_stream_chunk_size = int(os.environ.get('RUN_STREAM_CHUNK_SIZE', 1000))  # node ids or edges per streamed event
+        # ids per IN list of bulk updates, below the SQLite limit of bound parameters
+        self.status_chunk_size = int(os.environ.get('STATUS_CHUNK_SIZE', 900))
+        self.audience_chunk_size = int(os.environ.get('AUDIENCE_CHUNK_SIZE', 10000))
+
+
+settings = Settings()
@@ -1,14 +1,116 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, declarative_base
+from config import settings
 
-SQLALCHEMY_URL = "sqlite:///./sql_app.db"
-engine = create_engine(SQLALCHEMY_URL, connect_args={'check_same_thread': False})
+
+def sqlite_pragmas(read_only: bool = False) -> list:
+    """
+    Returns the pragmas applied to every new SQLite connection of the configured profile.
+    """
+    if settings.db_profile != 'production':
+        return [f'PRAGMA busy_timeout = {settings.sqlite_busy_timeout}']
+    pragmas = [
+        # readers don`t block the writer and the writer doesn`t block readers
+        'PRAGMA journal_mode = WAL',
+        # in WAL mode NORMAL is still safe from corruption, only the last commits may be lost on power failure
+        f'PRAGMA synchronous = {settings.sqlite_synchronous}',
+        f'PRAGMA busy_timeout = {settings.sqlite_busy_timeout}',
+        f'PRAGMA cache_size = {settings.sqlite_cache_size}',
+        f'PRAGMA mmap_size = {settings.sqlite_mmap_size}',
+        'PRAGMA temp_store = MEMORY',
+    ]
+    if read_only:
+        pragmas.append('PRAGMA query_only = ON')
+    return pragmas
+
+
+def is_memory_database(url) -> bool:
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def set_sqlite_pragmas(engine, read_only: bool = False):
+    pragmas = sqlite_pragmas(read_only)
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def create_db_engine(url: str, pool_size: int, max_overflow: int = 0, read_only: bool = False, **kwargs):
+    """
+    Creates a database engine. SQLite connections are shared between threads and get the pragmas
+    of the configured profile.
+
+    Args:
+        url (str): Database URL.
+        pool_size (int): Number of pooled connections.
+        max_overflow (int): Connections opened over pool_size under load.
+        read_only (bool): Reject writes on the connections of this engine.
+    """
+    if is_memory_database(url):
+        # every connection to ":memory:" is a separate database, so it can`t be pooled
+        return create_engine(url, connect_args={'check_same_thread': False}, **kwargs)
+
+    pool_options = {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': settings.db_pool_timeout}
+    if make_url(url).get_backend_name() != 'sqlite':
+        return create_engine(url, **pool_options, **kwargs)
+
+    engine = create_engine(url, connect_args={'check_same_thread': False}, **pool_options, **kwargs)
+    set_sqlite_pragmas(engine, read_only)
+    return engine
+
+
+SQLALCHEMY_URL = settings.database_url
+engine = create_db_engine(SQLALCHEMY_URL, pool_size=settings.db_write_pool_size)
+if settings.read_database_url == SQLALCHEMY_URL and is_memory_database(SQLALCHEMY_URL):
+    read_engine = engine
+else:
+    read_engine = create_db_engine(settings.read_database_url, pool_size=settings.db_pool_size, max_overflow=settings.db_pool_size, read_only=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 Base = declarative_base()
 
+# async engine is created on first use, so the sync mode doesn`t need aiosqlite
+async_engine = None
+AsyncSessionLocal = None
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_async_sessionmaker():
+    global async_engine, AsyncSessionLocal
+    if AsyncSessionLocal is None:
+        # aiosqlite defaults to NullPool: a new connection and thread for every session
+        async_engine = create_async_engine(settings.async_database_url, poolclass=AsyncAdaptedQueuePool, pool_size=settings.db_pool_size, max_overflow=0)
+        if async_engine.dialect.name == 'sqlite':
+            set_sqlite_pragmas(async_engine.sync_engine)
+        # objects are returned to the client after commit and can`t be lazily reloaded in async mode
+        AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+    return AsyncSessionLocal
+
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        yield db
+
+async def dispose_async_engine():
+    # pooled aiosqlite connections run in their own threads, which keep the process alive
+    if async_engine is not None:
+        await async_engine.dispose()
@@ -1,12 +1,48 @@
-import uvicorn
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from database import SessionLocal, engine, Base
-from routers import workflow as WorkflowRouters, node as NodeRouters
+from fastapi.responses import ORJSONResponse
+from config import settings
+from database import engine, read_engine, dispose_async_engine
+from migrations import migrate
+from services.run_queue import run_queue
+from services.history import history_writer
+from services.metrics import metrics, MetricsMiddleware
+from services.health import server_state
+from routers import workflow as WorkflowRouters, node as NodeRouters, contact as ContactRouters, metrics as MetricsRouters, health as HealthRouters
+from routers import async_workflow as AsyncWorkflowRouters, async_node as AsyncNodeRouters
 
-Base.metadata.create_all(bind=engine)
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup_seconds = server_state.mark_ready()
+    logger.info("Worker ready in %.0f ms", startup_seconds * 1000)
+    yield
+    # the server has stopped accepting connections and finished the running requests
+    server_state.mark_draining()
+    run_queue.shutdown()
+    history_writer.close()
+    await dispose_async_engine()
+    engine.dispose()
+    read_engine.dispose()
+
+logger = logging.getLogger('uvicorn.error')
+if settings.migrate_on_startup:
+    migrate(engine)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+if metrics.enabled:
+    metrics.install_sql_hooks()
+    app.add_middleware(MetricsMiddleware)
+if settings.db_mode == 'async':
+    # registered first, so they take precedence over the sync routes with the same path
+    app.include_router(AsyncWorkflowRouters.router, prefix="")
+    app.include_router(AsyncNodeRouters.router, prefix="/node")
 app.include_router(WorkflowRouters.router, prefix="")
 app.include_router(NodeRouters.router, prefix="/node")
+app.include_router(ContactRouters.router, prefix="/contacts")
+app.include_router(MetricsRouters.router, prefix="")
+app.include_router(HealthRouters.router, prefix="/health")
 
 if __name__ == '__main__':
-    uvicorn.run('main:app', reload=True, workers=3)
\ No newline at end of file
+    import serve
+    serve.main()
@@ -0,0 +1,60 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.engine import Engine
+from database import Base
+import models.workflow  # registers tables in Base.metadata
+from services.graph import refresh_message_nodes
+
+
+def migrate(engine: Engine):
+    """
+    Brings the database schema up to date with the models: creates missing tables, adds missing
+    columns to existing tables and creates missing indexes. Safe to run on every start,
+    existing sql_app.db files are upgraded in place.
+    """
+    added_columns = set()
+    # a single connection: the writer pool may hold only one
+    with engine.begin() as connection:
+        Base.metadata.create_all(bind=connection)
+        if engine.dialect.name == 'sqlite':
+            for table in Base.metadata.sorted_tables:
+                if table.dialect_options['sqlite']['autoincrement']:
+                    add_autoincrement(connection, table)
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                connection.execute(text(ddl))
+                added_columns.add((table.name, column.name))
+
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+        # columns derived from existing data
+        if ('condition_nodes', 'message_node_id') in added_columns:
+            refresh_message_nodes(connection)
+
+
+def add_autoincrement(connection, table):
+    """
+    Rebuilds a SQLite table created without AUTOINCREMENT, so that the ids of deleted rows are never
+    given again. The rows are copied to a new table, which replaces the old one; the indexes are
+    created again by migrate.
+    """
+    sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table.name}).scalar()
+    if sql is None or 'AUTOINCREMENT' in sql.upper():
+        return
+    existing_columns = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    columns = ', '.join(column.name for column in table.columns if column.name in existing_columns)
+    new_name = f'{table.name}_autoincrement'
+    ddl = str(CreateTable(table).compile(dialect=connection.dialect)).strip()
+    connection.execute(text(ddl.replace(f'CREATE TABLE {table.name} (', f'CREATE TABLE {new_name} (', 1)))
+    connection.execute(text(f'INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {table.name}'))
+    connection.execute(text(f'DROP TABLE {table.name}'))
+    connection.execute(text(f'ALTER TABLE {new_name} RENAME TO {table.name}'))
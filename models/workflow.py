@@ -1,40 +1,60 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Enum
+from sqlalchemy import Column, Integer, String, ForeignKey, Enum, JSON, Boolean, Float, Index
 from sqlalchemy.orm import relationship, Session
 from database import Base 
 import rule_engine
 
+# message statuses in delivery order, a status only moves forward
+MESSAGE_STATUSES = ('pending', 'sent', 'opened')
+# states of a queued run
+RUN_JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+
 # Workflow model
 class Workflow(Base):
     __tablename__ = 'workflows'
+    # ids are never reused: plans, ETags and cache entries are keyed on (id, version)
+    __table_args__ = {'sqlite_autoincrement': True}
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String)
+    version = Column(Integer, nullable=False, default=1, server_default='1')  # bumped on every change of the workflow or its nodes
     nodes = relationship("Node", back_populates="workflow", cascade='all, delete')
+    result = relationship("WorkflowResult", uselist=False, cascade='all, delete')
 
 # Base node model
 class Node(Base):
     __tablename__ = 'nodes'
+    __table_args__ = {'sqlite_autoincrement': True}
 
     id = Column(Integer, primary_key=True, index=True)
     node_type = Column(String)  # Node type (start, message, condition, end)
-    workflow_id = Column(Integer, ForeignKey('workflows.id'))
+    workflow_id = Column(Integer, ForeignKey('workflows.id'), index=True)
+    version = Column(Integer, nullable=False, default=1, server_default='1')  # bumped on every change of the node
     workflow = relationship("Workflow", back_populates="nodes", cascade='all, delete')
 
     __mapper_args__ = {
         'polymorphic_on': node_type
     }
 
+# Last run result of a workflow, patched when the statuses read by its conditions change
+class WorkflowResult(Base):
+    __tablename__ = 'workflow_results'
+
+    workflow_id = Column(Integer, ForeignKey('workflows.id'), primary_key=True)
+    version = Column(Integer, nullable=False)  # workflow version the path was computed for
+    success_path = Column(JSON, nullable=False)
+
 """ Specific nodes classes """
 
 class StartNode(Node):
     __tablename__ = 'start_nodes'
 
     id = Column(Integer, ForeignKey('nodes.id'), primary_key=True, index=True)
-    next_node_id = Column(Integer, ForeignKey('nodes.id'))
+    next_node_id = Column(Integer, ForeignKey('nodes.id'), index=True)
     next_node = relationship("Node", foreign_keys=[next_node_id])
 
     __mapper_args__ = {
         'inherit_condition': id == Node.id,
-        'polymorphic_identity': 'start'
+        'polymorphic_identity': 'start',
+        'polymorphic_load': 'inline'
     }
 
 
@@ -43,13 +63,14 @@ class MessageNode(Node):
 
     id = Column(Integer, ForeignKey('nodes.id'), primary_key=True, index=True)
     message_text = Column(String)
-    status = Column(Enum('pending', 'sent', 'opened'))
-    next_node_id = Column(Integer, ForeignKey('nodes.id'))
+    status = Column(Enum(*MESSAGE_STATUSES))
+    next_node_id = Column(Integer, ForeignKey('nodes.id'), index=True)
     next_node = relationship("Node", foreign_keys=[next_node_id])
 
     __mapper_args__ = {
         'inherit_condition': id == Node.id,
-        'polymorphic_identity': 'message'
+        'polymorphic_identity': 'message',
+        'polymorphic_load': 'inline'
     }
 
 class ConditionNode(Node):
@@ -57,17 +78,21 @@ class ConditionNode(Node):
 
     id = Column(Integer, ForeignKey('nodes.id'), primary_key=True, index=True)
     condition = Column(String)
-    yes_node_id = Column(Integer, ForeignKey('nodes.id'))
-    no_node_id = Column(Integer, ForeignKey('nodes.id'))
+    yes_node_id = Column(Integer, ForeignKey('nodes.id'), index=True)
+    no_node_id = Column(Integer, ForeignKey('nodes.id'), index=True)
+    # MessageNode whose status is checked by the condition, kept up to date by NodeService
+    message_node_id = Column(Integer, ForeignKey('nodes.id'), index=True)
     yes_node = relationship("Node", foreign_keys=[yes_node_id])
     no_node = relationship("Node", foreign_keys=[no_node_id])
 
-    def evaluate_condition(self, db: Session):
+    def evaluate_condition(self, db: Session, message_node: "MessageNode" = None):
         """
         Evaluates the condition for a node of type ConditionNode.
 
         Args:
             db (Session): The SQLAlchemy database session.
+            message_node (MessageNode, optional): Already resolved MessageNode whose status is checked.
+                If omitted, it is looked up through the database.
 
         Returns:
             bool: True if the condition evaluates to True, False otherwise.
@@ -75,48 +100,38 @@ class ConditionNode(Node):
         Raises:
             ValueError: If an unexpected error occurs.
         """
-        rule = rule_engine.Rule(self.condition)
-
-        connected_message_node = db.query(MessageNode).filter(MessageNode.next_node_id == self.id).first()
-
-            # Finding connected nodes of type ConditionNode
-        connected_condition_node = db.query(ConditionNode).filter(ConditionNode.no_node_id == self.id).first()
-
-        print('cond:', connected_message_node)
-        if connected_message_node:
-                # If a connected node of type MessageNode is found, check the condition based on it
-            rule_dict = {
-                'status': str(connected_message_node.status),
-            }
-
-            if rule.matches(rule_dict):
-                return True
-            else:
-                return False
-        elif connected_condition_node:
-                # If a connected node of type ConditionNode is found, get the previous node of type MessageNode
-            previous_message_node = db.query(MessageNode).filter(MessageNode.next_node_id == connected_condition_node.id).first()
-
-            if previous_message_node:
-                    # If the previous node of type MessageNode is found, check the condition based on it
-                try:
-                    rule_dict = {
-                        'status': str(previous_message_node.status),
-                    }
-                    if rule.matches(rule_dict):
-                        return True
-                    else:
-                        return False
-                except:
-                    raise ValueError("Rule error")
-            else:
-                raise ValueError('Unforeseen error')
-        else:
+        if message_node is None:
+            message_node = self.find_message_node(db)
+        return self.matches(message_node.status)
+
+    def find_message_node(self, db: Session):
+        """
+        Returns the MessageNode whose status is checked by this condition: either the message node
+        leading directly to it, or the one leading to the condition node whose "no" branch points here.
+        """
+        message_node = None
+        if self.message_node_id:
+            message_node = db.get(MessageNode, self.message_node_id)
+        if not message_node:
             raise ValueError('Condition Node has no connected message nodes')
+        return message_node
+
+    def matches(self, status):
+        """
+        Checks the condition against the status of a message node. Runs use the compiled rules of services.rules.
+
+        Raises:
+            ValueError: If the condition isn`t a valid rule.
+        """
+        try:
+            return bool(rule_engine.Rule(self.condition).matches({'status': str(status)}))
+        except rule_engine.EngineError as e:
+            raise ValueError(f"Rule error: {e.message}")
 
     __mapper_args__ = {
         'inherit_condition': id == Node.id,
-        'polymorphic_identity': 'condition'
+        'polymorphic_identity': 'condition',
+        'polymorphic_load': 'inline'
     }
 
 class EndNode(Node):
@@ -126,5 +141,83 @@ class EndNode(Node):
 
     __mapper_args__ = {
         'inherit_condition': id == Node.id,
-        'polymorphic_identity': 'end'  # Указываем идентификатор полиморфизма
-    }
\ No newline at end of file
+        'polymorphic_identity': 'end',  # Указываем идентификатор полиморфизма
+        'polymorphic_load': 'inline'
+    }
+
+
+""" Audience models """
+
+class Contact(Base):
+    __tablename__ = 'contacts'
+
+    id = Column(Integer, primary_key=True, index=True)
+    external_id = Column(String, unique=True, nullable=False)  # id of the recipient in the client system
+    statuses = relationship("ContactStatus", back_populates="contact", cascade='all, delete')
+
+class ContactStatus(Base):
+    """
+    Status of a message node for one recipient. A contact without a row for a message node
+    has the status stored on the node itself.
+    """
+    __tablename__ = 'contact_statuses'
+
+    contact_id = Column(Integer, ForeignKey('contacts.id'), primary_key=True)
+    message_node_id = Column(Integer, ForeignKey('nodes.id'), primary_key=True)
+    status = Column(Enum(*MESSAGE_STATUSES))
+    contact = relationship("Contact", back_populates="statuses")
+
+
+""" Run queue models """
+
+class RunJob(Base):
+    """
+    Run submitted to the run queue. Kept in the database, so any worker process can report it.
+    """
+    __tablename__ = 'run_jobs'
+
+    id = Column(String, primary_key=True)
+    workflow_id = Column(Integer, nullable=False)
+    audience = Column(Boolean, nullable=False, default=False)
+    status = Column(Enum(*RUN_JOB_STATUSES), nullable=False)
+    result = Column(JSON)
+    status_code = Column(Integer)  # of the error of a failed run
+    error = Column(String)
+    created_at = Column(Float, nullable=False)  # unix time
+    finished_at = Column(Float, index=True)
+
+
+""" Run history models """
+
+class RunHistory(Base):
+    """
+    Record of a workflow run, written in batches in the background by services.history.
+    """
+    __tablename__ = 'run_history'
+
+    id = Column(Integer, primary_key=True)
+    workflow_id = Column(Integer, nullable=False)
+    version = Column(Integer)  # None if the run failed before the workflow was loaded
+    success_path = Column(JSON)
+    conditions = Column(JSON)  # [condition node id, result] pairs in evaluation order
+    duration_ms = Column(Float, nullable=False)
+    status_code = Column(Integer)
+    error = Column(String)
+    created_at = Column(Float, nullable=False, index=True)  # unix time
+
+    # keyset pagination of the runs of a workflow
+    __table_args__ = (Index('ix_run_history_workflow_id_id', 'workflow_id', 'id'),)
+
+
+""" Cache models """
+
+class CacheVersion(Base):
+    """
+    Last change of a cached entry ("node:<id>" or "workflow:<id>"). Written in the transaction of the
+    change, read by every worker process to drop its stale entries, see services.cache.
+    """
+    __tablename__ = 'cache_versions'
+
+    key = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, index=True)  # increases with every change of any key
+    changed_at = Column(Float, nullable=False, default=0, server_default='0')  # unix time, old rows are pruned
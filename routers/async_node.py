@@ -0,0 +1,74 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException, Response, Header
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
+from services.node import AsyncNodeService
+from services.etag import node_etag, etag_matches, not_modified
+from routers.node import with_etag
+from schemas.workflow import *
+
+# async versions of the routes in routers/node.py, included instead of them in the async database mode
+router = APIRouter()
+
+
+@router.post("/create-start-node/", tags=['nodes'], response_model=StartNodeDetailSchema)
+async def create_start_node(node_data: StartNodeSchema, db: AsyncSession = Depends(get_async_db)):
+    created_node = await AsyncNodeService.create_node(node_type='start', db=db, data=node_data)
+    if created_node: # if start node doesn`t exist before (for specific workflow)`
+        return created_node
+    else:
+        return Response(content="Start node for this workflow is already exists.", status_code=200)
+
+@router.post("/create-message-node/", tags=['nodes'], response_model=MessageNodeDetailSchema)
+async def create_message_node(node_data: MessageNodeSchema, db: AsyncSession = Depends(get_async_db)):
+    return await AsyncNodeService.create_node(node_type='message', db=db, data=node_data)
+
+@router.post("/create-condition-node/", tags=['nodes'], response_model=ConditionNodeDetailSchema)
+async def create_condition_node(node_data: ConditionNodeSchema, db: AsyncSession = Depends(get_async_db)):
+    return await AsyncNodeService.create_node(node_type='condition', db=db, data=node_data)
+
+@router.post("/create-end-node/", tags=['nodes'], response_model=EndNodeDetailSchema)
+async def create_end_node(node_data: EndNodeSchema, db: AsyncSession = Depends(get_async_db)):
+    created_node = await AsyncNodeService.create_node(node_type='end', db=db, data=node_data)
+    if created_node: # if end node doesn`t exist before (for specific workflow)`
+        return created_node
+    else:
+        return Response(content="End node for this workflow is already exists.", status_code=200)
+
+@router.put('/update-start-node/{node_id}', tags=['nodes'], response_model=StartNodeDetailSchema)
+async def update_start_node(node_data: StartNodeSchema, node_id: int, response: Response = None, if_match: Annotated[Optional[str], Header()] = None, db: AsyncSession = Depends(get_async_db)):
+    return with_etag(await AsyncNodeService.update_node(node_id=node_id, db=db, data=node_data, if_match=if_match), response)
+
+@router.put('/update-message-node/{node_id}', tags=['nodes'], response_model=MessageNodeDetailSchema)
+async def update_message_node(node_data: MessageNodeSchema, node_id: int, response: Response = None, if_match: Annotated[Optional[str], Header()] = None, db: AsyncSession = Depends(get_async_db)):
+    return with_etag(await AsyncNodeService.update_node(node_id=node_id, db=db, data=node_data, if_match=if_match), response)
+
+@router.put('/update-condition-node/{node_id}', tags=['nodes'], response_model=ConditionNodeDetailSchema)
+async def update_condition_node(node_data: ConditionNodeSchema, node_id: int, response: Response = None, if_match: Annotated[Optional[str], Header()] = None, db: AsyncSession = Depends(get_async_db)):
+    return with_etag(await AsyncNodeService.update_node(node_id=node_id, db=db, data=node_data, if_match=if_match), response)
+
+@router.put('/update-end-node/{node_id}', tags=['nodes'], response_model=EndNodeDetailSchema)
+async def update_end_node(node_data: EndNodeSchema, node_id: int, response: Response = None, if_match: Annotated[Optional[str], Header()] = None, db: AsyncSession = Depends(get_async_db)):
+    return with_etag(await AsyncNodeService.update_node(node_id=node_id, db=db, data=node_data, if_match=if_match), response)
+
+@router.post('/update-message-statuses/', tags=['nodes'], response_model=MessageStatusesUpdateResultSchema)
+async def update_message_statuses(data: MessageStatusesUpdateSchema, db: AsyncSession = Depends(get_async_db)):
+    return await AsyncNodeService.update_statuses(statuses=data.statuses, db=db)
+
+@router.get("/{node_id}", tags=['nodes'], response_model=NodeSchema)
+async def read_node(node_id: int, response: Response = None, if_none_match: Annotated[Optional[str], Header()] = None, db: AsyncSession = Depends(get_async_db)):
+    version = None
+    if if_none_match is not None:
+        version = await AsyncNodeService.get_version(db, node_id)
+        if version is not None and etag_matches(if_none_match, node_etag(node_id, version)):
+            return not_modified(node_etag(node_id, version))
+    db_node, version = await AsyncNodeService.get_versioned_node(db, node_id, version)
+    if db_node is None:
+        raise HTTPException(status_code=404, detail="Node not found.")
+    if response is not None:
+        response.headers['ETag'] = node_etag(node_id, version)
+    return db_node
+
+@router.delete("/delete/{node_id}", tags=['nodes'], response_model=bool)
+async def delete_node(node_id: int, if_match: Annotated[Optional[str], Header()] = None, db: AsyncSession = Depends(get_async_db)):
+    return await AsyncNodeService.delete_node(db=db, node_id=node_id, if_match=if_match)
@@ -0,0 +1,57 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException, Response, Header
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
+from services.workflow import WorkflowServices, AsyncWorkflowServices
+from services.etag import workflow_etag, etag_matches, not_modified
+from routers.workflow import ndjson_stream, event_stream
+from schemas.workflow import *
+
+# async versions of the routes in routers/workflow.py, included instead of them in the async database mode
+router = APIRouter()
+
+@router.post('/create-workflow', tags=['workflows'], response_model=WorkflowBaseSchema)
+async def create_workflow(data: WorkflowCreateSchema = None, db: AsyncSession = Depends(get_async_db)):
+    return await AsyncWorkflowServices.create_workflow(data, db)
+
+@router.get('/get/{id}', tags=['workflows'], response_model=WorkflowSchema)
+async def get_workflow(id: int = None, response: Response = None, if_none_match: Annotated[Optional[str], Header()] = None, db: AsyncSession = Depends(get_async_db)):
+    version = None
+    if if_none_match is not None:
+        version = await AsyncWorkflowServices.get_version(db, id)
+        if version is not None and etag_matches(if_none_match, workflow_etag(id, version)):
+            return not_modified(workflow_etag(id, version))
+    workflow, version = await AsyncWorkflowServices.get_versioned_workflow(db, id, version)
+    if workflow:
+        if response is not None:
+            response.headers['ETag'] = workflow_etag(id, version)
+        return workflow
+    else:
+        raise HTTPException(status_code=404, detail="Workflow not found.")
+
+@router.put('/update/{id}', tags=['workflows'], response_model=WorkflowBaseSchema)
+async def update_workflow(workflow_id: int, data: WorkflowSchema, response: Response = None, if_match: Annotated[Optional[str], Header()] = None, db: AsyncSession = Depends(get_async_db)):
+    workflow = await AsyncWorkflowServices.update_workflow(data=data, db=db, workflow_id=workflow_id, if_match=if_match)
+    if response is not None:
+        response.headers['ETag'] = workflow_etag(workflow.id, workflow.version)
+    return workflow
+
+@router.delete('/delete/{id}', tags=['workflows'], response_model=bool)
+async def delete_workflow(workflow_id: int, if_match: Annotated[Optional[str], Header()] = None, db: AsyncSession = Depends(get_async_db)):
+    return await AsyncWorkflowServices.delete_workflow(db=db, workflow_id=workflow_id, if_match=if_match)
+
+@router.post('/run-sequence/batch', tags=['workflows'], response_model=RunBatchResultSchema, response_model_exclude_none=True)
+async def run_sequence_batch(data: RunBatchSchema, stream: bool = False, db: AsyncSession = Depends(get_async_db)):
+    if stream:
+        return StreamingResponse(ndjson_stream(WorkflowServices.iter_run_batch(data.workflow_ids)), media_type='application/x-ndjson')
+    results = await db.run_sync(lambda session: WorkflowServices.run_batch(db=session, workflow_ids=data.workflow_ids))
+    return {'results': results}
+
+@router.post('/run-sequence/{workflow_id}', tags=['workflows'], response_model=Union[RunResultSchema, AudienceRunResultSchema], response_model_exclude_none=True)
+async def run_sequence(workflow_id: int, audience: bool = False, edges: bool = True, stream: Optional[RunStreamFormat] = None, db: AsyncSession = Depends(get_async_db)):
+    if stream is not None:
+        if audience:
+            raise HTTPException(status_code=400, detail="Error. Audience runs can`t be streamed.")
+        return event_stream(await AsyncWorkflowServices.stream_run(db=db, workflow_id=workflow_id, edges=edges), stream)
+    return await AsyncWorkflowServices.create_and_run_graph(db=db, workflow_id=workflow_id, audience=audience, edges=edges)
@@ -0,0 +1,17 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.orm import Session
+from database import get_db
+from services.audience import AudienceService
+from services.write_queue import run_write
+from schemas.workflow import *
+
+router = APIRouter()
+
+
+@router.post('/import', tags=['contacts'], response_model=ContactsImportResultSchema)
+def import_contacts(data: ContactsImportSchema, db: Session = Depends(get_db)):
+    """
+    Creates contacts and sets their statuses of message nodes. Existing contacts are matched by
+    `external_id`, statuses they already have are replaced.
+    """
+    return run_write(db, AudienceService.upsert_contacts, contacts=data.contacts)
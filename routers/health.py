@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.orm import Session
+from database import get_read_db
+from services.health import HealthService
+from schemas.workflow import LivenessSchema, ReadinessSchema
+
+router = APIRouter()
+
+
+@router.get('/live', tags=['health'], response_model=LivenessSchema)
+async def liveness():
+    """
+    Answers as long as the event loop of the worker process runs, even with a busy threadpool.
+    """
+    return HealthService.liveness()
+
+
+@router.get('/ready', tags=['health'], response_model=ReadinessSchema)
+def readiness(db: Session = Depends(get_read_db)):
+    """
+    503 until the worker has started, once it shuts down, or if the database can`t be read.
+    """
+    return HealthService.readiness(db)
@@ -0,0 +1,15 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
+from services.metrics import metrics
+
+router = APIRouter()
+
+
+@router.get('/metrics', tags=['metrics'], response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Metrics of this worker process in the Prometheus text format.
+    """
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled.")
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,59 +1,85 @@
-from fastapi import APIRouter, Depends, HTTPException, Response
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException, Response, Header
 from sqlalchemy.orm import Session
-from database import get_db
+from database import get_db, get_read_db
 from models.workflow import *
 from services.node import NodeService
+from services.write_queue import run_write
+from services.etag import node_etag, etag_matches, not_modified
 from schemas.workflow import *
 router = APIRouter()
 
+def with_etag(node, response: Response):
+    if response is not None:
+        response.headers['ETag'] = node_etag(node.id, node.version)
+    return node
 
-@router.post("/create-start-node/", tags=['nodes'])
+
+@router.post("/create-start-node/", tags=['nodes'], response_model=StartNodeDetailSchema)
 def create_start_node(node_data: StartNodeSchema, db: Session = Depends(get_db)):
-    created_node = NodeService.create_node(node_type='start', db=db, data=node_data)
+    created_node = run_write(db, NodeService.create_node, node_type='start', data=node_data)
     if created_node: # if start node doesn`t exist before (for specific workflow)`
         return created_node
     else:
         return Response(content="Start node for this workflow is already exists.", status_code=200)
 
-@router.post("/create-message-node/", tags=['nodes'])
+@router.post("/create-message-node/", tags=['nodes'], response_model=MessageNodeDetailSchema)
 def create_message_node(node_data: MessageNodeSchema, db: Session = Depends(get_db)):
-    return NodeService.create_node(node_type='message', db=db, data=node_data)
+    return run_write(db, NodeService.create_node, node_type='message', data=node_data)
 
-@router.post("/create-condition-node/", tags=['nodes'])
+@router.post("/create-condition-node/", tags=['nodes'], response_model=ConditionNodeDetailSchema)
 def create_condition_node(node_data: ConditionNodeSchema, db: Session = Depends(get_db)):
-    return NodeService.create_node(node_type='condition', db=db, data=node_data)
+    return run_write(db, NodeService.create_node, node_type='condition', data=node_data)
 
-@router.post("/create-end-node/", tags=['nodes'])
+@router.post("/create-end-node/", tags=['nodes'], response_model=EndNodeDetailSchema)
 def create_end_node(node_data: EndNodeSchema, db: Session = Depends(get_db)):
-    created_node = NodeService.create_node(node_type='end', db=db, data=node_data) 
+    created_node = run_write(db, NodeService.create_node, node_type='end', data=node_data) 
     if created_node: # if end node doesn`t exist before (for specific workflow)`
         return created_node
     else:
         return Response(content="End node for this workflow is already exists.", status_code=200)
 
-@router.put('/update-start-node/{node_id}', tags=['nodes'])
-def update_start_node(node_data: StartNodeSchema, node_id: int, db: Session = Depends(get_db)):
-    return NodeService.update_node(node_id=node_id, db=db, data=node_data)
+@router.put('/update-start-node/{node_id}', tags=['nodes'], response_model=StartNodeDetailSchema)
+def update_start_node(node_data: StartNodeSchema, node_id: int, response: Response = None, if_match: Annotated[Optional[str], Header()] = None, db: Session = Depends(get_db)):
+    return with_etag(run_write(db, NodeService.update_node, node_id=node_id, data=node_data, if_match=if_match), response)
+
+@router.put('/update-message-node/{node_id}', tags=['nodes'], response_model=MessageNodeDetailSchema)
+def update_message_node(node_data: MessageNodeSchema, node_id: int, response: Response = None, if_match: Annotated[Optional[str], Header()] = None, db: Session = Depends(get_db)):
+    return with_etag(run_write(db, NodeService.update_node, node_id=node_id, data=node_data, if_match=if_match), response)
 
-@router.put('/update-message-node/{node_id}', tags=['nodes'])
-def update_message_node(node_data: MessageNodeSchema, node_id: int, db: Session = Depends(get_db)):
-    return NodeService.update_node(node_id=node_id, db=db, data=node_data)
+@router.put('/update-condition-node/{node_id}', tags=['nodes'], response_model=ConditionNodeDetailSchema)
+def update_condition_node(node_data: ConditionNodeSchema, node_id: int, response: Response = None, if_match: Annotated[Optional[str], Header()] = None, db: Session = Depends(get_db)):
+    return with_etag(run_write(db, NodeService.update_node, node_id=node_id, data=node_data, if_match=if_match), response)
 
-@router.put('/update-condition-node/{node_id}', tags=['nodes'])
-def update_condition_node(node_data: ConditionNodeSchema, node_id: int, db: Session = Depends(get_db)):
-    return NodeService.update_node(node_id=node_id, db=db, data=node_data)
+@router.put('/update-end-node/{node_id}', tags=['nodes'], response_model=EndNodeDetailSchema)
+def update_end_node(node_data: EndNodeSchema, node_id: int, response: Response = None, if_match: Annotated[Optional[str], Header()] = None, db: Session = Depends(get_db)):
+    return with_etag(run_write(db, NodeService.update_node, node_id=node_id, data=node_data, if_match=if_match), response)
 
-@router.put('/update-end-node/{node_id}', tags=['nodes'])
-def update_end_node(node_data: EndNodeSchema, node_id: int, db: Session = Depends(get_db)):
-    return NodeService.update_node(node_id=node_id, db=db, data=node_data)
+@router.post('/update-message-statuses/', tags=['nodes'], response_model=MessageStatusesUpdateResultSchema)
+def update_message_statuses(data: MessageStatusesUpdateSchema, db: Session = Depends(get_db)):
+    """
+    Sets the statuses of many message nodes at once. A status only moves forward
+    (pending -> sent -> opened), the ids of rejected changes are returned.
+    """
+    return run_write(db, NodeService.update_statuses, statuses=data.statuses)
 
-@router.get("/{node_id}", tags=['nodes'])
-def read_node(node_id: int, db: Session = Depends(get_db)):
-    db_node = NodeService.get_node(db=db, node_id=node_id)
+@router.get("/{node_id}", tags=['nodes'], response_model=NodeSchema)
+def read_node(node_id: int, response: Response = None, if_none_match: Annotated[Optional[str], Header()] = None, db: Session = Depends(get_read_db)):
+    """
+    Returns the node with its ETag, or 304 without loading it if `If-None-Match` matches its current version.
+    """
+    version = None
+    if if_none_match is not None:
+        version = NodeService.get_version(db, node_id)
+        if version is not None and etag_matches(if_none_match, node_etag(node_id, version)):
+            return not_modified(node_etag(node_id, version))
+    db_node, version = NodeService.get_versioned_node(db, node_id, version)
     if db_node is None:
         raise HTTPException(status_code=404, detail="Node not found.")
+    if response is not None:
+        response.headers['ETag'] = node_etag(node_id, version)
     return db_node
 
-@router.delete("/delete/{node_id}", tags=['nodes'])
-def delete_node(node_id: int, db: Session = Depends(get_db)):
-    return NodeService.delete_node(db=db, node_id=node_id)
+@router.delete("/delete/{node_id}", tags=['nodes'], response_model=bool)
+def delete_node(node_id: int, if_match: Annotated[Optional[str], Header()] = None, db: Session = Depends(get_db)):
+    return run_write(db, NodeService.delete_node, node_id=node_id, if_match=if_match)
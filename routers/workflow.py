@@ -1,31 +1,252 @@
-from fastapi import APIRouter, Depends, HTTPException
+import itertools
+import json
+import tempfile
+import orjson
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, Query, Header
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from database import get_db
+from database import get_db, get_read_db
 from services.workflow import WorkflowServices
+from services.plan import plan_cache
+from services.cache import read_cache
+from services.results import ResultService
+from services.run_queue import run_queue
+from services.history import HistoryService, history_writer
+from services.write_queue import run_write, write_queue
+from services.importer import import_graph, IMPORT_SPOOL_SIZE
+from services.clone import CloneService
+from services.snapshot import SnapshotService, SnapshotReader, MEDIA_TYPE as SNAPSHOT_MEDIA_TYPE
+from services.etag import workflow_etag, etag_matches, not_modified
 from schemas.workflow import *
 
 router = APIRouter()
 
-@router.post('/create-workflow', tags=['workflows'])
+@router.post('/create-workflow', tags=['workflows'], response_model=WorkflowBaseSchema)
 def create_workflow(data: WorkflowCreateSchema = None, db: Session = Depends(get_db)):
-    return WorkflowServices.create_workflow(data, db)
+    return run_write(db, WorkflowServices.create_workflow, data=data)
 
-@router.get('/get/{id}', tags=['workflows'])
-def get_workflow(id: int = None, db: Session = Depends(get_db)):
-    workflow = WorkflowServices.get_workflow(db=db, workflow_id=id)
+def parse_ndjson_line(line: bytes, number: int):
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Error. Line {number} is not valid JSON.")
+
+def read_ndjson(file):
+    """
+    Yields parsed lines of a newline-delimited JSON file.
+    """
+    for number, line in enumerate(file, 1):
+        if line.strip():
+            yield parse_ndjson_line(line, number)
+
+async def spool_body(request: Request):
+    """
+    Returns the request body in a temporary file, kept in memory up to IMPORT_SPOOL_SIZE bytes.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE)
+    async for chunk in request.stream():
+        await run_in_threadpool(spool.write, chunk)
+    spool.seek(0)
+    return spool
+
+@router.post('/import-workflow', tags=['workflows'], response_model=WorkflowImportResultSchema)
+async def import_workflow(request: Request, db: Session = Depends(get_db)):
+    """
+    Imports a whole workflow graph from a newline-delimited JSON stream in a single transaction.
+    The first line is the workflow (`{"name": ...}`), every next line is a node with a client-side
+    temporary id in `ref` and edges (`next`, `yes`, `no`) referencing those ids.
+    """
+    # the body is received before the transaction starts, so a slow client never holds the write lock
+    with await spool_body(request) as spool:
+        lines = read_ndjson(spool)
+        header = await run_in_threadpool(next, lines, None)
+        if header is None:
+            raise HTTPException(status_code=400, detail="Error. Empty import.")
+        return await run_in_threadpool(run_write, db, import_graph, header=header, lines=lines)
+
+@router.get('/export-workflow/{workflow_id}', tags=['workflows'], response_class=StreamingResponse)
+def export_workflow(workflow_id: int, db: Session = Depends(get_read_db)):
+    """
+    Streams the workflow as a binary snapshot, see services/snapshot.py for the format.
+    """
+    snapshot = SnapshotService.export_snapshot(db, workflow_id)
+    headers = {'Content-Disposition': f'attachment; filename="workflow-{workflow_id}.wfsn"'}
+    return StreamingResponse(snapshot, media_type=SNAPSHOT_MEDIA_TYPE, headers=headers)
+
+@router.post('/import-snapshot', tags=['workflows'], response_model=WorkflowImportResultSchema)
+async def import_snapshot(request: Request, name: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    Imports a snapshot made by `/export-workflow/{workflow_id}` as a new workflow, named as the exported one
+    unless `name` is given. The body is received first, then decoded block by block while the nodes are bulk inserted
+    in a single transaction. `nodes` maps the exported node ids to the new ones.
+    """
+    # the body is received before the transaction starts, so a slow client never holds the write lock
+    with await spool_body(request) as spool:
+        reader = SnapshotReader()
+        lines = SnapshotService.read_import_lines(reader, spool)
+        first = await run_in_threadpool(next, lines, None)
+        if first is None:
+            raise HTTPException(status_code=400, detail="Error. The snapshot has no nodes.")
+        return await run_in_threadpool(run_write, db, import_graph, header={'name': name or reader.header[2]}, lines=itertools.chain([first], lines))
+
+@router.post('/run-snapshot', tags=['workflows'], response_model=RunResultSchema, response_model_exclude_none=True)
+async def run_snapshot(request: Request, status: List[str] = Query([]), edges: bool = True):
+    """
+    Runs the workflow of a snapshot without the database. Each `status=<message node id>:<status>`
+    replaces the status stored in the snapshot, to see which path the workflow would take.
+    """
+    statuses = {}
+    for item in status:
+        node_id, _, value = item.partition(':')
+        try:
+            statuses[int(node_id)] = MessageStatus(value).value
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Error. Invalid status {item!r}, expected <message node id>:<status>.")
+    return await run_in_threadpool(SnapshotService.run_snapshot, await request.body(), statuses, edges)
+
+@router.post('/clone-workflow/{workflow_id}', tags=['workflows'], response_model=WorkflowCloneResultSchema)
+def clone_workflow(workflow_id: int, data: WorkflowCloneSchema = None, db: Session = Depends(get_db)):
+    """
+    Copies the workflow with all its nodes `copies` times, edges between its nodes are remapped to the copies.
+    Node `n` of the template is copied as node `n + node_id_offset` of each copy.
+    """
+    return run_write(db, CloneService.clone_workflow, workflow_id=workflow_id, data=data or WorkflowCloneSchema())
+
+@router.get('/get/{id}', tags=['workflows'], response_model=WorkflowSchema)
+def get_workflow(id: int = None, response: Response = None, if_none_match: Annotated[Optional[str], Header()] = None, db: Session = Depends(get_read_db)):
+    """
+    Returns the workflow with its ETag. When `If-None-Match` is sent, the version is checked with one
+    primary key lookup and 304 is answered without loading the workflow if it hasn`t changed.
+    """
+    version = None
+    if if_none_match is not None:
+        version = WorkflowServices.get_version(db, id)
+        if version is not None and etag_matches(if_none_match, workflow_etag(id, version)):
+            return not_modified(workflow_etag(id, version))
+    workflow, version = WorkflowServices.get_versioned_workflow(db, id, version)
     if workflow:
+        if response is not None:
+            response.headers['ETag'] = workflow_etag(id, version)
         return workflow
     else:
         raise HTTPException(status_code=404, detail="Workflow not found.")
 
-@router.put('/update/{id}', tags=['workflows'])
-def update_workflow(workflow_id: int, data: WorkflowSchema, db: Session = Depends(get_db)):
-    return WorkflowServices.update_workflow(data=data, db=db, workflow_id=workflow_id)
+@router.put('/update/{id}', tags=['workflows'], response_model=WorkflowBaseSchema)
+def update_workflow(workflow_id: int, data: WorkflowSchema, response: Response = None, if_match: Annotated[Optional[str], Header()] = None, db: Session = Depends(get_db)):
+    """
+    Renames the workflow. With `If-Match` the change is refused with 412 if the workflow has been changed since.
+    """
+    workflow = run_write(db, WorkflowServices.update_workflow, data=data, workflow_id=workflow_id, if_match=if_match)
+    if response is not None:
+        response.headers['ETag'] = workflow_etag(workflow.id, workflow.version)
+    return workflow
+
+@router.delete('/delete/{id}', tags=['workflows'], response_model=bool)
+def delete_workflow(workflow_id: int, if_match: Annotated[Optional[str], Header()] = None, db: Session = Depends(get_db)):
+    return run_write(db, WorkflowServices.delete_workflow, workflow_id=workflow_id, if_match=if_match)
+
+def ndjson_stream(results):
+    for result in results:
+        yield json.dumps(result) + '\n'
+
+# declared before /run-sequence/{workflow_id}, which would match "batch" as well
+@router.post('/run-sequence/batch', tags=['workflows'], response_model=RunBatchResultSchema, response_model_exclude_none=True)
+def run_sequence_batch(data: RunBatchSchema, stream: bool = False, db: Session = Depends(get_read_db)):
+    """
+    Runs many workflows in one request. Every workflow gets its own result or error.
+    With `stream=true` results are sent as newline-delimited JSON while the batch is processed.
+    """
+    if stream:
+        return StreamingResponse(ndjson_stream(WorkflowServices.iter_run_batch(data.workflow_ids)), media_type='application/x-ndjson')
+    return {'results': WorkflowServices.run_batch(db=db, workflow_ids=data.workflow_ids)}
+
+def event_stream(events, format: RunStreamFormat) -> StreamingResponse:
+    """
+    Sends (event, data) pairs as newline-delimited JSON objects `{event: data}`, or as server-sent events.
+    """
+    if format == RunStreamFormat.sse:
+        body = (b'event: %s\ndata: %s\n\n' % (event.encode(), orjson.dumps(data)) for event, data in events)
+        return StreamingResponse(body, media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    return StreamingResponse((orjson.dumps({event: data}) + b'\n' for event, data in events), media_type='application/x-ndjson')
+
+@router.post('/run-sequence/{workflow_id}', tags=['workflows'], response_model=Union[RunResultSchema, AudienceRunResultSchema], response_model_exclude_none=True)
+def run_sequence(workflow_id: int, audience: bool = False, edges: bool = True, stream: Optional[RunStreamFormat] = None, db: Session = Depends(get_read_db)):
+    """
+    Runs the workflow. With `audience=true` it is run for every contact and the distinct
+    success paths are returned with the number of contacts following them.
+    With `edges=false` the edges of the workflow are left out of the result.
+
+    With `stream=ndjson` or `stream=sse` the success path is sent in chunks while the workflow is walked
+    (`path` events), followed by the edges (`edges` events) and an `end` event with the path length.
+    A walk failing on the way ends the stream with an `error` event.
+    """
+    if stream is not None:
+        if audience:
+            raise HTTPException(status_code=400, detail="Error. Audience runs can`t be streamed.")
+        return event_stream(WorkflowServices.stream_run(db=db, workflow_id=workflow_id, edges=edges), stream)
+    return WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow_id, audience=audience, edges=edges)
+
+@router.get('/run-sequence/{workflow_id}/result', tags=['workflows'], response_model=RunResultSchema)
+def run_sequence_result(workflow_id: int, db: Session = Depends(get_read_db), write_db: Session = Depends(get_db)):
+    """
+    Returns the last result of the workflow. It is kept up to date when message statuses change,
+    the workflow is run only if it has no result for its current structure.
+    """
+    # the stored result is read without the writer connection, which is used only to store a missing one
+    result = ResultService.get_stored_result(db=db, workflow_id=workflow_id)
+    if result is not None:
+        return result
+    return run_write(write_db, ResultService.get_result, workflow_id=workflow_id)
+
+@router.post('/run-sequence/{workflow_id}/submit', tags=['workflows'], response_model=RunJobSchema, status_code=202)
+async def submit_run_sequence(workflow_id: int, audience: bool = False, wait: float = Query(0, ge=0, le=60), db: Session = Depends(get_db)):
+    """
+    Queues a run of the workflow and returns the job to poll at `/run-jobs/{job_id}`.
+    With `wait` the response is delayed up to that many seconds until the run is finished.
+    Answers 429 when the run queue is full.
+    """
+    job = await run_in_threadpool(run_queue.submit, db, workflow_id, audience)
+    if wait:
+        return await run_queue.wait(job['id'], wait)
+    return job
+
+# declared before /run-jobs/{job_id}, which would match "stats" as well
+@router.get('/run-jobs/stats', tags=['workflows'], response_model=RunQueueStatsSchema)
+def run_queue_stats():
+    return run_queue.stats()
+
+@router.get('/run-jobs/{job_id}', tags=['workflows'], response_model=RunJobSchema)
+async def get_run_job(job_id: str, wait: float = Query(0, ge=0, le=60)):
+    """
+    Returns the state of a queued run, with its result once it is done. Results expire `RUN_RESULT_TTL`
+    seconds after the run. With `wait` the response is delayed up to that many seconds until the run is finished.
+    """
+    return await run_queue.wait(job_id, wait)
+
+@router.get('/run-history', tags=['workflows'], response_model=RunHistoryPageSchema)
+def run_history(workflow_id: Optional[int] = None, before: Optional[int] = None, limit: int = Query(100, ge=1, le=1000), db: Session = Depends(get_read_db)):
+    """
+    Lists recorded runs, newest first. Pass the `next_before` of a page as `before` to read the next one.
+    Runs are recorded in the background, a run shows up here within `HISTORY_FLUSH_MS`.
+    """
+    return HistoryService.list_runs(db=db, workflow_id=workflow_id, before=before, limit=limit)
+
+@router.get('/run-history/stats', tags=['workflows'], response_model=HistoryWriterStatsSchema)
+def run_history_stats():
+    return history_writer.stats()
+
+@router.get('/plan-cache/stats', tags=['workflows'], response_model=PlanCacheStatsSchema)
+def plan_cache_stats():
+    return plan_cache.stats()
 
-@router.delete('/delete/{id}', tags=['workflows'])
-def delete_workflow(workflow_id: int, db: Session = Depends(get_db)):
-    return WorkflowServices.delete_workflow(db=db, workflow_id=workflow_id)
+@router.get('/read-cache/stats', tags=['workflows'], response_model=ReadCacheStatsSchema)
+def read_cache_stats():
+    return read_cache.stats()
 
-@router.post('/run-sequence/{workflow_id}', tags=['workflows'])
-def run_sequence(workflow_id: int, db: Session = Depends(get_db)):
-    return WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow_id)
+@router.get('/write-queue/stats', tags=['workflows'], response_model=WriteQueueStatsSchema)
+def write_queue_stats():
+    if write_queue is None:
+        return {'enabled': False}
+    return {'enabled': True, **write_queue.stats()}
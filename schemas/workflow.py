@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import Dict, Any, List
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Dict, Any, List, Optional, Tuple, Union
 from enum import Enum
 
 
@@ -16,6 +16,18 @@ class MessageStatus(str, Enum):
     sent = "sent"
     opened = "opened"
 
+# Run job status schema
+class RunJobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+# Streamed run format
+class RunStreamFormat(str, Enum):
+    ndjson = "ndjson"
+    sse = "sse"
+
 # Create Node schema
 class CreateNodeSchema(BaseModel):
     data: Dict[str, Any] = Field(default={})
@@ -24,8 +36,7 @@ class CreateNodeSchema(BaseModel):
 class NodeBaseSchema(BaseModel):
     workflow_id: int
 
-    class ConfigDict:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 """ Specific nodes classes schemas """
 
@@ -45,6 +56,41 @@ class ConditionNodeSchema(NodeBaseSchema):
 class EndNodeSchema(NodeBaseSchema):
     pass
 
+# new status of a message node, reported by a delivery webhook
+class MessageStatusUpdateSchema(BaseModel):
+    node_id: int
+    status: MessageStatus
+
+class MessageStatusesUpdateSchema(BaseModel):
+    statuses: List[MessageStatusUpdateSchema] = Field(max_length=100_000)
+
+class MessageStatusesUpdateResultSchema(BaseModel):
+    updated: int
+    # not existing message nodes and transitions to an earlier status
+    rejected: List[int]
+
+# node returned by GET /node/{node_id}. Plain dicts are matched in order, so schemas
+# with more required fields go first
+NodeSchema = Union[MessageNodeSchema, ConditionNodeSchema, StartNodeSchema, EndNodeSchema]
+
+""" Created and updated nodes """
+
+class NodeDetailSchema(NodeBaseSchema):
+    id: int
+    node_type: NodeType
+
+class StartNodeDetailSchema(NodeDetailSchema, StartNodeSchema):
+    pass
+
+class MessageNodeDetailSchema(NodeDetailSchema, MessageNodeSchema):
+    pass
+
+class ConditionNodeDetailSchema(NodeDetailSchema, ConditionNodeSchema):
+    message_node_id: Optional[int] = None
+
+class EndNodeDetailSchema(NodeDetailSchema, EndNodeSchema):
+    pass
+
 """ Workflow schemas """
 # nodes list for workflow class 
 class WorkflowNodeDetailSchema(BaseModel):
@@ -52,19 +98,197 @@ class WorkflowNodeDetailSchema(BaseModel):
     node_type: NodeType
     workflow_id: int
 
-    class ConfigDict:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # create workflow object schema
 class WorkflowCreateSchema(BaseModel):
     name: str
 
+# created or updated workflow, without nodes
+class WorkflowBaseSchema(BaseModel):
+    id: int
+    name: str
+
+    model_config = ConfigDict(from_attributes=True)
+
 # detalied workflow schema
 class WorkflowSchema(BaseModel):
     id: int
     name: str
     nodes: List[WorkflowNodeDetailSchema]
 
-    class ConfigDict:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
+
+""" Import schemas """
+# first line of an import stream
+class WorkflowImportSchema(BaseModel):
+    name: str
+
+# node line of an import stream, edges reference client-side temporary ids
+class NodeImportSchema(BaseModel):
+    ref: Union[int, str]
+    node_type: NodeType
+    message_text: Optional[str] = None
+    status: Optional[MessageStatus] = None
+    condition: Optional[str] = None
+    next: Optional[Union[int, str]] = None
+    yes: Optional[Union[int, str]] = None
+    no: Optional[Union[int, str]] = None
+
+# imported workflow with temporary ids mapped to real ids
+class WorkflowImportResultSchema(BaseModel):
+    id: int
+    name: str
+    nodes: Dict[str, int]
+
+""" Clone schemas """
+class WorkflowCloneSchema(BaseModel):
+    name: Optional[str] = None  # name of the template by default, numbered when several copies are made
+    copies: int = Field(1, ge=1)
+
+# node `n` of the template is copied as node `n + node_id_offset`
+class WorkflowCopySchema(BaseModel):
+    id: int
+    name: str
+    node_id_offset: int
+
+class WorkflowCloneResultSchema(BaseModel):
+    workflows: List[WorkflowCopySchema]
+    nodes: int  # nodes per copy
+
+""" Run schemas """
+# edges are None when the run is requested without them
+class RunResultSchema(BaseModel):
+    success_path: List[int]
+    edges: Optional[List[Tuple[int, int]]] = None
+
+# success path followed by a part of the audience
+class AudiencePathSchema(BaseModel):
+    success_path: List[int]
+    contacts: int
+
+class AudienceRunResultSchema(BaseModel):
+    contacts: int
+    paths: List[AudiencePathSchema]
+    edges: Optional[List[Tuple[int, int]]] = None
+
+# workflows to run in one batch
+class RunBatchSchema(BaseModel):
+    workflow_ids: List[int]
+
+# result or error of one workflow of a batch
+class RunBatchItemSchema(BaseModel):
+    workflow_id: int
+    success_path: Optional[List[int]] = None
+    edges: Optional[List[Tuple[int, int]]] = None
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+
+class RunBatchResultSchema(BaseModel):
+    results: List[RunBatchItemSchema]
+
+# run submitted to the run queue, `result` is set once it is done
+class RunJobSchema(BaseModel):
+    id: str
+    workflow_id: int
+    audience: bool
+    status: RunJobStatus
+    result: Optional[Union[RunResultSchema, AudienceRunResultSchema]] = None
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+    created_at: float
+    finished_at: Optional[float] = None
+
+# counters of the run queue of the worker process
+class RunQueueStatsSchema(BaseModel):
+    executor: str
+    workers: int
+    max_size: int
+    pending: int
+    submitted: int
+    rejected: int
+    completed: int
+
+# recorded run of a workflow
+class RunHistorySchema(BaseModel):
+    id: int
+    workflow_id: int
+    version: Optional[int] = None
+    success_path: Optional[List[int]] = None
+    conditions: Optional[List[Tuple[int, bool]]] = None
+    duration_ms: float
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+    created_at: float
+
+# page of the history, newest runs first; `next_before` is the cursor of the next page
+class RunHistoryPageSchema(BaseModel):
+    items: List[RunHistorySchema]
+    next_before: Optional[int] = None
+
+class HistoryWriterStatsSchema(BaseModel):
+    enabled: bool
+    buffered: int
+    written: int
+    dropped: int
+    batches: int
+    failed_batches: int
+    deleted: int
+
+class PlanCacheStatsSchema(BaseModel):
+    size: int
+    maxsize: int
+    hits: int
+    misses: int
+
+# read-through cache of node and workflow details of the worker process
+class ReadCacheStatsSchema(BaseModel):
+    enabled: bool
+    size: int
+    maxsize: int
+    ttl: float
+    hits: int
+    misses: int
+    hit_ratio: float
+    evictions: int
+    expirations: int
+    invalidations: int
+    syncs: int
+    version: Optional[int] = None
+
+# group commit queue, all counters are zero when the write-behind mode is disabled
+class WriteQueueStatsSchema(BaseModel):
+    enabled: bool
+    queue_depth: int = 0
+    batches: int = 0
+    operations: int = 0
+    failed_commits: int = 0
+    last_batch_size: int = 0
+    max_batch_size: int = 0
+    avg_batch_size: float = 0
+    avg_commit_ms: float = 0
+    max_commit_ms: float = 0
+
+# health checks of the worker process
+class LivenessSchema(BaseModel):
+    status: str
+    pid: int
+    uptime: float
+
+class ReadinessSchema(BaseModel):
+    status: str
+    pid: int
+    startup_seconds: Optional[float] = None
+
+""" Audience schemas """
+# recipient with its own statuses of message nodes
+class ContactSchema(BaseModel):
+    external_id: str
+    statuses: Dict[int, MessageStatus] = Field(default={})
+
+class ContactsImportSchema(BaseModel):
+    contacts: List[ContactSchema]
 
+class ContactsImportResultSchema(BaseModel):
+    contacts: int
+    statuses: int
@@ -0,0 +1,71 @@
+"""
+Production launcher. Migrates the database once, imports the application to fail before any worker
+is started, then serves it with uvicorn:
+
+    python serve.py --workers 4 --loop uvloop --http httptools
+
+Options default to the SERVER_* settings and WEB_CONCURRENCY. SIGTERM or Ctrl+C stops the workers
+gracefully: they stop accepting connections, finish the running requests within --graceful-timeout
+seconds and close the queues and the database pools.
+"""
+import argparse
+import logging
+import logging.config
+import os
+import time
+import uvicorn
+from uvicorn.config import LOGGING_CONFIG
+from config import settings
+
+logger = logging.getLogger('uvicorn.error')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=settings.server_host)
+    parser.add_argument('--port', type=int, default=settings.server_port)
+    parser.add_argument('--workers', type=int, default=settings.server_workers)
+    parser.add_argument('--loop', choices=['auto', 'asyncio', 'uvloop'], default=settings.server_loop)
+    parser.add_argument('--http', choices=['auto', 'h11', 'httptools'], default=settings.server_http)
+    parser.add_argument('--graceful-timeout', type=float, default=settings.graceful_timeout)
+    parser.add_argument('--log-level', default='info')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.config.dictConfig(LOGGING_CONFIG)
+    logger.setLevel(args.log_level.upper())
+
+    # workers measure their startup from here
+    os.environ['LAUNCH_STARTED'] = str(time.time())
+    started = time.perf_counter()
+
+    from database import engine
+    from migrations import migrate
+    migrate(engine)
+    # the workers import the application without migrating again
+    os.environ['MIGRATE_ON_STARTUP'] = 'false'
+    settings.migrate_on_startup = False
+    migrated = time.perf_counter()
+
+    import main as application
+    engine.dispose()
+    logger.info("Migrated in %.0f ms, application imported in %.0f ms", (migrated - started) * 1000, (time.perf_counter() - migrated) * 1000)
+
+    # one worker serves the imported application, more workers are spawned processes which import it again
+    app = application.app if args.workers == 1 else 'main:app'
+    uvicorn.run(
+        app,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=args.loop,
+        http=args.http,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        log_level=args.log_level,
+    )
+
+
+if __name__ == '__main__':
+    main()
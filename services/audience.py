@@ -0,0 +1,110 @@
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from models.workflow import Contact, ContactStatus, MessageNode
+from schemas.workflow import ContactSchema
+from services.plan import PlanService
+from config import settings
+
+AUDIENCE_CHUNK_SIZE = settings.audience_chunk_size
+
+
+def iter_audience(db: Session, message_ids: list, defaults: dict, chunk_size: int = AUDIENCE_CHUNK_SIZE):
+    """
+    Streams contacts in chunks ordered by id (keyset pagination), so memory is bounded by the chunk size.
+
+    Yields:
+        tuple: contact ids of the chunk and message node id -> list of their statuses, one per contact.
+            Contacts without a status row get the status stored on the message node.
+    """
+    last_id = 0
+    while True:
+        contact_ids = db.scalars(select(Contact.id).where(Contact.id > last_id).order_by(Contact.id).limit(chunk_size)).all()
+        if not contact_ids:
+            return
+
+        columns = {message_id: [defaults.get(message_id)] * len(contact_ids) for message_id in message_ids}
+        if message_ids:
+            positions = {contact_id: i for i, contact_id in enumerate(contact_ids)}
+            # every contact in the id range belongs to the chunk, the range is read from the primary key
+            rows = db.execute(
+                select(ContactStatus.contact_id, ContactStatus.message_node_id, ContactStatus.status)
+                .where(ContactStatus.contact_id.between(contact_ids[0], contact_ids[-1]), ContactStatus.message_node_id.in_(message_ids))
+            )
+            for contact_id, message_id, status in rows:
+                columns[message_id][positions[contact_id]] = status
+
+        yield contact_ids, columns
+        last_id = contact_ids[-1]
+
+
+class AudienceService:
+    """
+    Manages contacts with their own message statuses and runs workflows for all of them at once.
+    """
+
+    def upsert_contacts(db: Session, contacts: list) -> dict:
+        """
+        Creates missing contacts and sets their message statuses in one transaction.
+
+        Args:
+            db (Session): The SQLAlchemy database session.
+            contacts (list): ContactSchema items, contacts are matched by external_id.
+
+        Returns:
+            dict: Number of upserted contacts and statuses.
+        """
+        message_ids = {message_id for contact in contacts for message_id in contact.statuses}
+        if message_ids:
+            existing_ids = set(db.scalars(select(MessageNode.id).where(MessageNode.id.in_(message_ids))))
+            missing_ids = sorted(message_ids - existing_ids)
+            if missing_ids:
+                raise HTTPException(status_code=400, detail=f"Error. Message nodes {missing_ids} are not exists.")
+
+        statuses_count = 0
+        for i in range(0, len(contacts), settings.import_chunk_size):
+            chunk = contacts[i:i + settings.import_chunk_size]
+            external_ids = [contact.external_id for contact in chunk]
+            db.execute(insert(Contact).on_conflict_do_nothing(index_elements=[Contact.external_id]), [{'external_id': external_id} for external_id in external_ids])
+            ids = dict(db.execute(select(Contact.external_id, Contact.id).where(Contact.external_id.in_(external_ids))).all())
+
+            rows = [
+                {'contact_id': ids[contact.external_id], 'message_node_id': message_id, 'status': status.value}
+                for contact in chunk for message_id, status in contact.statuses.items()
+            ]
+            if rows:
+                statement = insert(ContactStatus)
+                db.execute(statement.on_conflict_do_update(index_elements=[ContactStatus.contact_id, ContactStatus.message_node_id], set_={'status': statement.excluded.status}), rows)
+                statuses_count += len(rows)
+
+        db.commit()
+        return {'contacts': len(contacts), 'statuses': statuses_count}
+
+    def run_workflow(db: Session, workflow_id: int, chunk_size: int = AUDIENCE_CHUNK_SIZE) -> dict:
+        """
+        Runs the workflow for every contact. Contacts are routed through the compiled plan chunk by chunk,
+        conditions are evaluated once per distinct status, not once per contact.
+
+        Returns:
+            dict: Number of contacts, the distinct success paths with the number of contacts following
+                each of them (most followed first) and the edges of the workflow.
+        """
+        plan = PlanService.get_plan(db, workflow_id)
+        statement = plan.statuses_statement()
+        defaults = dict(db.execute(statement).all()) if statement is not None else {}
+
+        counts = {}
+        total = 0
+        for contact_ids, columns in iter_audience(db, plan.message_ids, defaults, chunk_size):
+            total += len(contact_ids)
+            for path, members in plan.route(columns, len(contact_ids)):
+                path = tuple(path)
+                counts[path] = counts.get(path, 0) + len(members)
+
+        paths = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+        return {
+            'contacts': total,
+            'paths': [{'success_path': list(path), 'contacts': count} for path, count in paths],
+            'edges': list(plan.edges)
+        }
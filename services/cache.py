@@ -0,0 +1,219 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import select, func, delete, event
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from models.workflow import CacheVersion, Workflow, Node
+from config import settings
+
+
+def node_key(node_id: int) -> str:
+    return f'node:{node_id}'
+
+
+def workflow_key(workflow_id: int) -> str:
+    return f'workflow:{workflow_id}'
+
+
+def deleted_keys(db: Session) -> list:
+    """
+    Returns the keys of the workflows and nodes deleted in the session, including the cascaded deletes.
+    """
+    keys = []
+    for item in db.deleted:
+        if isinstance(item, Node):
+            keys.append(node_key(item.id))
+        elif isinstance(item, Workflow):
+            keys.append(workflow_key(item.id))
+    return keys
+
+
+class ReadCache:
+    """
+    In-process read-through cache of node and workflow details, with LRU eviction above `maxsize`
+    entries and expiration `ttl` seconds after an entry was loaded.
+
+    Writers invalidate the keys they change: the entries of this process are dropped at once and again
+    after the commit, since a reader may cache the old row until then, and the keys are stamped with
+    a new version in the cache_versions table, in the transaction of the change. Every process reads
+    the versions above the last one it has seen, at most once per `sync_interval`, and drops those keys,
+    so changes made by other workers are seen within that interval.
+
+    Versions older than `ttl` + `sync_interval` are pruned: an entry loaded before such a change has
+    expired in every process. The newest version is always kept, versions keep increasing.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60, sync_interval: float = 1):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self.enabled = maxsize > 0
+
+        self._entries = OrderedDict()  # key -> (value, expires at)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._version = None  # last version read from cache_versions
+        self._last_sync = 0
+        self._last_prune = time.monotonic()
+        # counts the local invalidations, a load overlapping one of them is not cached
+        self.epoch = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.syncs = 0
+
+    def get(self, key: str, fresh=None):
+        """
+        Returns the cached value, None on a miss. A value rejected by the `fresh` predicate is dropped.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            elif entry is not None and fresh is not None and not fresh(entry[0]):
+                del self._entries[key]
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, value, epoch: int):
+        """
+        Caches a value loaded after `epoch` was read. Ignored if an invalidation happened meanwhile,
+        the value may have been loaded before the change.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if epoch != self.epoch:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def load(self, db: Session, key: str, loader, fresh=None):
+        """
+        Returns the cached value of the key, or the value returned by `loader()`, cached unless it is falsy.
+        """
+        self.sync(db)
+        value = self.get(key, fresh)
+        if value is None:
+            epoch = self.epoch
+            value = loader()
+            if value:
+                self.put(key, value, epoch)
+        return value
+
+    def drop(self, keys):
+        with self._lock:
+            self.epoch += 1
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def invalidate(self, db: Session, *keys: str):
+        """
+        Drops the keys in this process and stamps them in cache_versions for the other processes.
+        Called before the commit of the change, the keys are dropped again once the session commits.
+        """
+        if not self.enabled or not keys:
+            return
+        self.drop(keys)
+        db.info.setdefault('cache_keys', set()).update(keys)
+        versions = CacheVersion.__table__
+        next_version = select(func.coalesce(func.max(versions.c.version), 0) + 1).scalar_subquery()
+        statement = insert(versions).values(version=next_version, changed_at=time.time())
+        statement = statement.on_conflict_do_update(index_elements=[versions.c.key], set_={'version': statement.excluded.version, 'changed_at': statement.excluded.changed_at})
+        db.execute(statement, [{'key': key} for key in dict.fromkeys(keys)])
+        if time.monotonic() - self._last_prune >= self.ttl:
+            self.prune(db)
+
+    def prune(self, db: Session):
+        """
+        Deletes the versions changed more than `ttl` + `sync_interval` seconds ago, except the newest one.
+        """
+        self._last_prune = time.monotonic()
+        versions = CacheVersion.__table__
+        newest = select(func.max(versions.c.version)).scalar_subquery()
+        db.execute(delete(versions).where(versions.c.changed_at < time.time() - self.ttl - self.sync_interval, versions.c.version < newest))
+
+    def sync_due(self) -> bool:
+        return self.enabled and time.monotonic() - self._last_sync >= self.sync_interval
+
+    def sync(self, db: Session):
+        """
+        Drops the keys changed by any process since the last sync, if the sync interval has passed.
+        """
+        if not self.sync_due() or not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            versions = CacheVersion.__table__
+            if self._version is None:
+                # nothing is cached before the first sync
+                self._version = db.scalar(select(func.coalesce(func.max(versions.c.version), 0)))
+            else:
+                changes = db.execute(select(versions.c.key, versions.c.version).where(versions.c.version > self._version)).all()
+                if changes:
+                    self.drop(key for key, _ in changes)
+                    self._version = max(version for _, version in changes)
+            self._last_sync = time.monotonic()
+            self.syncs += 1
+        finally:
+            self._sync_lock.release()
+
+    def clear(self):
+        with self._lock:
+            self.epoch += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'syncs': self.syncs,
+                'version': self._version,
+            }
+
+
+read_cache = ReadCache(settings.read_cache_size, settings.read_cache_ttl, settings.read_cache_sync_ms / 1000)
+
+
+@event.listens_for(Session, 'after_commit')
+def drop_committed(db: Session):
+    # also called when a savepoint is released, the keys wait for the real commit
+    if db.in_nested_transaction():
+        return
+    keys = db.info.pop('cache_keys', None)
+    if keys:
+        read_cache.drop(keys)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_rolled_back(db: Session, previous_transaction):
+    # a rolled back savepoint of the group commit keeps the keys of the other operations
+    if previous_transaction.parent is None:
+        db.info.pop('cache_keys', None)
@@ -0,0 +1,108 @@
+from fastapi import HTTPException
+from sqlalchemy import select, insert, func, literal, cast, case, table, column, String, Integer
+from sqlalchemy.orm import Session
+from models.workflow import Workflow, Node, StartNode, MessageNode, ConditionNode, EndNode
+from config import settings
+
+CLONE_MAX_COPIES = settings.clone_max_copies
+
+NODE_TABLES = [model.__table__ for model in (StartNode, MessageNode, ConditionNode, EndNode)]
+
+# largest id ever given by the AUTOINCREMENT tables, deleted rows included
+sqlite_sequence = table('sqlite_sequence', column('name'), column('seq'))
+
+
+def last_id(id_column):
+    """
+    Returns the expression of the largest id given in the table of `id_column`, ids of deleted rows are never reused.
+    """
+    given = select(sqlite_sequence.c.seq).where(sqlite_sequence.c.name == id_column.table.name).scalar_subquery()
+    current = select(func.max(id_column)).scalar_subquery()
+    return func.max(func.coalesce(given, 0), func.coalesce(current, 0))
+
+
+class CloneService:
+    """
+    Copies a workflow with all its nodes in a few INSERT ... SELECT statements, one per table,
+    whatever the number of nodes and copies. Nothing is loaded into Python.
+
+    The nodes of copy `k` get the ids of the template nodes shifted by the offset of the copy, so every
+    edge between two template nodes is remapped with an addition. Edges to nodes of other workflows
+    are kept as they are.
+    """
+
+    def clone_workflow(db: Session, workflow_id: int, data) -> dict:
+        """
+        Args:
+            db (Session): The SQLAlchemy database session.
+            workflow_id (int): Id of the template workflow.
+            data (WorkflowCloneSchema): Name and number of the copies.
+
+        Returns:
+            dict: The copies with their id, name and node id offset, and the number of nodes of each.
+
+        Raises:
+            HTTPException: If the template workflow doesn`t exist or too many copies are requested.
+        """
+        if data.copies > CLONE_MAX_COPIES:
+            raise HTTPException(status_code=400, detail=f"Error. At most {CLONE_MAX_COPIES} copies can be made at once.")
+        template = db.execute(select(Workflow.name).where(Workflow.id == workflow_id)).first()
+        if template is None:
+            raise HTTPException(status_code=404, detail="Workflow not found.")
+
+        copies = select(literal(0, Integer).label('k')).cte('copies', recursive=True)
+        copies = copies.union_all(select(copies.c.k + 1).where(copies.c.k + 1 < data.copies))
+
+        # ids are taken above the largest one ever given, in the statement itself. Inserting takes the write lock
+        # of the transaction, so the node ids read below can`t be taken by another writer
+        workflows = Workflow.__table__
+        name = data.name if data.name is not None else template.name
+        # copies are numbered from 1 when more than one is made
+        copy_name = literal(name) if data.copies == 1 else literal(name) + ' ' + cast(copies.c.k + 1, String)
+        first_id = select(last_id(workflows.c.id)).scalar_subquery() + 1
+        statement = insert(workflows).from_select(['id', 'name', 'version'], select(first_id + copies.c.k, copy_name, literal(1)))
+        workflow_ids = sorted(db.scalars(statement.returning(workflows.c.id)))
+
+        nodes = Node.__table__
+        count, min_id, max_id = db.execute(select(func.count(), func.min(nodes.c.id), func.max(nodes.c.id)).where(nodes.c.workflow_id == workflow_id)).one()
+        offset = span = 0
+        if count:
+            offset = db.scalar(select(last_id(nodes.c.id))) + 1 - min_id
+            span = max_id - min_id + 1
+            CloneService.copy_nodes(db, workflow_id, copies, workflow_ids[0], offset, span)
+
+        db.commit()
+        return {
+            'workflows': [
+                {'id': new_id, 'name': name if data.copies == 1 else f'{name} {k + 1}', 'node_id_offset': offset + k * span}
+                for k, new_id in enumerate(workflow_ids)
+            ],
+            'nodes': count,
+        }
+
+    def copy_nodes(db: Session, workflow_id: int, copies, first_workflow_id: int, offset: int, span: int):
+        """
+        Copies the rows of the template nodes into the nodes table and the table of every node type.
+        """
+        nodes = Node.__table__
+        template_ids = select(nodes.c.id).where(nodes.c.workflow_id == workflow_id)
+        shift = offset + copies.c.k * span
+
+        def copied(table, column):
+            if column.name == 'id':
+                return column + shift
+            if table is nodes and column.name == 'workflow_id':
+                return first_workflow_id + copies.c.k
+            if table is nodes and column.name == 'version':
+                return literal(1)
+            if any(key.column is nodes.c.id for key in column.foreign_keys):
+                return case((column.in_(template_ids), column + shift), else_=column)
+            return column
+
+        for table in [nodes, *NODE_TABLES]:
+            columns = list(table.columns)
+            rows = select(*[copied(table, column) for column in columns]).select_from(table)
+            if table is not nodes:
+                rows = rows.join(nodes, nodes.c.id == table.c.id)
+            rows = rows.join(copies, literal(True)).where(nodes.c.workflow_id == workflow_id)
+            db.execute(insert(table).from_select([column.name for column in columns], rows))
@@ -0,0 +1,40 @@
+from fastapi import HTTPException, Response
+
+
+# ids are never reused (AUTOINCREMENT) and versions only grow, so a tag names one state of one resource
+def workflow_etag(workflow_id: int, version: int) -> str:
+    return f'"w{workflow_id}-{version}"'
+
+
+def node_etag(node_id: int, version: int) -> str:
+    return f'"n{node_id}-{version}"'
+
+
+def etag_matches(header: str, etag: str, weak: bool = True) -> bool:
+    """
+    Tells if an If-None-Match (weak comparison) or If-Match (strong comparison) header matches the ETag.
+    """
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def check_if_match(header: str, etag: str):
+    """
+    Raises:
+        HTTPException: 412 if an If-Match header is given and doesn`t match the current ETag.
+    """
+    if header is not None and not etag_matches(header, etag, weak=False):
+        raise HTTPException(status_code=412, detail="Precondition failed. The resource has been changed.", headers={'ETag': etag})
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={'ETag': etag})
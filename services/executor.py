@@ -0,0 +1,207 @@
+from array import array
+
+# node kinds of the compact graph
+START, MESSAGE, CONDITION, END = range(4)
+KINDS = {'start': START, 'message': MESSAGE, 'condition': CONDITION, 'end': END}
+
+# index of a missing edge target
+NO_NODE = -1
+
+
+class WalkError(ValueError):
+    def __init__(self, node_id: int, message: str):
+        super().__init__(message)
+        self.node_id = node_id
+
+
+class CycleError(WalkError):
+    def __init__(self, node_id: int):
+        super().__init__(node_id, f"Error. Sequence has a cycle at node {node_id}.")
+
+
+class DeadEndError(WalkError):
+    def __init__(self, node_id: int):
+        super().__init__(node_id, f"Error. Sequence has a dead end at node {node_id}.")
+
+
+class CompactGraph:
+    """
+    Workflow graph stored in flat integer arrays indexed by node position.
+    Start and message nodes keep their edge in `next`, condition nodes in `yes` and `no`.
+    """
+    __slots__ = ('ids', 'index', 'kinds', 'next', 'yes', 'no')
+
+    def __init__(self, nodes):
+        """
+        Args:
+            nodes: iterable of (id, kind, next_id, yes_id, no_id) tuples. Edges to ids missing
+                from `nodes` are stored as NO_NODE.
+        """
+        nodes = list(nodes)
+        self.ids = array('q', (node[0] for node in nodes))
+        self.index = {node_id: i for i, node_id in enumerate(self.ids)}
+        self.kinds = array('b', (node[1] for node in nodes))
+
+        get = self.index.get
+        self.next = array('q', (get(node[2], NO_NODE) for node in nodes))
+        self.yes = array('q', (get(node[3], NO_NODE) for node in nodes))
+        self.no = array('q', (get(node[4], NO_NODE) for node in nodes))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def successors(self, i: int):
+        if self.kinds[i] == CONDITION:
+            return (self.yes[i], self.no[i])
+        return (self.next[i],)
+
+    def reachable(self, source: int, target: int) -> bool:
+        """
+        Checks whether `target` can be reached from `source` following both branches of conditions.
+        """
+        seen = bytearray(len(self.ids))
+        seen[source] = 1
+        stack = [source]
+        while stack:
+            i = stack.pop()
+            if i == target:
+                return True
+            for j in self.successors(i):
+                if j != NO_NODE and not seen[j]:
+                    seen[j] = 1
+                    stack.append(j)
+        return False
+
+
+def walk(graph: CompactGraph, start: int, branch, prefix: list = ()) -> list:
+    """
+    Follows the edges from the start node until the end node.
+    O(path length) time, one byte of memory per node.
+
+    Args:
+        graph (CompactGraph): The graph to walk.
+        start (int): Index of the start node.
+        branch: Callable receiving the index of a condition node and returning its result.
+        prefix (list, optional): IDs of the nodes already walked before `start`, to continue a walk.
+
+    Returns:
+        list: IDs of the nodes on the path.
+
+    Raises:
+        CycleError: If the walk returns to an already visited node.
+        DeadEndError: If the walk reaches a node with no further edge.
+    """
+    ids, kinds, next_, yes, no = graph.ids, graph.kinds, graph.next, graph.yes, graph.no
+    visited = bytearray(len(ids))
+    path = list(prefix)
+    for node_id in path:
+        visited[graph.index[node_id]] = 1
+
+    i = start
+    while True:
+        if visited[i]:
+            raise CycleError(ids[i])
+        visited[i] = 1
+        path.append(ids[i])
+
+        kind = kinds[i]
+        if kind == END:
+            return path
+        elif kind == CONDITION:
+            j = yes[i] if branch(i) else no[i]
+        else:
+            j = next_[i]
+
+        if j == NO_NODE:
+            raise DeadEndError(ids[i])
+        i = j
+
+
+def iter_walk(graph: CompactGraph, start: int, branch):
+    """
+    Same walk as `walk`, yielding the node IDs one by one as they are reached, so the beginning
+    of a long path can be used before the walk is over.
+
+    Raises:
+        CycleError: If the walk returns to an already visited node.
+        DeadEndError: If the walk reaches a node with no further edge.
+    """
+    ids, kinds, next_, yes, no = graph.ids, graph.kinds, graph.next, graph.yes, graph.no
+    visited = bytearray(len(ids))
+
+    i = start
+    while True:
+        if visited[i]:
+            raise CycleError(ids[i])
+        visited[i] = 1
+        yield ids[i]
+
+        kind = kinds[i]
+        if kind == END:
+            return
+        elif kind == CONDITION:
+            j = yes[i] if branch(i) else no[i]
+        else:
+            j = next_[i]
+
+        if j == NO_NODE:
+            raise DeadEndError(ids[i])
+        i = j
+
+
+def partition_walk(graph: CompactGraph, start: int, members, split) -> list:
+    """
+    Routes a whole group of members through the graph at once instead of walking it once per member.
+    The group follows the edges together and is split in two at every condition node whose
+    result differs between its members.
+
+    Args:
+        graph (CompactGraph): The graph to walk.
+        start (int): Index of the start node.
+        members: Sized collection of members entering the start node.
+        split: Callable receiving the index of a condition node and the members reaching it,
+            and returning the (yes, no) partition of them.
+
+    Returns:
+        list: (path, members) pairs, where path is the list of node IDs followed by the partition.
+
+    Raises:
+        CycleError: If a partition returns to a node already visited by it.
+        DeadEndError: If a partition reaches a node with no further edge.
+    """
+    ids, kinds, next_, yes, no = graph.ids, graph.kinds, graph.next, graph.yes, graph.no
+    results = []
+    if not len(members):
+        return results
+
+    stack = [(start, members, [], set())]
+    while stack:
+        i, members, path, visited = stack.pop()
+        while True:
+            if i in visited:
+                raise CycleError(ids[i])
+            visited.add(i)
+            path.append(ids[i])
+
+            kind = kinds[i]
+            if kind == END:
+                results.append((path, members))
+                break
+            elif kind == CONDITION:
+                yes_members, no_members = split(i, members)
+                if yes_members and no_members:
+                    if no[i] == NO_NODE:
+                        raise DeadEndError(ids[i])
+                    stack.append((no[i], no_members, list(path), set(visited)))
+                    members, j = yes_members, yes[i]
+                elif yes_members:
+                    j = yes[i]
+                else:
+                    j = no[i]
+            else:
+                j = next_[i]
+
+            if j == NO_NODE:
+                raise DeadEndError(ids[i])
+            i = j
+    return results
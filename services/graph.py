@@ -0,0 +1,145 @@
+from sqlalchemy import select, update, func, or_
+from sqlalchemy.orm import Session, selectinload
+from models.workflow import Workflow, Node, StartNode, EndNode, MessageNode, ConditionNode
+from schemas.workflow import WorkflowSchema
+
+
+class WorkflowGraph:
+    """
+    Nodes of a workflow together with their edge columns, loaded up front so that walking the
+    graph never goes back to the database.
+    """
+
+    def __init__(self, workflow: Workflow, nodes: list, external_nodes: dict = None):
+        self.workflow = workflow
+        self.nodes = {node.id: node for node in nodes}
+        # id -> node of other workflows referenced by edges of this one
+        self.external_nodes = external_nodes or {}
+
+        self.start_node = None
+        self.end_node = None
+        for node in nodes:
+            if isinstance(node, StartNode):
+                self.start_node = node
+            elif isinstance(node, EndNode):
+                self.end_node = node
+
+    def get(self, node_id: int):
+        """
+        Returns the node with the given id, looking into referenced nodes of other workflows too.
+        """
+        node = self.nodes.get(node_id)
+        if node is None:
+            node = self.external_nodes.get(node_id)
+        return node
+
+
+def edge_targets(node: Node) -> list:
+    """
+    Returns the ids referenced by the edge columns of a node.
+    """
+    if isinstance(node, (StartNode, MessageNode)):
+        return [node.next_node_id]
+    elif isinstance(node, ConditionNode):
+        return [node.yes_node_id, node.no_node_id]
+    return []
+
+
+def refresh_message_nodes(db, node_ids=None, workflow_id: int = None):
+    """
+    Recomputes ConditionNode.message_node_id with a single UPDATE: the message node leading directly
+    to the condition, otherwise the one leading to the condition node whose "no" branch points to it.
+
+    Args:
+        db: Session or Connection.
+        node_ids: IDs of changed nodes and edge targets. Conditions among them and conditions reached
+            through their "no" branch are refreshed. All conditions are refreshed if omitted.
+        workflow_id (int, optional): Refresh all conditions of the workflow instead.
+    """
+    messages = MessageNode.__table__
+    conditions = ConditionNode.__table__
+    previous = conditions.alias('previous')
+
+    direct_message = select(func.min(messages.c.id)).where(messages.c.next_node_id == conditions.c.id).scalar_subquery()
+    previous_condition = select(func.min(previous.c.id)).where(previous.c.no_node_id == conditions.c.id).correlate(conditions).scalar_subquery()
+    previous_message = select(func.min(messages.c.id)).where(messages.c.next_node_id == previous_condition).scalar_subquery()
+
+    statement = update(conditions).values(message_node_id=func.coalesce(direct_message, previous_message))
+    if workflow_id is not None:
+        statement = statement.where(conditions.c.id.in_(select(Node.id).where(Node.workflow_id == workflow_id)))
+    elif node_ids is not None:
+        node_ids = {node_id for node_id in node_ids if node_id is not None}
+        if not node_ids:
+            return
+        dependent_ids = select(previous.c.no_node_id).where(previous.c.id.in_(node_ids))
+        statement = statement.where(or_(conditions.c.id.in_(node_ids), conditions.c.id.in_(dependent_ids)))
+    db.execute(statement)
+
+
+class GraphService:
+    """
+    Loads workflows with all their nodes in a fixed number of queries, whatever the workflow size.
+    """
+
+    def load_workflow(db: Session, workflow_id: int):
+        """
+        Loads a workflow with its nodes list (two queries). Only the columns of the nodes table are read,
+        the tables of the node types are not joined and no ORM objects are built.
+
+        Returns:
+            WorkflowSchema: loaded workflow, or None if the workflow doesn`t exist.
+        """
+        detail = GraphService.load_versioned_workflow(db, workflow_id)
+        return detail[0] if detail else None
+
+    def load_versioned_workflow(db: Session, workflow_id: int):
+        """
+        Loads a workflow as load_workflow, with the version it was read at.
+
+        Returns:
+            tuple: (WorkflowSchema, version), or None if the workflow doesn`t exist.
+        """
+        workflow = db.execute(GraphService.workflow_statement(workflow_id)).first()
+        if workflow is None:
+            return None
+        nodes = db.execute(GraphService.workflow_nodes_statement(workflow_id))
+        return GraphService.workflow_schema(workflow, nodes), workflow.version
+
+    def workflow_schema(workflow, nodes) -> WorkflowSchema:
+        # plain dicts are validated several times faster than rows read by attribute
+        return WorkflowSchema(id=workflow.id, name=workflow.name, nodes=[{'id': node_id, 'node_type': node_type, 'workflow_id': workflow_id} for node_id, node_type, workflow_id in nodes])
+
+    def workflow_statement(workflow_id: int):
+        return select(Workflow.id, Workflow.name, Workflow.version).where(Workflow.id == workflow_id)
+
+    def workflow_nodes_statement(workflow_id: int):
+        return select(Node.id, Node.node_type, Node.workflow_id).where(Node.workflow_id == workflow_id).order_by(Node.id)
+
+    def load_graph(db: Session, workflow_id: int):
+        """
+        Loads a workflow graph. At most three queries are issued: the workflow, its nodes with the columns
+        of every node table, and the nodes of other workflows its edges point to (if any).
+
+        Returns:
+            WorkflowGraph: loaded graph, or None if the workflow doesn`t exist.
+        """
+        return GraphService.load_graphs(db, [workflow_id]).get(workflow_id)
+
+    def load_graphs(db: Session, workflow_ids: list) -> dict:
+        """
+        Loads the graphs of several workflows with the same three queries as load_graph.
+
+        Returns:
+            dict: workflow id -> WorkflowGraph of the existing workflows.
+        """
+        workflows = db.query(Workflow).options(selectinload(Workflow.nodes)).filter(Workflow.id.in_(set(workflow_ids))).all()
+
+        loaded_nodes = {node.id: node for workflow in workflows for node in workflow.nodes}
+        missing_ids = {target for node in loaded_nodes.values() for target in edge_targets(node) if target is not None and target not in loaded_nodes}
+
+        # nodes are shared between graphs, an edge can point to another workflow of the batch
+        external_nodes = dict(loaded_nodes)
+        if missing_ids:
+            external_nodes.update((node.id, node) for node in db.query(Node).filter(Node.id.in_(missing_ids)).all())
+
+        return {workflow.id: WorkflowGraph(workflow, workflow.nodes, external_nodes) for workflow in workflows}
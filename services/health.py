@@ -0,0 +1,65 @@
+import os
+import time
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+
+class ServerState:
+    """
+    Lifecycle of the worker process: ready once the application startup is complete, draining
+    from the start of its shutdown.
+    """
+
+    def __init__(self):
+        # serve.py passes the launch time to its workers, so the startup includes the migration and the spawn
+        launched = os.environ.get('LAUNCH_STARTED')
+        self.started = float(launched) if launched else time.time()
+        self.ready = False
+        self.draining = False
+        self.startup_seconds = None
+
+    def mark_ready(self) -> float:
+        self.ready = True
+        self.draining = False
+        self.startup_seconds = time.time() - self.started
+        return self.startup_seconds
+
+    def mark_draining(self):
+        self.ready = False
+        self.draining = True
+
+
+server_state = ServerState()
+
+
+class HealthService:
+    """
+    Liveness and readiness checks of the worker process.
+    """
+
+    def liveness() -> dict:
+        return {
+            'status': 'draining' if server_state.draining else 'alive',
+            'pid': os.getpid(),
+            'uptime': time.time() - server_state.started,
+        }
+
+    def readiness(db: Session) -> dict:
+        """
+        Raises:
+            HTTPException: 503 while the worker starts or shuts down, or when the database can`t be read.
+        """
+        if not server_state.ready:
+            detail = "Shutting down." if server_state.draining else "Starting."
+            raise HTTPException(status_code=503, detail=detail)
+        try:
+            db.execute(text('SELECT 1'))
+        except SQLAlchemyError as e:
+            raise HTTPException(status_code=503, detail=f"Database unavailable. {e.__class__.__name__}")
+        return {
+            'status': 'ready',
+            'pid': os.getpid(),
+            'startup_seconds': server_state.startup_seconds,
+        }
@@ -0,0 +1,192 @@
+import threading
+import time
+from collections import deque
+from sqlalchemy import select, insert, delete, func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from models.workflow import RunHistory
+from database import create_db_engine
+from config import settings
+
+# seconds between two retention passes of the writer
+COMPACTION_INTERVAL = 60
+
+
+class HistoryWriter:
+    """
+    Records workflow runs without making them wait for the database. Records are appended to an
+    in-memory buffer and inserted by a background thread, one transaction per `batch_size` records,
+    at most `flush_interval` seconds after they were recorded. A full buffer drops new records
+    instead of slowing the runs down.
+
+    The same thread applies the retention policy: records older than `retention_days` are deleted,
+    and only the last `max_rows` records are kept.
+    """
+
+    def __init__(self, enabled: bool = True, batch_size: int = 500, flush_interval: float = 0.2, buffer_size: int = 10000,
+                 retention_days: float = 30, max_rows: int = 1000000):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.retention_days = retention_days
+        self.max_rows = max_rows
+
+        self._buffer = deque()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._engine = None
+        self._last_compaction = 0
+
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.deleted = 0
+
+    def record(self, workflow_id: int, version: int, started: float, success_path: list = None, conditions: list = None, status_code: int = None, error: str = None):
+        """
+        Buffers the record of a run.
+
+        Args:
+            workflow_id (int): The ID of the workflow.
+            version (int): Workflow version of the run, None if it failed before the workflow was loaded.
+            started (float): time.perf_counter() at the start of the run.
+            success_path (list, optional): Node IDs of the success path.
+            conditions (list, optional): (condition node id, result) pairs in evaluation order.
+            status_code (int, optional): Status code of the error the run failed with.
+            error (str, optional): Error the run failed with.
+        """
+        if not self.enabled:
+            return
+        if len(self._buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self._buffer.append({
+            'workflow_id': workflow_id,
+            'version': version,
+            'success_path': success_path,
+            'conditions': conditions,
+            'duration_ms': (time.perf_counter() - started) * 1000,
+            'status_code': status_code,
+            'error': error,
+            'created_at': time.time(),
+        })
+        self._start()
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _start(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._serve, name='history-writer', daemon=True)
+                    self._thread.start()
+
+    def _get_engine(self):
+        # a connection of its own, the writes of the requests don`t wait for a flush
+        if self._engine is None:
+            self._engine = create_db_engine(settings.database_url, pool_size=1)
+        return self._engine
+
+    def _serve(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            if time.monotonic() - self._last_compaction >= COMPACTION_INTERVAL:
+                self.compact()
+
+    def flush(self):
+        """
+        Inserts the buffered records. Called by the writer thread, and on shutdown.
+        """
+        with self._flush_lock:
+            while self._buffer:
+                rows = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+                try:
+                    with self._get_engine().begin() as connection:
+                        connection.execute(insert(RunHistory), rows)
+                except SQLAlchemyError:
+                    # the history never fails the runs, the batch is lost
+                    self.failed_batches += 1
+                    self.dropped += len(rows)
+                    return
+                self.written += len(rows)
+                self.batches += 1
+
+    def compact(self):
+        """
+        Deletes the records past the retention period and the oldest records above `max_rows`.
+        Both deletes go through indexes: created_at and the primary key, which grows with time.
+        """
+        self._last_compaction = time.monotonic()
+        try:
+            with self._get_engine().begin() as connection:
+                deleted = connection.execute(delete(RunHistory).where(RunHistory.created_at < time.time() - self.retention_days * 86400)).rowcount
+                last_id = connection.scalar(select(func.max(RunHistory.id)))
+                if last_id is not None and last_id > self.max_rows:
+                    deleted += connection.execute(delete(RunHistory).where(RunHistory.id <= last_id - self.max_rows)).rowcount
+        except SQLAlchemyError:
+            return
+        self.deleted += deleted
+
+    def close(self):
+        self.flush()
+        if self._engine is not None:
+            self._engine.dispose()
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'buffered': len(self._buffer),
+            'written': self.written,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'failed_batches': self.failed_batches,
+            'deleted': self.deleted,
+        }
+
+
+history_writer = HistoryWriter(
+    settings.history_enabled,
+    settings.history_batch_size,
+    settings.history_flush_ms / 1000,
+    settings.history_buffer_size,
+    settings.history_retention_days,
+    settings.history_max_rows,
+)
+
+
+class HistoryService:
+    """
+    Reads the run history.
+    """
+
+    def list_runs(db: Session, workflow_id: int = None, before: int = None, limit: int = 100) -> dict:
+        """
+        Returns a page of recorded runs, newest first. Pages are read by keyset: the next page starts
+        below the last returned id, so reading deep pages costs as much as the first one.
+
+        Args:
+            db (Session): The SQLAlchemy database session.
+            workflow_id (int, optional): Only the runs of this workflow.
+            before (int, optional): Only the runs with a smaller id, the `next_before` of the previous page.
+            limit (int): Maximum number of runs in the page.
+
+        Returns:
+            dict: `items` and the `next_before` cursor, None on the last page.
+        """
+        columns = RunHistory.__table__.c
+        statement = select(*columns).order_by(columns.id.desc()).limit(limit)
+        if workflow_id is not None:
+            statement = statement.where(columns.workflow_id == workflow_id)
+        if before is not None:
+            statement = statement.where(columns.id < before)
+        items = [dict(row) for row in db.execute(statement).mappings()]
+        return {
+            'items': items,
+            'next_before': items[-1]['id'] if len(items) == limit else None,
+        }
@@ -0,0 +1,157 @@
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+from models.workflow import Workflow, StartNode, EndNode, MessageNode, ConditionNode
+from schemas.workflow import WorkflowImportSchema, NodeImportSchema
+from services.graph import GraphService, refresh_message_nodes
+from services.plan import compile_plan
+from services.rules import compile_rule
+from services.validation import ValidationService
+from config import settings
+
+IMPORT_CHUNK_SIZE = settings.import_chunk_size
+IMPORT_SPOOL_SIZE = settings.import_spool_size
+
+NODE_MODELS = {
+    'start': StartNode,
+    'message': MessageNode,
+    'condition': ConditionNode,
+    'end': EndNode,
+}
+
+
+class GraphImport:
+    """
+    Imports a whole workflow graph in one transaction. Nodes are added in chunks with bulk inserts,
+    so the document is never held in memory; edges reference client-side temporary ids and are
+    resolved with bulk updates once every node is inserted. The structure is validated once and
+    the transaction is committed once.
+    """
+
+    def __init__(self, db: Session, header: dict):
+        try:
+            data = WorkflowImportSchema.model_validate(header)
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=f"Error. Invalid workflow header: {e.errors()}")
+
+        self.db = db
+        self.workflow = Workflow(name=data.name)
+        db.add(self.workflow)
+        db.flush()
+
+        self.ids = {}  # temporary id -> node id
+        self.edges = []  # (model, node id, next ref, yes ref, no ref)
+        self.count = 0
+        self.has_start = False
+        self.has_end = False
+
+    def add_nodes(self, lines: list):
+        """
+        Validates and bulk inserts a chunk of node lines.
+        """
+        rows = {node_type: ([], []) for node_type in NODE_MODELS}
+        chunk_refs = set()
+        for line in lines:
+            self.count += 1
+            try:
+                data = NodeImportSchema.model_validate(line)
+            except ValidationError as e:
+                raise HTTPException(status_code=400, detail=f"Error. Invalid node #{self.count}: {e.errors()}")
+            ref = str(data.ref)
+            if ref in self.ids or ref in chunk_refs:
+                raise HTTPException(status_code=400, detail=f"Error. Node id {ref!r} is used twice.")
+            chunk_refs.add(ref)
+
+            node_type = data.node_type.value
+            row = {'workflow_id': self.workflow.id}
+            if node_type == 'start':
+                if self.has_start:
+                    raise HTTPException(status_code=400, detail="Error. Start node for this workflow is already exists.")
+                self.has_start = True
+            elif node_type == 'end':
+                if self.has_end:
+                    raise HTTPException(status_code=400, detail="Error. End node for this workflow is already exists.")
+                self.has_end = True
+            elif node_type == 'message':
+                if data.message_text is None or data.status is None:
+                    raise HTTPException(status_code=400, detail=f"Error. Message node {ref!r} requires message_text and status.")
+                row['message_text'] = data.message_text
+                row['status'] = data.status.value
+            elif node_type == 'condition':
+                if data.condition is None:
+                    raise HTTPException(status_code=400, detail=f"Error. Condition node {ref!r} requires condition.")
+                try:
+                    compile_rule(data.condition)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=f"Error. Invalid condition {data.condition!r}. {e}")
+                row['condition'] = data.condition
+
+            node_rows, refs = rows[node_type]
+            node_rows.append(row)
+            refs.append((ref, data.next, data.yes, data.no))
+
+        for node_type, (node_rows, refs) in rows.items():
+            if not node_rows:
+                continue
+            model = NODE_MODELS[node_type]
+            node_ids = self.db.scalars(insert(model).returning(model.id, sort_by_parameter_order=True), node_rows).all()
+            for node_id, (ref, next_ref, yes_ref, no_ref) in zip(node_ids, refs):
+                self.ids[ref] = node_id
+                if next_ref is not None or yes_ref is not None or no_ref is not None:
+                    self.edges.append((model, node_id, next_ref, yes_ref, no_ref))
+
+    def resolve(self, ref):
+        if ref is None:
+            return None
+        node_id = self.ids.get(str(ref))
+        if node_id is None:
+            raise HTTPException(status_code=400, detail=f"Error. Node id {ref!r} is not exists.")
+        return node_id
+
+    def finish(self) -> dict:
+        """
+        Resolves the edges, validates the structure and commits the import.
+        """
+        updates = {model: [] for model in NODE_MODELS.values()}
+        for model, node_id, next_ref, yes_ref, no_ref in self.edges:
+            if model is ConditionNode:
+                updates[model].append({'id': node_id, 'yes_node_id': self.resolve(yes_ref), 'no_node_id': self.resolve(no_ref)})
+            elif model in (StartNode, MessageNode):
+                updates[model].append({'id': node_id, 'next_node_id': self.resolve(next_ref)})
+        self.edges = []
+
+        for model, rows in updates.items():
+            for i in range(0, len(rows), IMPORT_CHUNK_SIZE):
+                self.db.execute(update(model), rows[i:i + IMPORT_CHUNK_SIZE])
+
+        refresh_message_nodes(self.db, workflow_id=self.workflow.id)
+        self.db.flush()
+
+        graph = GraphService.load_graph(self.db, self.workflow.id)
+        compile_plan(graph, self.workflow.version)
+        ValidationService.check_acyclic(self.db, self.workflow.id)
+
+        self.db.commit()
+        return {
+            'id': self.workflow.id,
+            'name': self.workflow.name,
+            'nodes': self.ids,
+        }
+
+
+def import_graph(db: Session, header: dict, lines) -> dict:
+    """
+    Imports a workflow from its header and an iterable of node lines, added in chunks of IMPORT_CHUNK_SIZE.
+    The lines must already be available: the transaction is held from the first insert to the commit.
+    """
+    graph_import = GraphImport(db, header)
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            graph_import.add_nodes(chunk)
+            chunk = []
+    if chunk:
+        graph_import.add_nodes(chunk)
+    return graph_import.finish()
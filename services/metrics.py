@@ -0,0 +1,224 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import settings
+
+# seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PHASE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # labels -> [count per bucket and +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            values[0][index] += 1
+            values[1] += value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = 'le="%s"' % (bound if bound == '+Inf' else format_value(bound))
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+class RequestStats:
+    __slots__ = ('queries', 'sql_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+
+# statistics of the current request, shared with the threadpool the request is served in
+request_stats = ContextVar('request_stats', default=None)
+
+
+class Metrics:
+    """
+    Process-wide metrics in the Prometheus text format. Nothing is recorded and no hooks are
+    installed unless `enabled`; callers check `metrics.enabled` before measuring.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.request_seconds = Histogram('http_request_duration_seconds', 'Latency of HTTP requests by route.', ('method', 'route', 'status'))
+        self.request_queries = Histogram('http_request_sql_queries', 'SQL queries issued per HTTP request.', ('method', 'route'), QUERY_COUNT_BUCKETS)
+        self.request_sql_seconds = Histogram('http_request_sql_duration_seconds', 'Time spent in SQL per HTTP request.', ('method', 'route'))
+        self.queries = Counter('sql_queries_total', 'SQL statements executed.', ('operation',))
+        self.query_seconds = Histogram('sql_query_duration_seconds', 'Latency of SQL statements.', ('operation',), PHASE_BUCKETS)
+        self.phase_seconds = Histogram('workflow_run_phase_duration_seconds', 'Time spent in the phases of workflow runs.', ('phase',), PHASE_BUCKETS)
+        self._hooks_installed = False
+
+    def install_sql_hooks(self):
+        """
+        Times every statement of every engine, including the engines created later.
+        """
+        if self._hooks_installed:
+            return
+        self._hooks_installed = True
+
+        @event.listens_for(Engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+        @event.listens_for(Engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info['query_started'].pop()
+            operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+            self.queries.inc(operation)
+            self.query_seconds.observe(elapsed, operation)
+            stats = request_stats.get()
+            if stats is not None:
+                stats.queries += 1
+                stats.sql_seconds += elapsed
+
+    def phase(self, name: str):
+        """
+        Context manager timing a phase of a run, a no-op when metrics are disabled.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return PhaseTimer(self.phase_seconds, name)
+
+    def time_walk(self, walk, graph, start: int, branch):
+        """
+        Runs a walk, timing the evaluation of the conditions apart from the path search.
+        """
+        conditions_time = 0.0
+
+        def timed_branch(index):
+            nonlocal conditions_time
+            started = time.perf_counter()
+            try:
+                return branch(index)
+            finally:
+                conditions_time += time.perf_counter() - started
+
+        started = time.perf_counter()
+        try:
+            return walk(graph, start, timed_branch)
+        finally:
+            self.phase_seconds.observe(conditions_time, 'conditions')
+            self.phase_seconds.observe(time.perf_counter() - started - conditions_time, 'walk')
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.request_seconds, self.request_queries, self.request_sql_seconds, self.queries, self.query_seconds, self.phase_seconds):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class PhaseTimer:
+    __slots__ = ('histogram', 'name', 'started')
+
+    def __init__(self, histogram: Histogram, name: str):
+        self.histogram = histogram
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, self.name)
+
+
+metrics = Metrics(settings.metrics_enabled)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency, the number of SQL queries and the SQL time of every request,
+    labelled with the route path template.
+    """
+
+    def __init__(self, app, metrics: Metrics = metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            request_stats.reset(token)
+            route = scope.get('route')
+            # unmatched paths share one label, so the number of series stays bounded
+            path = route.path if route is not None else 'unmatched'
+            self.metrics.request_seconds.observe(elapsed, scope['method'], path, status)
+            self.metrics.request_queries.observe(stats.queries, scope['method'], path)
+            self.metrics.request_sql_seconds.observe(stats.sql_seconds, scope['method'], path)
@@ -1,8 +1,21 @@
 from fastapi import HTTPException, Depends
-from models.workflow import StartNode, EndNode, MessageNode, ConditionNode, Node
+from models.workflow import StartNode, EndNode, MessageNode, ConditionNode, Node, MESSAGE_STATUSES
 from schemas.workflow import *
+from sqlalchemy import select, update, or_
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from database import get_db
+from services.write_queue import write_queue
+from services.workflow import WorkflowServices
+from services.rules import compile_rule
+from services.graph import edge_targets, refresh_message_nodes
+from services.results import ResultService
+from services.validation import ValidationService
+from services.cache import read_cache, node_key, workflow_key, deleted_keys
+from services.etag import node_etag, check_if_match
+from config import settings
+
+STATUS_CHUNK_SIZE = settings.status_chunk_size
 
 
 class NodeService:
@@ -10,8 +23,35 @@ class NodeService:
     Service provides basic nodes management (get, create, update, delete)
     """
 
+    def validate_condition(condition: str):
+        """
+        Compiles the condition so that malformed rules are rejected when the node is saved, not during a run.
+        """
+        try:
+            compile_rule(condition)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Error. Invalid condition {condition!r}. {e}")
+
     def get_node(node_id: int, db: Session = Depends(get_db)):
+        return NodeService.get_versioned_node(db, node_id)[0]
+
+    def get_versioned_node(db: Session, node_id: int, version: int = None) -> tuple:
+        """
+        Returns the node schema with the version its ETag is made of, (None, None) if it doesn`t exist.
+        A cached node of another version than `version`, if given, is reloaded.
+        """
+        fresh = None if version is None else lambda detail: detail[1] == version
+        detail = read_cache.load(db, node_key(node_id), lambda: NodeService.load_node(db, node_id), fresh)
+        return detail or (None, None)
+
+    def load_node(db: Session, node_id: int):
         node = db.query(Node).filter(Node.id == node_id).first()
+        return (NodeService.to_schema(node), node.version) if node else None
+
+    def get_version(db: Session, node_id: int):
+        return db.scalar(select(Node.version).where(Node.id == node_id))
+
+    def to_schema(node: Node):
         if node:
             if node.node_type == 'start':
                 return StartNodeSchema(workflow_id=node.workflow_id, next_node_id=node.next_node_id)
@@ -24,6 +64,15 @@ class NodeService:
         else:
             return None
 
+    def data_targets(node_type: str, data) -> list:
+        """
+        Returns the ids the edges of a node of the given type point to after saving `data`.
+        """
+        if node_type in ('start', 'message'):
+            return [data.next_node_id]
+        elif node_type == 'condition':
+            return [data.yes_node_id, data.no_node_id]
+        return []
 
     def create_node(node_type: str, data: dict, db: Session = Depends(get_db())):
         if node_type == 'start':
@@ -37,6 +86,7 @@ class NodeService:
             node = MessageNode(node_type=node_type, workflow_id=data.workflow_id, message_text=data.message_text, status=data.status, next_node_id=data.next_node_id)
 
         elif node_type == 'condition':
+            NodeService.validate_condition(data.condition)
             node = ConditionNode(node_type=node_type, workflow_id=data.workflow_id, condition=data.condition, yes_node_id=data.yes_node_id, no_node_id=data.no_node_id)
 
         elif node_type == 'end':
@@ -45,15 +95,45 @@ class NodeService:
                 node = EndNode(node_type=node_type, workflow_id=data.workflow_id)
             else:
                 return False
-            
+
+        topology = ValidationService.get_topology(db, node.workflow_id)
         db.add(node)
+        db.flush()
+        ValidationService.add_node(topology, node.id, node_type, edge_targets(node))
+        refresh_message_nodes(db, [node.id, *edge_targets(node)])
+        WorkflowServices.bump_version(db, node.workflow_id)
+        ValidationService.committed(db, node.workflow_id, topology)
+        read_cache.invalidate(db, workflow_key(node.workflow_id))
         db.commit()
         db.refresh(node)
 
         return node
     
-    def update_node(node_id: int, data: dict, db: Session = Depends(get_db)):
+    def update_node(node_id: int, data: dict, db: Session = Depends(get_db), if_match: str = None):
         node = db.query(Node).filter(Node.id == node_id).first()
+        if node is None:
+            raise HTTPException(status_code=404, detail="Node not found.")
+        check_if_match(if_match, node_etag(node.id, node.version))
+        old_workflow_id = node.workflow_id
+        old_edge_targets = edge_targets(node)
+        old_condition = getattr(node, 'condition', None)
+        old_status = getattr(node, 'status', None)
+        if node.node_type == 'condition':
+            NodeService.validate_condition(data.condition)
+
+        # the structure is checked before the node is changed, an invalid edit leaves the session clean
+        workflow_id = old_workflow_id if node.node_type == 'start' else data.workflow_id
+        targets = NodeService.data_targets(node.node_type, data)
+        topologies = {}
+        if workflow_id != old_workflow_id:
+            topologies[old_workflow_id] = ValidationService.get_topology(db, old_workflow_id)
+            topologies[workflow_id] = ValidationService.get_topology(db, workflow_id)
+            ValidationService.remove_node(topologies[old_workflow_id], node.id)
+            ValidationService.add_node(topologies[workflow_id], node.id, node.node_type, targets)
+        elif targets != old_edge_targets:
+            topologies[workflow_id] = ValidationService.get_topology(db, workflow_id)
+            ValidationService.update_edges(topologies[workflow_id], node.id, old_edge_targets, targets)
+
         if node.node_type == 'start':
             node.next_node_id = data.next_node_id
         elif node.node_type == 'message':
@@ -68,20 +148,144 @@ class NodeService:
             node.no_node_id = data.no_node_id
         elif node.node_type == 'end':
             node.workflow_id=data.workflow_id
+        node.version = Node.version + 1
 
         db.add(node)
+        db.flush()
+        # message texts and statuses are not a part of the execution plan
+        if old_workflow_id != node.workflow_id or old_edge_targets != edge_targets(node) or old_condition != getattr(node, 'condition', None):
+            refresh_message_nodes(db, [node.id, *old_edge_targets, *edge_targets(node)])
+            WorkflowServices.bump_version(db, old_workflow_id, node.workflow_id)
+            for changed_workflow_id, topology in topologies.items():
+                ValidationService.committed(db, changed_workflow_id, topology)
+        elif old_status != getattr(node, 'status', None):
+            ResultService.refresh(db, [node.id])
+        keys = [node_key(node.id)]
+        if old_workflow_id != node.workflow_id:
+            # the workflow details list the nodes with their workflow
+            keys += [workflow_key(old_workflow_id), workflow_key(node.workflow_id)]
+        read_cache.invalidate(db, *keys)
         db.commit()
         db.refresh(node)
 
         return node
     
-    def delete_node(node_id: int, db: Session = Depends(get_db())):
+    def delete_node(node_id: int, db: Session = Depends(get_db()), if_match: str = None):
         node = db.query(Node).filter(Node.id == node_id).first()
         if node:
+            check_if_match(if_match, node_etag(node.id, node.version))
+            workflow_id = node.workflow_id
+            old_edge_targets = edge_targets(node)
+            topology = ValidationService.get_topology(db, workflow_id)
+            ValidationService.remove_node(topology, node.id)
             db.delete(node)
+            keys = [workflow_key(workflow_id), *deleted_keys(db)]
+            db.flush()
+            refresh_message_nodes(db, old_edge_targets)
+            WorkflowServices.bump_version(db, workflow_id)
+            ValidationService.committed(db, workflow_id, topology)
+            read_cache.invalidate(db, *keys)
             db.commit()
             return True
         else:
             raise HTTPException(status_code=400, detail=f'Node with id {node_id} is not exists.')
-    
-        
\ No newline at end of file
+
+    def update_statuses(db: Session, statuses: list) -> dict:
+        """
+        Applies many message status changes in one transaction, with an UPDATE per status and chunk of ids.
+        Changes are applied in delivery order of the statuses and a status never moves back,
+        repeating the current status is accepted.
+
+        Args:
+            db (Session): The SQLAlchemy database session.
+            statuses (list): MessageStatusUpdateSchema items.
+
+        Returns:
+            dict: Number of applied changes and ids of the rejected ones: not existing message nodes
+                and transitions to an earlier status.
+        """
+        messages = MessageNode.__table__
+        ids_by_status = {status: [] for status in MESSAGE_STATUSES}
+        for item in statuses:
+            ids_by_status[item.status.value].append(item.node_id)
+
+        updated = 0
+        rejected = []
+        changed_ids = set()
+        for rank, status in enumerate(MESSAGE_STATUSES):
+            # an id repeated with the same status is one change
+            node_ids = list(dict.fromkeys(ids_by_status[status]))
+            previous_statuses = MESSAGE_STATUSES[:rank + 1]
+            for i in range(0, len(node_ids), STATUS_CHUNK_SIZE):
+                chunk = node_ids[i:i + STATUS_CHUNK_SIZE]
+                statement = (
+                    update(messages)
+                    .where(messages.c.id.in_(chunk), or_(messages.c.status.is_(None), messages.c.status.in_(previous_statuses)))
+                    .values(status=status)
+                    .returning(messages.c.id)
+                )
+                applied = set(db.scalars(statement))
+                changed_ids |= applied
+                for node_id in chunk:
+                    if node_id in applied:
+                        updated += 1
+                    else:
+                        rejected.append(node_id)
+
+        nodes = Node.__table__
+        changed = list(changed_ids)
+        for i in range(0, len(changed), STATUS_CHUNK_SIZE):
+            db.execute(update(nodes).where(nodes.c.id.in_(changed[i:i + STATUS_CHUNK_SIZE])).values(version=nodes.c.version + 1))
+        ResultService.refresh(db, changed_ids)
+        read_cache.invalidate(db, *map(node_key, changed_ids))
+        db.commit()
+        return {'updated': updated, 'rejected': rejected}
+
+
+class AsyncNodeService:
+    """
+    Async counterpart of NodeService, used when the API runs in the async database mode.
+    Writes reuse the sync implementation through AsyncSession.run_sync, or go through
+    the group commit queue in the write-behind mode.
+    """
+
+    async def get_node(node_id: int, db: AsyncSession):
+        return (await AsyncNodeService.get_versioned_node(db, node_id))[0]
+
+    async def get_versioned_node(db: AsyncSession, node_id: int, version: int = None) -> tuple:
+        if read_cache.sync_due():
+            await db.run_sync(read_cache.sync)
+        key = node_key(node_id)
+        detail = read_cache.get(key, None if version is None else lambda detail: detail[1] == version)
+        if detail is not None:
+            return detail
+        epoch = read_cache.epoch
+        node = await db.get(Node, node_id)
+        if node is None:
+            return None, None
+        detail = NodeService.to_schema(node), node.version
+        read_cache.put(key, detail, epoch)
+        return detail
+
+    async def get_version(db: AsyncSession, node_id: int):
+        return await db.scalar(select(Node.version).where(Node.id == node_id))
+
+    async def create_node(node_type: str, data: dict, db: AsyncSession):
+        if write_queue is not None:
+            return await write_queue.run_async(NodeService.create_node, node_type=node_type, data=data)
+        return await db.run_sync(lambda session: NodeService.create_node(node_type=node_type, data=data, db=session))
+
+    async def update_node(node_id: int, data: dict, db: AsyncSession, if_match: str = None):
+        if write_queue is not None:
+            return await write_queue.run_async(NodeService.update_node, node_id=node_id, data=data, if_match=if_match)
+        return await db.run_sync(lambda session: NodeService.update_node(node_id=node_id, data=data, db=session, if_match=if_match))
+
+    async def update_statuses(statuses: list, db: AsyncSession):
+        if write_queue is not None:
+            return await write_queue.run_async(NodeService.update_statuses, statuses=statuses)
+        return await db.run_sync(lambda session: NodeService.update_statuses(statuses=statuses, db=session))
+
+    async def delete_node(node_id: int, db: AsyncSession, if_match: str = None):
+        if write_queue is not None:
+            return await write_queue.run_async(NodeService.delete_node, node_id=node_id, if_match=if_match)
+        return await db.run_sync(lambda session: NodeService.delete_node(node_id=node_id, db=session, if_match=if_match))
@@ -0,0 +1,342 @@
+import threading
+from collections import OrderedDict
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models.workflow import Workflow, StartNode, EndNode, MessageNode, ConditionNode
+from services.executor import CompactGraph, WalkError, START, MESSAGE, CONDITION, END, walk, iter_walk, partition_walk
+from services.graph import GraphService, WorkflowGraph
+from services.metrics import metrics
+from services.rules import match_condition
+from config import settings
+
+PLAN_CACHE_SIZE = settings.plan_cache_size
+VALIDATE_ON_RUN = settings.validate_on_run
+
+
+class ExecutionPlan:
+    """
+    Compiled, structurally validated workflow. Holds everything needed to run the workflow
+    except the results of its conditions, which depend on the current message statuses.
+    """
+
+    def __init__(self, workflow_id: int, version: int, graph: CompactGraph, start_node: int, end_node: int, conditions: dict, edges: list):
+        self.workflow_id = workflow_id
+        self.version = version
+        self.graph = graph
+        # indexes of the start and end nodes in the compact graph
+        self.start_node = start_node
+        self.end_node = end_node
+        # condition node index -> (condition, checked message node id)
+        self.conditions = conditions
+        self.message_ids = sorted({message_id for _, message_id in conditions.values()})
+        self.edges = edges
+
+    def statuses_statement(self):
+        """
+        Returns the query of the statuses checked by the conditions, or None if there are no conditions.
+        """
+        if not self.message_ids:
+            return None
+        return select(MessageNode.id, MessageNode.status).where(MessageNode.id.in_(self.message_ids))
+
+    def run(self, db: Session, conditions: list = None, edges: bool = True) -> dict:
+        """
+        Evaluates the conditions against the current message statuses and walks the success path.
+        """
+        return self.execute(self.load_statuses(db), conditions, edges)
+
+    def load_statuses(self, db: Session) -> dict:
+        statement = self.statuses_statement()
+        if statement is None:
+            return {}
+        with metrics.phase('statuses'):
+            return dict(db.execute(statement).all())
+
+    def execute(self, statuses: dict, conditions: list = None, edges: bool = True) -> dict:
+        """
+        Walks the success path, evaluating only the conditions met on the way.
+
+        Args:
+            statuses (dict): Message node id -> status of the message nodes checked by conditions.
+            conditions (list, optional): Receives the (condition node id, result) pairs in evaluation order.
+            edges (bool): Include the edges of the workflow in the result.
+        """
+        branch = self.branch(statuses, conditions)
+        try:
+            if metrics.enabled:
+                sequence = metrics.time_walk(walk, self.graph, self.start_node, branch)
+            else:
+                sequence = walk(self.graph, self.start_node, branch)
+        except WalkError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return {
+            'success_path': sequence,
+            'edges': list(self.edges) if edges else None
+        }
+
+    def iter_path(self, statuses: dict, conditions: list = None):
+        """
+        Yields the node IDs of the success path while walking it, see execute.
+        """
+        try:
+            yield from iter_walk(self.graph, self.start_node, self.branch(statuses, conditions))
+        except WalkError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    def branch(self, statuses: dict, conditions: list = None):
+        """
+        Returns the callable evaluating a condition node of the walk against the statuses.
+        """
+        def branch(index):
+            condition, message_id = self.conditions[index]
+            result = match_condition(condition, statuses.get(message_id))
+            if conditions is not None:
+                conditions.append((self.graph.ids[index], result))
+            return result
+        return branch
+
+    def route(self, columns: dict, size: int) -> list:
+        """
+        Routes a chunk of recipients through the workflow in one pass. At every condition the rule is
+        evaluated once per distinct status in the column of its message node, then the recipients
+        reaching the condition are split by looking their status up.
+
+        Args:
+            columns (dict): Message node id -> list of statuses, one per recipient of the chunk.
+            size (int): Number of recipients in the chunk.
+
+        Returns:
+            list: (success path, positions of the recipients following it) pairs.
+        """
+        def split(index, members):
+            condition, message_id = self.conditions[index]
+            column = columns[message_id]
+            results = {status: match_condition(condition, status) for status in {column[member] for member in members}}
+            yes_members = []
+            no_members = []
+            for member in members:
+                (yes_members if results[column[member]] else no_members).append(member)
+            return yes_members, no_members
+
+        try:
+            return partition_walk(self.graph, self.start_node, range(size), split)
+        except WalkError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+
+def compile_plan(graph: WorkflowGraph, version: int, validate: bool = True) -> ExecutionPlan:
+    """
+    Builds the compact graph of the workflow and runs the structural checks.
+
+    Args:
+        graph (WorkflowGraph): The loaded workflow graph.
+        version (int): Workflow version the graph is loaded for.
+        validate (bool): Check the rules already checked when nodes are written (previous nodes of
+            the start node, condition after the start node) and that the end node is reachable.
+            Cycles and dead ends are still reported by the walk.
+
+    Raises:
+        HTTPException: If the workflow structure is invalid.
+    """
+    start_node = 0
+    last_node = 0
+    rows = []
+    edges = []
+    conditions = {}
+    for node in graph.nodes.values():
+        if isinstance(node, StartNode):
+            next_node = graph.get(node.next_node_id)
+            if not next_node:
+                raise HTTPException(status_code=400, detail=f"Error. Node {node.id} is connected to not existing node.")
+            if not validate or next_node.node_type != 'condition':
+                rows.append((node.id, START, node.next_node_id, None, None))
+                edges.append((node.id, node.next_node_id))
+                start_node = node.id
+            else:
+                raise HTTPException(status_code=400, detail="Error. Condition node could be reached through Message or Condition node")
+
+        elif isinstance(node, MessageNode):
+            next_node = graph.get(node.next_node_id)
+            if not next_node:
+                raise HTTPException(status_code=400, detail=f"Error. Node {node.id} is connected to not existing node.")
+            if not validate or next_node.node_type != 'start':
+                rows.append((node.id, MESSAGE, node.next_node_id, None, None))
+                edges.append((node.id, node.next_node_id))
+            else:
+                raise HTTPException(status_code=400, detail="Error. Start node couldn`t have any previous nodes.")
+
+        elif isinstance(node, ConditionNode):
+            if not node.message_node_id:
+                raise HTTPException(status_code=400, detail=f"Error. Condition node {node.id} has no connected message nodes.")
+            conditions[len(rows)] = (node.condition, node.message_node_id)
+            rows.append((node.id, CONDITION, None, node.yes_node_id, node.no_node_id))
+            edges.append((node.id, node.yes_node_id))
+            if node.no_node_id != node.yes_node_id:
+                edges.append((node.id, node.no_node_id))
+
+        elif isinstance(node, EndNode):
+            rows.append((node.id, END, None, None, None))
+            last_node = node.id
+
+    if not start_node:
+        raise HTTPException(status_code=400, detail="Error. Sequence has no start node.")
+
+    if not last_node:
+        raise HTTPException(status_code=400, detail="Error. Sequence has no end node.")
+
+    compact_graph = CompactGraph(rows)
+    start_index = compact_graph.index[start_node]
+    end_index = compact_graph.index[last_node]
+
+    if validate and not compact_graph.reachable(start_index, end_index):
+        raise HTTPException(status_code=400, detail="Error. End node is unreachable.")
+
+    if not edges:
+        raise HTTPException(status_code=400, detail="Error. Created graph has no edges.")
+
+    return ExecutionPlan(graph.workflow.id, version, compact_graph, start_index, end_index, conditions, edges)
+
+
+class PlanCache:
+    """
+    Bounded LRU cache of execution plans keyed by (workflow_id, version).
+
+    The version is read from the database on every lookup, so a change made by any worker
+    sharing the database file makes the cached plan unreachable.
+    """
+
+    def __init__(self, maxsize: int = PLAN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, workflow_id: int, version: int):
+        key = (workflow_id, version)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is None:
+                self.misses += 1
+                return None
+            self._plans.move_to_end(key)
+            self.hits += 1
+            return plan
+
+    def put(self, plan: ExecutionPlan):
+        with self._lock:
+            # older versions of the workflow are never requested again
+            old_version = self._versions.get(plan.workflow_id)
+            if old_version is not None:
+                self._plans.pop((plan.workflow_id, old_version), None)
+
+            self._plans[(plan.workflow_id, plan.version)] = plan
+            self._versions[plan.workflow_id] = plan.version
+            while len(self._plans) > self.maxsize:
+                (workflow_id, _), _ = self._plans.popitem(last=False)
+                self._versions.pop(workflow_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+            self._versions.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._plans),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+plan_cache = PlanCache()
+
+
+class PlanService:
+    """
+    Provides compiled execution plans of workflows.
+    """
+
+    def get_version(db: Session, workflow_id: int):
+        return db.query(Workflow.version).filter(Workflow.id == workflow_id).scalar()
+
+    def get_plan(db: Session, workflow_id: int) -> ExecutionPlan:
+        """
+        Returns the cached plan of the current workflow version, compiling it on a cache miss.
+
+        Raises:
+            HTTPException: If the workflow doesn`t exist or its structure is invalid.
+        """
+        version = PlanService.get_version(db, workflow_id)
+        if version is None:
+            raise HTTPException(status_code=400, detail= f"Error. Workflow not found")
+
+        plan = plan_cache.get(workflow_id, version)
+        if plan is not None:
+            return plan
+        return PlanService.load_plan(db, workflow_id, version)
+
+    def load_plan(db: Session, workflow_id: int, version: int) -> ExecutionPlan:
+        """
+        Compiles the plan of the given workflow version and puts it in the cache.
+        """
+        with metrics.phase('load'):
+            graph = GraphService.load_graph(db, workflow_id)
+        if not graph:
+            raise HTTPException(status_code=400, detail= f"Error. Workflow not found")
+        with metrics.phase('build'):
+            plan = compile_plan(graph, version, VALIDATE_ON_RUN)
+
+        # nodes could be changed by another worker while loading, such a plan is used only once
+        if PlanService.get_version(db, workflow_id) == version:
+            plan_cache.put(plan)
+        return plan
+
+    def get_plans(db: Session, workflow_ids: list) -> dict:
+        """
+        Returns the plans of several workflows. Versions, graphs of the cache misses and their
+        nodes are loaded with a fixed number of set-based queries.
+
+        Returns:
+            dict: workflow id -> ExecutionPlan, or the HTTPException explaining why the workflow can`t be run.
+        """
+        ids = set(workflow_ids)
+        versions = dict(db.query(Workflow.id, Workflow.version).filter(Workflow.id.in_(ids)).all())
+
+        plans = {}
+        missing = {}
+        for workflow_id in ids:
+            version = versions.get(workflow_id)
+            if version is None:
+                plans[workflow_id] = HTTPException(status_code=400, detail= f"Error. Workflow not found")
+                continue
+            plan = plan_cache.get(workflow_id, version)
+            if plan is None:
+                missing[workflow_id] = version
+            else:
+                plans[workflow_id] = plan
+
+        if missing:
+            with metrics.phase('load'):
+                graphs = GraphService.load_graphs(db, list(missing))
+            current_versions = dict(db.query(Workflow.id, Workflow.version).filter(Workflow.id.in_(list(missing))).all())
+            for workflow_id, version in missing.items():
+                graph = graphs.get(workflow_id)
+                if not graph:
+                    plans[workflow_id] = HTTPException(status_code=400, detail= f"Error. Workflow not found")
+                    continue
+                try:
+                    with metrics.phase('build'):
+                        plan = compile_plan(graph, version, VALIDATE_ON_RUN)
+                except HTTPException as e:
+                    plans[workflow_id] = e
+                    continue
+                if current_versions.get(workflow_id) == version:
+                    plan_cache.put(plan)
+                plans[workflow_id] = plan
+        return plans
@@ -0,0 +1,132 @@
+from fastapi import HTTPException
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from models.workflow import Workflow, WorkflowResult, ConditionNode, MessageNode
+from services.executor import WalkError, DeadEndError, NO_NODE, walk
+from services.plan import ExecutionPlan, PlanService
+from services.rules import match_condition
+from config import settings
+
+CHUNK_SIZE = settings.status_chunk_size
+
+
+def patch_path(plan: ExecutionPlan, path: list, condition_ids: set, statuses: dict) -> list:
+    """
+    Re-evaluates the given conditions of a stored success path. The path is kept up to the first
+    condition whose branch changed and walked again from there.
+
+    Args:
+        plan (ExecutionPlan): Plan of the workflow version the path was computed for.
+        path (list): Stored success path.
+        condition_ids (set): IDs of the conditions whose message status changed.
+        statuses (dict): Message node id -> current status of the messages checked by the plan.
+
+    Returns:
+        list: The new success path, or None if it is unchanged.
+
+    Raises:
+        WalkError: If the new path has a cycle or a dead end.
+    """
+    graph = plan.graph
+
+    def branch(index):
+        condition, message_id = plan.conditions[index]
+        return match_condition(condition, statuses.get(message_id))
+
+    for position, node_id in enumerate(path[:-1]):
+        if node_id not in condition_ids:
+            continue
+        index = graph.index[node_id]
+        target = graph.yes[index] if branch(index) else graph.no[index]
+        if target == NO_NODE:
+            raise DeadEndError(node_id)
+        if graph.ids[target] != path[position + 1]:
+            return walk(graph, target, branch, prefix=path[:position + 1])
+    return None
+
+
+class ResultService:
+    """
+    Keeps the last result of every workflow materialized in workflow_results. Message status changes
+    re-evaluate only the conditions reading those messages (ConditionNode.message_node_id is the
+    dependency map) and patch the stored path from the first changed branch on.
+    """
+
+    def get_stored_result(db: Session, workflow_id: int):
+        """
+        Returns the stored result of the current workflow version, None if there is none. Only reads.
+        """
+        plan = PlanService.get_plan(db, workflow_id)
+        stored = db.get(WorkflowResult, workflow_id)
+        if stored is not None and stored.version == plan.version:
+            return {'success_path': stored.success_path, 'edges': list(plan.edges)}
+        return None
+
+    def get_result(db: Session, workflow_id: int) -> dict:
+        """
+        Returns the stored result of the workflow, running it and storing the result if there is none
+        for the current workflow version.
+        """
+        result = ResultService.get_stored_result(db, workflow_id)
+        if result is not None:
+            return result
+
+        plan = PlanService.get_plan(db, workflow_id)
+        result = plan.run(db)
+        statement = insert(WorkflowResult).values(workflow_id=workflow_id, version=plan.version, success_path=result['success_path'])
+        db.execute(statement.on_conflict_do_update(index_elements=[WorkflowResult.workflow_id], set_={'version': statement.excluded.version, 'success_path': statement.excluded.success_path}))
+        db.commit()
+        return result
+
+    def refresh(db: Session, message_ids) -> int:
+        """
+        Patches the stored results depending on the given message nodes. Runs in the caller`s
+        transaction, which is expected to commit the status change.
+
+        Returns:
+            int: Number of changed results.
+        """
+        message_ids = list(set(message_ids))
+        dependents = {}  # workflow id -> ids of the conditions reading a changed message
+        for i in range(0, len(message_ids), CHUNK_SIZE):
+            rows = db.execute(select(ConditionNode.workflow_id, ConditionNode.id).where(ConditionNode.message_node_id.in_(message_ids[i:i + CHUNK_SIZE])))
+            for workflow_id, condition_id in rows:
+                dependents.setdefault(workflow_id, set()).add(condition_id)
+        if not dependents:
+            return 0
+
+        stored = {}
+        workflow_ids = list(dependents)
+        for i in range(0, len(workflow_ids), CHUNK_SIZE):
+            rows = db.execute(
+                select(WorkflowResult.workflow_id, WorkflowResult.success_path)
+                .join(Workflow, Workflow.id == WorkflowResult.workflow_id)
+                .where(WorkflowResult.workflow_id.in_(workflow_ids[i:i + CHUNK_SIZE]), WorkflowResult.version == Workflow.version)
+            )
+            stored.update(rows.all())
+        if not stored:
+            return 0
+
+        plans = PlanService.get_plans(db, list(stored))
+        checked_ids = list({message_id for plan in plans.values() if not isinstance(plan, HTTPException) for message_id in plan.message_ids})
+        statuses = {}
+        for i in range(0, len(checked_ids), CHUNK_SIZE):
+            statuses.update(db.execute(select(MessageNode.id, MessageNode.status).where(MessageNode.id.in_(checked_ids[i:i + CHUNK_SIZE]))).all())
+
+        changed = 0
+        for workflow_id, path in stored.items():
+            plan = plans[workflow_id]
+            try:
+                if isinstance(plan, HTTPException):
+                    raise plan
+                new_path = patch_path(plan, path, dependents[workflow_id], statuses)
+            except (HTTPException, WalkError):
+                # the workflow can`t be run anymore, the error is reported by the next read
+                db.execute(delete(WorkflowResult).where(WorkflowResult.workflow_id == workflow_id))
+                changed += 1
+                continue
+            if new_path is not None:
+                db.query(WorkflowResult).filter(WorkflowResult.workflow_id == workflow_id).update({WorkflowResult.success_path: new_path}, synchronize_session=False)
+                changed += 1
+        return changed
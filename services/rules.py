@@ -0,0 +1,73 @@
+import re
+from functools import lru_cache
+import rule_engine
+from config import settings
+
+RULE_CACHE_SIZE = settings.rule_cache_size
+
+# conditions are evaluated against {'status': <message node status>} only
+RULE_CONTEXT = rule_engine.Context(type_resolver=rule_engine.type_resolver_from_dict({
+    'status': rule_engine.DataType.STRING,
+}))
+
+_STRING = r"""(?:'[^'\\]*'|"[^"\\]*")"""
+_EQUALITY = re.compile(rf"""^\s*status\s*(?P<operator>==|!=)\s*(?P<value>{_STRING})\s*$""")
+_MEMBERSHIP = re.compile(rf"""^\s*status\s+(?P<operator>not\s+in|in)\s*\[\s*(?P<values>{_STRING}(?:\s*,\s*{_STRING})*)?\s*,?\s*\]\s*$""")
+
+
+def _fast_predicate(condition: str):
+    """
+    Turns simple equality and membership rules on `status` into plain Python predicates.
+    Returns None for any other rule.
+    """
+    match = _EQUALITY.match(condition)
+    if match:
+        value = match.group('value')[1:-1]
+        if match.group('operator') == '==':
+            return lambda status: status == value
+        return lambda status: status != value
+
+    match = _MEMBERSHIP.match(condition)
+    if match:
+        values = frozenset(item[1:-1] for item in re.findall(_STRING, match.group('values') or ''))
+        if match.group('operator') == 'in':
+            return lambda status: status in values
+        return lambda status: status not in values
+
+    return None
+
+
+@lru_cache(maxsize=RULE_CACHE_SIZE)
+def compile_rule(condition: str):
+    """
+    Compiles a condition into a predicate taking the status of a message node.
+    Results are memoized by condition text.
+
+    Raises:
+        ValueError: If the condition isn`t a valid rule.
+    """
+    if not isinstance(condition, str):
+        raise ValueError("Rule error")
+
+    predicate = _fast_predicate(condition)
+    if predicate:
+        return predicate
+
+    try:
+        rule = rule_engine.Rule(condition, context=RULE_CONTEXT)
+    except rule_engine.EngineError as e:
+        raise ValueError(f"Rule error: {e.message}")
+
+    def predicate(status):
+        try:
+            return bool(rule.matches({'status': status}))
+        except rule_engine.EngineError:
+            raise ValueError("Rule error")
+    return predicate
+
+
+def match_condition(condition: str, status) -> bool:
+    """
+    Checks a condition rule against the status of a message node.
+    """
+    return compile_rule(condition)(str(status))
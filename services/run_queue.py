@@ -0,0 +1,201 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import insert, update, delete
+from sqlalchemy.orm import Session
+from models.workflow import RunJob
+from database import SessionLocal, ReadSessionLocal
+from services.workflow import WorkflowServices
+from services.write_queue import run_write
+from config import settings
+
+FINISHED_STATUSES = ('done', 'failed')
+# interval of the database polls waiting for a job of another worker process
+POLL_INTERVAL = 0.05
+
+
+def add_job(db: Session, values: dict) -> dict:
+    db.execute(insert(RunJob).values(**values))
+    db.commit()
+    return values
+
+
+def set_job(db: Session, job_id: str, values: dict):
+    db.execute(update(RunJob).where(RunJob.id == job_id).values(**values))
+    db.commit()
+
+
+def purge_jobs(db: Session, finished_before: float) -> int:
+    deleted = db.execute(delete(RunJob).where(RunJob.finished_at < finished_before)).rowcount
+    db.commit()
+    return deleted
+
+
+def execute_job(job_id: str, workflow_id: int, audience: bool):
+    """
+    Runs a queued job and stores its outcome. Called in a pool thread or process, with its own sessions.
+    """
+    with SessionLocal() as db:
+        run_write(db, set_job, job_id=job_id, values={'status': 'running'})
+    try:
+        with ReadSessionLocal() as db:
+            values = {'status': 'done', 'result': WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow_id, audience=audience)}
+    except HTTPException as e:
+        values = {'status': 'failed', 'status_code': e.status_code, 'error': e.detail}
+    except Exception as e:
+        values = {'status': 'failed', 'status_code': 500, 'error': str(e)}
+    values['finished_at'] = time.time()
+    with SessionLocal() as db:
+        run_write(db, set_job, job_id=job_id, values=values)
+
+
+class RunQueue:
+    """
+    Local queue of workflow runs served by a bounded thread or process pool. Submitting a run returns
+    at once, the job state and result are kept in the run_jobs table until `ttl` seconds after the run
+    finished, so they can be polled from any worker process.
+
+    A process accepts at most `max_size` unfinished jobs, submitting more fails with 429.
+    """
+
+    def __init__(self, executor: str = 'thread', workers: int = 2, max_size: int = 1000, ttl: float = 300):
+        if executor not in ('thread', 'process'):
+            raise ValueError(f"Unknown run queue executor {executor!r}")
+        self.executor = executor
+        self.workers = workers
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._pool = None
+        self._futures = {}  # job id -> future of the unfinished jobs of this process
+        self._lock = threading.Lock()
+        self._last_purge = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.executor == 'process':
+                # spawned processes don`t inherit the pooled database connections of the parent
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='run-queue')
+        return self._pool
+
+    def submit(self, db: Session, workflow_id: int, audience: bool = False) -> dict:
+        """
+        Queues a run of the workflow.
+
+        Returns:
+            dict: The queued job.
+
+        Raises:
+            HTTPException: 429 if the queue is full.
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            if len(self._futures) >= self.max_size:
+                self.rejected += 1
+                raise HTTPException(status_code=429, detail="Error. Run queue is full.", headers={'Retry-After': '1'})
+            # the slot is taken before the job is stored
+            self._futures[job_id] = None
+            self.submitted += 1
+
+        try:
+            self.purge(db)
+            job = run_write(db, add_job, values={
+                'id': job_id,
+                'workflow_id': workflow_id,
+                'audience': audience,
+                'status': 'queued',
+                'created_at': time.time(),
+            })
+            try:
+                future = self._get_pool().submit(execute_job, job_id, workflow_id, audience)
+            except BrokenExecutor:
+                # a pool process was killed, the pool is replaced
+                self._pool = None
+                future = self._get_pool().submit(execute_job, job_id, workflow_id, audience)
+        except BaseException:
+            with self._lock:
+                del self._futures[job_id]
+            raise
+        with self._lock:
+            self._futures[job_id] = future
+        future.add_done_callback(lambda future: self._finished(job_id, future))
+        return job
+
+    def _finished(self, job_id: str, future):
+        with self._lock:
+            self._futures.pop(job_id, None)
+            self.completed += 1
+        # the job couldn`t store its outcome: cancelled, or its process died
+        error = 'Run cancelled.' if future.cancelled() else future.exception()
+        if error is not None:
+            values = {'status': 'failed', 'status_code': 500, 'error': str(error), 'finished_at': time.time()}
+            with SessionLocal() as db:
+                run_write(db, set_job, job_id=job_id, values=values)
+
+    def get(self, db: Session, job_id: str) -> dict:
+        """
+        Raises:
+            HTTPException: 404 if the job doesn`t exist or its result has expired.
+        """
+        job = db.query(RunJob).filter(RunJob.id == job_id).first()
+        if job is None or (job.finished_at is not None and job.finished_at < time.time() - self.ttl):
+            raise HTTPException(status_code=404, detail="Run job not found.")
+        return {column.name: getattr(job, column.name) for column in RunJob.__table__.columns}
+
+    def read(self, job_id: str) -> dict:
+        with ReadSessionLocal() as db:
+            return self.get(db, job_id)
+
+    async def wait(self, job_id: str, timeout: float) -> dict:
+        """
+        Returns the job once it is finished or the timeout has expired. Jobs of this process are awaited,
+        jobs submitted to other worker processes are polled in the database. Reads use their own
+        sessions, a request session would keep a connection for the whole wait.
+        """
+        deadline = time.monotonic() + timeout
+        future = self._futures.get(job_id)
+        if future is not None and timeout > 0:
+            await asyncio.wait([asyncio.wrap_future(future)], timeout=timeout)
+        while True:
+            job = await run_in_threadpool(self.read, job_id)
+            if job['status'] in FINISHED_STATUSES or time.monotonic() >= deadline:
+                return job
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def purge(self, db: Session, force: bool = False):
+        """
+        Deletes the expired jobs, at most once in a while unless forced.
+        """
+        now = time.time()
+        if force or now - self._last_purge >= min(self.ttl, 60):
+            self._last_purge = now
+            run_write(db, purge_jobs, finished_before=now - self.ttl)
+
+    def stats(self) -> dict:
+        return {
+            'executor': self.executor,
+            'workers': self.workers,
+            'max_size': self.max_size,
+            'pending': len(self._futures),
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'completed': self.completed,
+        }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+run_queue = RunQueue(settings.run_queue_executor, settings.run_queue_workers, settings.run_queue_max_size, settings.run_result_ttl)
@@ -0,0 +1,371 @@
+import struct
+import sys
+import zlib
+from array import array
+from fastapi import HTTPException
+from sqlalchemy import select, func, union_all
+from sqlalchemy.orm import Session
+from database import ReadSessionLocal
+from models.workflow import Workflow, Node, StartNode, MessageNode, ConditionNode, EndNode, MESSAGE_STATUSES
+from services.executor import START, MESSAGE, CONDITION, END, KINDS
+from services.graph import WorkflowGraph
+from services.plan import ExecutionPlan, compile_plan
+from config import settings
+
+SNAPSHOT_CHUNK_SIZE = settings.snapshot_chunk_size
+MEDIA_TYPE = 'application/vnd.workflow-snapshot'
+
+MAGIC = b'WFSN'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHqqI')  # magic, format version, flags, workflow id, workflow version, name length
+BLOCK = struct.Struct('<II')  # nodes, new strings
+TRAILER = struct.Struct('<II')  # nodes, CRC-32 of everything before
+
+# (array type, column) in the order of the columns of a block
+COLUMNS = (
+    ('q', 'ids'),
+    ('b', 'kinds'),
+    ('b', 'statuses'),  # 0 for none, else 1 + position in MESSAGE_STATUSES
+    ('i', 'texts'),  # message text or condition, index in the string table, -1 for none
+    ('q', 'next'),  # edge targets and the message checked by a condition, 0 for none
+    ('q', 'yes'),
+    ('q', 'no'),
+    ('q', 'messages'),
+)
+NODE_SIZE = sum(array(code).itemsize for code, _ in COLUMNS)
+LENGTH_SIZE = array('I').itemsize
+KIND_NAMES = {kind: name for name, kind in KINDS.items()}
+BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def to_bytes(values: array) -> bytes:
+    if BIG_ENDIAN:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def from_bytes(code: str, data) -> array:
+    values = array(code)
+    values.frombytes(data)
+    if BIG_ENDIAN:
+        values.byteswap()
+    return values
+
+
+class SnapshotWriter:
+    """
+    Encodes a workflow snapshot: a header, blocks of up to a chunk of nodes stored column by column,
+    and a trailer with the number of nodes and a checksum. Strings are interned: every distinct
+    message text and condition is stored once, in the block where it first appears, and referenced
+    by its index. Blocks are encoded as the nodes are read, the snapshot is never held in memory.
+    """
+
+    def __init__(self):
+        self.strings = {}
+        self.count = 0
+        self.crc = 0
+
+    def _out(self, data: bytes) -> bytes:
+        self.crc = zlib.crc32(data, self.crc)
+        return data
+
+    def header(self, workflow_id: int, version: int, name: str) -> bytes:
+        name = (name or '').encode()
+        return self._out(HEADER.pack(MAGIC, FORMAT_VERSION, 0, workflow_id, version, len(name)) + name)
+
+    def intern(self, value, new: list) -> int:
+        if value is None:
+            return -1
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+            new.append(value.encode())
+        return index
+
+    def block(self, rows) -> bytes:
+        """
+        Args:
+            rows: (id, node type, next id, yes id, no id, message text, status, condition, message node id) tuples.
+        """
+        columns = {name: array(code) for code, name in COLUMNS}
+        new = []
+        for node_id, node_type, next_id, yes_id, no_id, message_text, status, condition, message_id in rows:
+            columns['ids'].append(node_id)
+            columns['kinds'].append(KINDS[node_type])
+            columns['statuses'].append(MESSAGE_STATUSES.index(status) + 1 if status else 0)
+            columns['texts'].append(self.intern(message_text if node_type == 'message' else condition, new))
+            columns['next'].append(next_id or 0)
+            columns['yes'].append(yes_id or 0)
+            columns['no'].append(no_id or 0)
+            columns['messages'].append(message_id or 0)
+        self.count += len(columns['ids'])
+        parts = [BLOCK.pack(len(columns['ids']), len(new)), to_bytes(array('I', map(len, new))), *new]
+        parts.extend(to_bytes(columns[name]) for _, name in COLUMNS)
+        return self._out(b''.join(parts))
+
+    def end(self) -> bytes:
+        data = self._out(BLOCK.pack(0, 0))
+        return data + TRAILER.pack(self.count, self.crc)
+
+
+class SnapshotReader:
+    """
+    Incremental decoder of snapshots: bytes are fed as they arrive, decoded blocks are returned as soon
+    as they are complete.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.header = None  # (workflow id, version, name)
+        self.strings = []
+        self.count = 0
+        self.crc = 0
+        self.finished = False
+
+    def feed(self, data: bytes) -> list:
+        """
+        Returns the blocks completed by the data, as dicts of column arrays.
+
+        Raises:
+            HTTPException: If the data isn`t a valid snapshot.
+        """
+        if self.finished and data:
+            raise HTTPException(status_code=400, detail="Error. Unexpected data after the end of the snapshot.")
+        self.buffer += data
+        blocks = []
+        while not self.finished:
+            block = self._parse()
+            if block is None:
+                break
+            if block['ids']:
+                blocks.append(block)
+        return blocks
+
+    def close(self):
+        """
+        Raises:
+            HTTPException: If the snapshot is truncated.
+        """
+        if not self.finished or self.buffer:
+            raise HTTPException(status_code=400, detail="Error. The snapshot is truncated.")
+
+    def _consume(self, size: int) -> bytes:
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def _parse(self):
+        if self.header is None:
+            if len(self.buffer) < HEADER.size:
+                return None
+            magic, version, _, workflow_id, workflow_version, name_length = HEADER.unpack_from(self.buffer)
+            if magic != MAGIC:
+                raise HTTPException(status_code=400, detail="Error. Not a workflow snapshot.")
+            if version != FORMAT_VERSION:
+                raise HTTPException(status_code=400, detail=f"Error. Unsupported snapshot version {version}.")
+            if len(self.buffer) < HEADER.size + name_length:
+                return None
+            data = self._consume(HEADER.size + name_length)
+            self.crc = zlib.crc32(data)
+            self.header = (workflow_id, workflow_version, data[HEADER.size:].decode())
+            return {'ids': ()}
+
+        if len(self.buffer) < BLOCK.size:
+            return None
+        count, string_count = BLOCK.unpack_from(self.buffer)
+        if not count and not string_count:
+            if len(self.buffer) < BLOCK.size + TRAILER.size:
+                return None
+            self.crc = zlib.crc32(self._consume(BLOCK.size), self.crc)
+            total, crc = TRAILER.unpack(self._consume(TRAILER.size))
+            if total != self.count or crc != self.crc:
+                raise HTTPException(status_code=400, detail="Error. The snapshot is corrupted.")
+            self.finished = True
+            return None
+
+        lengths_end = BLOCK.size + LENGTH_SIZE * string_count
+        if len(self.buffer) < lengths_end:
+            return None
+        lengths = from_bytes('I', self.buffer[BLOCK.size:lengths_end])
+        size = lengths_end + sum(lengths) + count * NODE_SIZE
+        if len(self.buffer) < size:
+            return None
+        data = memoryview(self._consume(size))
+        self.crc = zlib.crc32(data, self.crc)
+
+        position = lengths_end
+        try:
+            for length in lengths:
+                self.strings.append(str(data[position:position + length], 'utf-8'))
+                position += length
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="Error. The snapshot has an invalid string.")
+        block = {}
+        for code, name in COLUMNS:
+            end = position + count * array(code).itemsize
+            block[name] = from_bytes(code, data[position:end])
+            position = end
+        self._check(block)
+        self.count += count
+        return block
+
+    def _check(self, block: dict):
+        """
+        Raises:
+            HTTPException: If a node of the block has an unknown type or status, or references a missing string.
+        """
+        if not block['ids']:
+            return
+        unknown = set(block['kinds']) - KIND_NAMES.keys()
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Error. The snapshot has an unknown node type {min(unknown)}.")
+        if min(block['statuses']) < 0 or max(block['statuses']) > len(MESSAGE_STATUSES):
+            raise HTTPException(status_code=400, detail="Error. The snapshot has an unknown message status.")
+        if min(block['texts']) < -1 or max(block['texts']) >= len(self.strings):
+            raise HTTPException(status_code=400, detail="Error. The snapshot references a missing string.")
+
+
+def snapshot_rows_statement(workflow_id: int):
+    nodes = Node.__table__
+    starts = StartNode.__table__
+    messages = MessageNode.__table__
+    conditions = ConditionNode.__table__
+    return (
+        select(
+            nodes.c.id, nodes.c.node_type, func.coalesce(starts.c.next_node_id, messages.c.next_node_id), conditions.c.yes_node_id, conditions.c.no_node_id,
+            messages.c.message_text, messages.c.status, conditions.c.condition, conditions.c.message_node_id,
+        )
+        .select_from(
+            nodes.outerjoin(starts, starts.c.id == nodes.c.id)
+            .outerjoin(messages, messages.c.id == nodes.c.id)
+            .outerjoin(conditions, conditions.c.id == nodes.c.id)
+        )
+        .where(nodes.c.workflow_id == workflow_id)
+        .order_by(nodes.c.id)
+    )
+
+
+class SnapshotService:
+    """
+    Exports workflows as binary snapshots, and reads them back for imports and for runs that don`t
+    touch the database.
+    """
+
+    def export_snapshot(db: Session, workflow_id: int):
+        """
+        Checks that the workflow can be exported and returns the generator of the snapshot bytes.
+        The nodes are streamed chunk by chunk from a single query, in a session of the generator.
+
+        Raises:
+            HTTPException: If the workflow doesn`t exist, has no nodes or has edges to nodes of other workflows.
+        """
+        if db.scalar(select(Workflow.id).where(Workflow.id == workflow_id)) is None:
+            raise HTTPException(status_code=404, detail="Workflow not found.")
+        # a workflow without nodes has no start node, it couldn`t be imported back
+        if db.scalar(select(Node.id).where(Node.workflow_id == workflow_id).limit(1)) is None:
+            raise HTTPException(status_code=400, detail="Error. Workflows without nodes can`t be exported.")
+
+        nodes = Node.__table__
+        starts = StartNode.__table__
+        messages = MessageNode.__table__
+        conditions = ConditionNode.__table__
+        own_ids = select(nodes.c.id).where(nodes.c.workflow_id == workflow_id)
+        targets = union_all(
+            select(starts.c.next_node_id.label('target')).where(starts.c.id.in_(own_ids)),
+            select(messages.c.next_node_id).where(messages.c.id.in_(own_ids)),
+            select(conditions.c.yes_node_id).where(conditions.c.id.in_(own_ids)),
+            select(conditions.c.no_node_id).where(conditions.c.id.in_(own_ids)),
+        ).subquery()
+        external = select(targets.c.target).where(targets.c.target.is_not(None), targets.c.target.not_in(own_ids)).limit(1)
+        if db.scalar(external) is not None:
+            raise HTTPException(status_code=400, detail="Error. Workflows with edges to other workflows can`t be exported.")
+        return SnapshotService.iter_snapshot(workflow_id)
+
+    def iter_snapshot(workflow_id: int):
+        writer = SnapshotWriter()
+        with ReadSessionLocal() as db:
+            workflow = db.execute(select(Workflow.id, Workflow.version, Workflow.name).where(Workflow.id == workflow_id)).first()
+            if workflow is None:
+                return
+            yield writer.header(workflow.id, workflow.version, workflow.name)
+            result = db.execute(snapshot_rows_statement(workflow_id).execution_options(yield_per=SNAPSHOT_CHUNK_SIZE))
+            for rows in result.partitions():
+                yield writer.block(rows)
+        yield writer.end()
+
+    def import_lines(reader: SnapshotReader, block: dict) -> list:
+        """
+        Converts a block to the node lines of GraphImport, nodes referenced by their snapshot ids.
+        """
+        strings = reader.strings
+        lines = []
+        for node_id, kind, status, text, next_id, yes_id, no_id in zip(block['ids'], block['kinds'], block['statuses'], block['texts'], block['next'], block['yes'], block['no']):
+            line = {'ref': node_id, 'node_type': KIND_NAMES[kind]}
+            if kind == MESSAGE:
+                line['message_text'] = strings[text] if text >= 0 else None
+                line['status'] = MESSAGE_STATUSES[status - 1] if status else None
+                line['next'] = next_id or None
+            elif kind == START:
+                line['next'] = next_id or None
+            elif kind == CONDITION:
+                line['condition'] = strings[text] if text >= 0 else None
+                line['yes'] = yes_id or None
+                line['no'] = no_id or None
+            lines.append(line)
+        return lines
+
+    def read_import_lines(reader: SnapshotReader, file, chunk_size: int = 64 * 1024):
+        """
+        Decodes a snapshot file block by block, yielding the node lines of GraphImport.
+
+        Raises:
+            HTTPException: If the file isn`t a valid snapshot.
+        """
+        for data in iter(lambda: file.read(chunk_size), b''):
+            for block in reader.feed(data):
+                yield from SnapshotService.import_lines(reader, block)
+        reader.close()
+
+    def load_snapshot(data) -> tuple:
+        """
+        Decodes a whole snapshot into a workflow graph of detached nodes.
+
+        Returns:
+            tuple: (WorkflowGraph, workflow version, message node id -> status)
+        """
+        reader = SnapshotReader()
+        nodes = []
+        statuses = {}
+        for block in reader.feed(data):
+            strings = reader.strings
+            for node_id, kind, status, text, next_id, yes_id, no_id, message_id in zip(*(block[name] for _, name in COLUMNS)):
+                if kind == START:
+                    node = StartNode(id=node_id, next_node_id=next_id or None)
+                elif kind == MESSAGE:
+                    status = MESSAGE_STATUSES[status - 1] if status else None
+                    node = MessageNode(id=node_id, message_text=strings[text] if text >= 0 else None, status=status, next_node_id=next_id or None)
+                    statuses[node_id] = status
+                elif kind == CONDITION:
+                    node = ConditionNode(id=node_id, condition=strings[text] if text >= 0 else None, yes_node_id=yes_id or None, no_node_id=no_id or None, message_node_id=message_id or None)
+                else:
+                    node = EndNode(id=node_id)
+                nodes.append(node)
+        reader.close()
+        workflow_id, version, name = reader.header
+        return WorkflowGraph(Workflow(id=workflow_id, name=name, version=version), nodes), version, statuses
+
+    def run_snapshot(data, statuses: dict = None, edges: bool = True) -> dict:
+        """
+        Runs the workflow of a snapshot without the database, for what-if evaluations: `statuses`
+        (message node id -> status) replace the statuses stored in the snapshot.
+
+        Raises:
+            HTTPException: If the snapshot is invalid or its workflow structure is.
+        """
+        graph, version, stored_statuses = SnapshotService.load_snapshot(data)
+        plan: ExecutionPlan = compile_plan(graph, version)
+        for node_id in statuses or {}:
+            if node_id not in stored_statuses:
+                raise HTTPException(status_code=400, detail=f"Error. Message node {node_id} is not in the snapshot.")
+        return plan.execute({**stored_statuses, **(statuses or {})}, edges=edges)
@@ -0,0 +1,365 @@
+import threading
+from collections import OrderedDict, deque
+from fastapi import HTTPException
+from sqlalchemy import select, func, event
+from sqlalchemy.orm import Session
+from models.workflow import Workflow, Node, StartNode, MessageNode, ConditionNode
+from config import settings
+
+TOPOLOGY_CACHE_SIZE = settings.plan_cache_size
+
+
+class CycleFound(Exception):
+    def __init__(self, node_id: int):
+        super().__init__(node_id)
+        self.node_id = node_id
+
+
+class WorkflowTopology:
+    """
+    Edges of one workflow kept in an online topological order (Pearce-Kelly). Adding an edge that
+    agrees with the order costs O(1), otherwise only the nodes placed between its ends are visited
+    and reordered, and an edge closing a cycle is found on the way.
+
+    Edges to ids that are not nodes of the workflow (other workflows, nodes not created yet) are kept
+    aside as dangling, they join the graph when a node with that id is added.
+    """
+
+    def __init__(self, version: int, kinds: dict, edges: list):
+        """
+        Args:
+            version (int): Workflow version the topology is built for.
+            kinds (dict): Node id -> node type of the nodes of the workflow.
+            edges (list): (source id, target id) edges going out of the workflow nodes.
+        """
+        self.version = version
+        self.next_version = None
+        self.kinds = dict(kinds)
+        # successors include dangling targets, predecessors only nodes of the workflow
+        self.successors = {node_id: {} for node_id in kinds}
+        self.predecessors = {node_id: {} for node_id in kinds}
+        self.dangling = {}
+        for source, target in edges:
+            self._link(source, target)
+
+        # Kahn`s algorithm, nodes left out of the order are on a cycle
+        self.order = {}
+        indegree = {node_id: len(predecessors) for node_id, predecessors in self.predecessors.items()}
+        queue = deque(node_id for node_id, degree in indegree.items() if degree == 0)
+        while queue:
+            node_id = queue.popleft()
+            self.order[node_id] = len(self.order)
+            for target in self.successors[node_id]:
+                if target in indegree:
+                    indegree[target] -= 1
+                    if not indegree[target]:
+                        queue.append(target)
+        # workflows saved before the write-time validation may already contain a cycle,
+        # cycles are not looked for in them until the topology is rebuilt without one
+        self.acyclic = len(self.order) == len(self.kinds)
+        if not self.acyclic:
+            for node_id in self.kinds:
+                self.order.setdefault(node_id, len(self.order))
+        self.next_position = len(self.order)
+
+    def _link(self, source: int, target: int):
+        successors = self.successors[source]
+        successors[target] = successors.get(target, 0) + 1
+        sources = self.predecessors[target] if target in self.kinds else self.dangling.setdefault(target, {})
+        sources[source] = sources.get(source, 0) + 1
+
+    def add_edge(self, source: int, target: int):
+        """
+        Raises:
+            CycleFound: If the edge closes a cycle. The edge is not added.
+        """
+        if target in self.kinds and self.acyclic:
+            if source == target:
+                raise CycleFound(source)
+            lower, upper = self.order[target], self.order[source]
+            if lower < upper:
+                forward = self._search(target, self.successors, lambda position: position < upper, source)
+                backward = self._search(source, self.predecessors, lambda position: position > lower)
+                self._reorder(backward, forward)
+        self._link(source, target)
+
+    def remove_edge(self, source: int, target: int):
+        successors = self.successors[source]
+        if target not in successors:
+            return
+        sources = self.predecessors[target] if target in self.kinds else self.dangling[target]
+        for edges, key in ((successors, target), (sources, source)):
+            if edges[key] > 1:
+                edges[key] -= 1
+            else:
+                del edges[key]
+        if target in self.dangling and not self.dangling[target]:
+            del self.dangling[target]
+
+    def add_node(self, node_id: int, node_type: str) -> list:
+        """
+        Adds a node without edges. The dangling edges pointing to its id are detached and returned,
+        to be added back with add_edge.
+        """
+        self.kinds[node_id] = node_type
+        self.successors[node_id] = {}
+        self.predecessors[node_id] = {}
+        # a node without edges can take any place in the order, the positions only need to be distinct
+        self.order[node_id] = self.next_position
+        self.next_position += 1
+
+        sources = self.dangling.pop(node_id, {})
+        for source, count in sources.items():
+            del self.successors[source][node_id]
+        return [source for source, count in sources.items() for _ in range(count)]
+
+    def remove_node(self, node_id: int):
+        """
+        Removes a node with its outgoing edges, the edges pointing to it become dangling.
+        """
+        for target in list(self.successors[node_id]):
+            while target in self.successors[node_id]:
+                self.remove_edge(node_id, target)
+        del self.successors[node_id]
+        sources = self.predecessors.pop(node_id)
+        if sources:
+            self.dangling[node_id] = sources
+        del self.kinds[node_id]
+        del self.order[node_id]
+
+    def _search(self, start: int, edges: dict, bound, forbidden: int = None) -> list:
+        seen = {start}
+        stack = [start]
+        while stack:
+            for next_id in edges[stack.pop()]:
+                if next_id == forbidden:
+                    raise CycleFound(next_id)
+                if next_id not in seen and next_id in self.order and bound(self.order[next_id]):
+                    seen.add(next_id)
+                    stack.append(next_id)
+        return list(seen)
+
+    def _reorder(self, backward: list, forward: list):
+        # the nodes reaching the source move before the nodes reachable from the target,
+        # both groups keep their relative order and reuse the same positions
+        nodes = sorted(backward, key=self.order.get) + sorted(forward, key=self.order.get)
+        positions = sorted(self.order[node_id] for node_id in nodes)
+        for node_id, position in zip(nodes, positions):
+            self.order[node_id] = position
+
+
+class TopologyCache:
+    """
+    Bounded LRU cache of workflow topologies. A topology is only used for the workflow version
+    it was built for, so changes made by other workers cause a rebuild.
+
+    Topologies are mutated in place by the writes, so a writer takes the topology out of the cache
+    and puts it back once its change is done: two writers of the same workflow never share one,
+    the second builds its own from the database, whatever the number of writer connections.
+    """
+
+    def __init__(self, maxsize: int = TOPOLOGY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._topologies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, workflow_id: int, version: int):
+        """
+        Removes the topology from the cache and returns it, None if there is none for the version.
+        """
+        with self._lock:
+            topology = self._topologies.pop(workflow_id, None)
+            if topology is None or topology.version != version:
+                return None
+            return topology
+
+    def put(self, workflow_id: int, topology: WorkflowTopology):
+        with self._lock:
+            self._topologies[workflow_id] = topology
+            self._topologies.move_to_end(workflow_id)
+            while len(self._topologies) > self.maxsize:
+                self._topologies.popitem(last=False)
+
+    def invalidate(self, *workflow_ids: int):
+        with self._lock:
+            for workflow_id in workflow_ids:
+                self._topologies.pop(workflow_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._topologies.clear()
+
+
+topology_cache = TopologyCache()
+
+
+def node_edges_statement(workflow_id: int):
+    """
+    Returns the query of (id, node_type, next_node_id, yes_node_id, no_node_id) of the workflow nodes.
+    """
+    nodes = Node.__table__
+    starts = StartNode.__table__
+    messages = MessageNode.__table__
+    conditions = ConditionNode.__table__
+    return (
+        select(nodes.c.id, nodes.c.node_type, func.coalesce(starts.c.next_node_id, messages.c.next_node_id), conditions.c.yes_node_id, conditions.c.no_node_id)
+        .select_from(
+            nodes.outerjoin(starts, starts.c.id == nodes.c.id)
+            .outerjoin(messages, messages.c.id == nodes.c.id)
+            .outerjoin(conditions, conditions.c.id == nodes.c.id)
+        )
+        .where(nodes.c.workflow_id == workflow_id)
+    )
+
+
+def check_edge(source_type: str, target_type: str):
+    """
+    Raises:
+        HTTPException: If an edge between nodes of these types is not allowed.
+    """
+    if target_type == 'start':
+        raise HTTPException(status_code=400, detail="Error. Start node couldn`t have any previous nodes.")
+    if source_type == 'start' and target_type == 'condition':
+        raise HTTPException(status_code=400, detail="Error. Condition node could be reached through Message or Condition node")
+
+
+class ValidationService:
+    """
+    Checks the structural rules of a workflow when its nodes are written, so that invalid edits are
+    rejected at once: nothing points to the start node, no condition right after the start node
+    and no cycles. Only edges between nodes of the same workflow are checked.
+
+    Every change goes through the cached topology of the workflow, so its cost depends on the part
+    of the graph the changed edges reorder, not on the workflow size.
+    """
+
+    def get_topology(db: Session, workflow_id: int):
+        """
+        Takes the topology of the current workflow version out of the cache, built with one query on a miss.
+        It is cached again by `committed`. None if the workflow doesn`t exist.
+        """
+        version = db.query(Workflow.version).filter(Workflow.id == workflow_id).scalar()
+        if version is None:
+            return None
+        topology = topology_cache.take(workflow_id, version)
+        if topology is None:
+            topology = ValidationService.build_topology(db, workflow_id, version)
+        return topology
+
+    def build_topology(db: Session, workflow_id: int, version: int) -> WorkflowTopology:
+        kinds = {}
+        edges = []
+        for node_id, node_type, next_id, yes_id, no_id in db.execute(node_edges_statement(workflow_id)):
+            kinds[node_id] = node_type
+            edges.extend((node_id, target) for target in (next_id, yes_id, no_id) if target is not None)
+        return WorkflowTopology(version, kinds, edges)
+
+    def check_acyclic(db: Session, workflow_id: int):
+        """
+        Checks a whole workflow for cycles, for workflows written without going through the nodes.
+
+        Raises:
+            HTTPException: If the workflow has a cycle.
+        """
+        if not ValidationService.build_topology(db, workflow_id, None).acyclic:
+            raise HTTPException(status_code=400, detail="Error. Sequence has a cycle.")
+
+    def add_node(topology: WorkflowTopology, node_id: int, node_type: str, targets: list):
+        """
+        Adds a created node, or a node moved from another workflow, with its edges.
+
+        Raises:
+            HTTPException: If the node breaks a structural rule. The workflow topology is not cached again.
+        """
+        if topology is None:
+            return
+        ValidationService._change(topology)
+        for source in topology.add_node(node_id, node_type):
+            check_edge(topology.kinds[source], node_type)
+            ValidationService._add_edge(topology, source, node_id)
+        for target in targets:
+            ValidationService._add_edge(topology, node_id, target)
+
+    def update_edges(topology: WorkflowTopology, node_id: int, old_targets: list, targets: list):
+        """
+        Replaces the edges going out of a node.
+
+        Raises:
+            HTTPException: If a new edge breaks a structural rule. The workflow topology is not cached again.
+        """
+        if topology is None or node_id not in topology.kinds:
+            return
+        ValidationService._change(topology)
+        for target in old_targets:
+            if target is not None:
+                topology.remove_edge(node_id, target)
+        for target in targets:
+            ValidationService._add_edge(topology, node_id, target)
+
+    def remove_node(topology: WorkflowTopology, node_id: int):
+        """
+        Removes a deleted node, or a node moved to another workflow. Removing a node never breaks a rule.
+        """
+        if topology is None or node_id not in topology.kinds:
+            return
+        ValidationService._change(topology)
+        topology.remove_node(node_id)
+
+    def committed(db: Session, workflow_id: int, topology: WorkflowTopology):
+        """
+        Marks a changed topology as matching the workflow version, called after the version bump
+        of the change. It is cached again once the session commits, a rolled back change never reaches
+        the cache. If another writer changed the workflow meanwhile, it is dropped and rebuilt on next use.
+        """
+        if topology is None:
+            return
+        if topology.next_version is not None:
+            version = db.query(Workflow.version).filter(Workflow.id == workflow_id).scalar()
+            next_version, topology.next_version = topology.next_version, None
+            if version != next_version:
+                return
+            topology.version = version
+        transaction = db.get_nested_transaction() or db.get_transaction()
+        db.info.setdefault('topologies', []).append((transaction, workflow_id, topology))
+
+    def _change(topology: WorkflowTopology):
+        # the topology is ahead of the database until the change is committed
+        if topology.version is not None:
+            topology.next_version = topology.version + 1
+            topology.version = None
+
+    def _add_edge(topology: WorkflowTopology, source: int, target: int):
+        if target is None:
+            return
+        if target in topology.kinds:
+            check_edge(topology.kinds[source], topology.kinds[target])
+        try:
+            topology.add_edge(source, target)
+        except CycleFound as e:
+            raise HTTPException(status_code=400, detail=f"Error. Sequence has a cycle at node {e.node_id}.")
+
+
+@event.listens_for(Session, 'after_commit')
+def cache_committed(db: Session):
+    # also called when a savepoint is released, the topologies wait for the real commit
+    if db.in_nested_transaction():
+        return
+    for _, workflow_id, topology in db.info.pop('topologies', ()):
+        topology_cache.put(workflow_id, topology)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_rolled_back(db: Session, previous_transaction):
+    # a rolled back savepoint of the group commit drops only the topologies staged in it
+    staged = db.info.get('topologies')
+    if not staged:
+        return
+
+    def rolled_back(transaction):
+        while transaction is not None:
+            if transaction is previous_transaction:
+                return True
+            transaction = transaction.parent
+        return False
+
+    db.info['topologies'] = [item for item in staged if not rolled_back(item[0])]
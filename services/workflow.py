@@ -1,9 +1,19 @@
+import time
 from fastapi import HTTPException, Depends
-import networkx as nx
-from models.workflow import Workflow, StartNode, EndNode, MessageNode, ConditionNode
+from models.workflow import Workflow, MessageNode
 from schemas.workflow import *
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from database import get_db
+from config import settings
+from database import get_db, ReadSessionLocal
+from services.graph import GraphService
+from services.plan import PlanService, plan_cache
+from services.audience import AudienceService
+from services.write_queue import write_queue
+from services.history import history_writer
+from services.cache import read_cache, workflow_key, deleted_keys
+from services.etag import workflow_etag, check_if_match
 
 
 class WorkflowServices:
@@ -18,33 +28,49 @@ class WorkflowServices:
         db.commit()
         db.refresh(workflow)
 
-        print(workflow.id)
         return workflow
     
     def get_workflow(db: Session, workflow_id: int):
-        workflow = db.query(Workflow).filter(Workflow.id == workflow_id).first()
+        workflow, _ = WorkflowServices.get_versioned_workflow(db, workflow_id)
         if workflow:
-            print(workflow.nodes)
             return workflow
         else:
             return False
+
+    def get_versioned_workflow(db: Session, workflow_id: int, version: int = None) -> tuple:
+        """
+        Returns the workflow with the version its ETag is made of, (None, None) if it doesn`t exist.
+        A cached workflow of another version than `version`, if given, is reloaded.
+        """
+        fresh = None if version is None else lambda detail: detail[1] == version
+        detail = read_cache.load(db, workflow_key(workflow_id), lambda: GraphService.load_versioned_workflow(db, workflow_id), fresh)
+        return detail or (None, None)
+
+    def get_version(db: Session, workflow_id: int):
+        return PlanService.get_version(db, workflow_id)
     
-    def update_workflow(workflow_id: int, data: WorkflowSchema, db: Session = Depends(get_db())):
+    def update_workflow(workflow_id: int, data: WorkflowSchema, db: Session = Depends(get_db()), if_match: str = None):
         workflow = db.query(Workflow).filter(Workflow.id == workflow_id).first()
+        if workflow is None:
+            raise HTTPException(status_code=400, detail=f"Workflow doesn`t exists.")
+        check_if_match(if_match, workflow_etag(workflow.id, workflow.version))
         workflow.name = data.name
 
         db.add(workflow)
+        WorkflowServices.bump_version(db, workflow_id)
+        read_cache.invalidate(db, workflow_key(workflow_id))
         db.commit()
         db.refresh(workflow)
 
         return workflow
         
 
-    def delete_workflow(workflow_id: int, db: Session = Depends(get_db())):
+    def delete_workflow(workflow_id: int, db: Session = Depends(get_db()), if_match: str = None):
         workflow = db.query(Workflow).filter(Workflow.id == workflow_id).first()
-        print(workflow.id)
         if workflow:
+            check_if_match(if_match, workflow_etag(workflow.id, workflow.version))
             db.delete(workflow)   
+            read_cache.invalidate(db, *deleted_keys(db))
             db.commit()
             return True
         else:
@@ -52,81 +78,229 @@ class WorkflowServices:
 
 
 
-    def create_and_run_graph(db: Session, workflow_id: int) -> nx.DiGraph:
+    def bump_version(db: Session, *workflow_ids: int):
+        """
+        Increments the version of changed workflows, or of workflows whose nodes are changed. Runs as a single UPDATE,
+        so concurrent writers from several workers never lose an increment.
+        """
+        ids = {workflow_id for workflow_id in workflow_ids if workflow_id is not None}
+        if ids:
+            db.query(Workflow).filter(Workflow.id.in_(ids)).update({Workflow.version: Workflow.version + 1}, synchronize_session=False)
+
+    def create_and_run_graph(db: Session, workflow_id: int, audience: bool = False, edges: bool = True) -> dict:
             """
-            Run the workflow represented by models relations
+            Run the workflow represented by models relations. The structure of the workflow is compiled
+            and validated once per workflow version, only the conditions are evaluated on every run.
 
             Args:
-                G (nx.DiGraph): The directed graph representing the workflow.
-                start_node (int): The ID of the start node.
-                last_node (int): The ID of the last node.
-                node_types (dict): Determined types of nodes
+                db (Session): The SQLAlchemy database session.
+                workflow_id (int): The ID of the workflow.
+                audience (bool): Run the workflow for every contact instead of the statuses stored on the nodes.
+                edges (bool): Include the edges of the workflow, None in the result otherwise.
 
             Returns:
-                dict: A dictionary containing the success path and edges of the workflow.
+                dict: A dictionary containing the success path and edges of the workflow,
+                    or the success paths with their contact counts in the audience mode.
             """
-            workflow = db.query(Workflow).filter(Workflow.id == workflow_id).first()
-            if not workflow:
-                raise HTTPException(status_code=400, detail= f"Error. Workflow not found")
+            if audience:
+                result = AudienceService.run_workflow(db, workflow_id)
+                if not edges:
+                    result['edges'] = None
+                return result
+            started = time.perf_counter()
+            plan = None
+            conditions = []
+            try:
+                plan = PlanService.get_plan(db, workflow_id)
+                result = plan.run(db, conditions, edges)
+            except HTTPException as e:
+                history_writer.record(workflow_id, plan and plan.version, started, None, conditions, e.status_code, e.detail)
+                raise
+            history_writer.record(workflow_id, plan.version, started, result['success_path'], conditions)
+            return result
+
+
+    def stream_run(db: Session, workflow_id: int, edges: bool = True):
+        """
+        Loads the plan and the statuses of a run and returns a generator walking the workflow while
+        it is consumed. The generator doesn`t use the session.
+
+        Returns:
+            generator: (event, data) pairs: "path" with the next node IDs of the success path as they are
+                reached, "edges" with the next edges of the workflow, then "end" with the path length,
+                or "error" with the status code and error of a failed walk.
+
+        Raises:
+            HTTPException: If the workflow doesn`t exist or its structure is invalid.
+        """
+        started = time.perf_counter()
+        try:
+            plan = PlanService.get_plan(db, workflow_id)
+            statuses = plan.load_statuses(db)
+        except HTTPException as e:
+            history_writer.record(workflow_id, None, started, None, [], e.status_code, e.detail)
+            raise
+        return WorkflowServices.iter_run_events(plan, statuses, edges, started)
 
-            # create empty graph
-            G = nx.DiGraph()
-
-            # add nodes to graph
-            for node in workflow.nodes:
-                G.add_node(node.id)
-
-            # create graph edges
-            last_node = 0
-            for node in workflow.nodes:
-                if isinstance(node, StartNode):
-                    if node.next_node.node_type != 'condition':
-                        G.add_edge(node.id, node.next_node_id)
-                        start_node = node.id
-                    else:
-                        raise HTTPException(status_code=400, detail="Error. Condition node could be reached through Message or Condition node")
-
-                elif isinstance(node, MessageNode):
-                    if node.next_node.node_type != 'start':
-                        G.add_edge(node.id, node.next_node_id)
-                    else:
-                        raise HTTPException(status_code=400, detail="Error. Start node couldn`t have any previous nodes.")
-
-                elif isinstance(node, ConditionNode):
-                    condition_value = node.evaluate_condition(db=db)
-                    if condition_value:
-                        G.add_edge(node.id, node.yes_node_id)
-                        G.add_edge(node.id, node.no_node_id, weight=999) 
-                    else:
-                        G.add_edge(node.id, node.yes_node_id, weight=999)
-                        G.add_edge(node.id, node.no_node_id) 
-
-                elif isinstance(node, EndNode):
-                    last_node = node.id
-
-
-            if not last_node:
-                raise HTTPException(status_code=400, detail="Error. Sequence has no end node.")
-            
-            reachable_nodes = nx.bfs_tree(G, source=start_node).nodes()
-
-            if last_node not in reachable_nodes:
-                raise HTTPException(status_code=400, detail="Error. End node is unreachable.")
-            
-            edges = []
-            for edge in G.edges:
-                edges.append(edge)
+    def iter_run_events(plan, statuses: dict, edges: bool, started: float):
+        chunk_size = settings.run_stream_chunk_size
+        conditions = []
+        path = []
+        chunk = []
+        try:
+            for node_id in plan.iter_path(statuses, conditions):
+                chunk.append(node_id)
+                if len(chunk) >= chunk_size:
+                    yield 'path', chunk
+                    path.extend(chunk)
+                    chunk = []
+        except HTTPException as e:
+            history_writer.record(plan.workflow_id, plan.version, started, None, conditions, e.status_code, e.detail)
+            yield 'error', {'status_code': e.status_code, 'error': e.detail}
+            return
+        if chunk:
+            yield 'path', chunk
+            path.extend(chunk)
+        history_writer.record(plan.workflow_id, plan.version, started, path, conditions)
 
+        if edges:
+            for i in range(0, len(plan.edges), chunk_size):
+                yield 'edges', plan.edges[i:i + chunk_size]
+        yield 'end', {'length': len(path)}
+
+    def run_batch(db: Session, workflow_ids: list) -> list:
+        """
+        Runs several workflows together: plans, nodes and statuses of a chunk of workflows are loaded
+        with a few set-based queries. An invalid workflow doesn`t fail the batch, its item gets an error.
+
+        Returns:
+            list: A result per requested id, in the same order: the run result with `workflow_id`,
+                or `workflow_id`, `status_code` and `error`.
+        """
+        results = []
+        for i in range(0, len(workflow_ids), settings.run_batch_chunk_size):
+            results.extend(WorkflowServices.run_batch_chunk(db, workflow_ids[i:i + settings.run_batch_chunk_size]))
+        return results
+
+    def run_batch_chunk(db: Session, workflow_ids: list) -> list:
+        plans = PlanService.get_plans(db, workflow_ids)
+
+        message_ids = {message_id for plan in plans.values() if not isinstance(plan, HTTPException) for message_id in plan.message_ids}
+        statuses = {}
+        if message_ids:
+            statuses = dict(db.query(MessageNode.id, MessageNode.status).filter(MessageNode.id.in_(message_ids)).all())
+
+        results = []
+        for workflow_id in workflow_ids:
+            plan = plans[workflow_id]
+            started = time.perf_counter()
+            conditions = []
+            try:
+                if isinstance(plan, HTTPException):
+                    raise plan
+                result = {'workflow_id': workflow_id, **plan.execute(statuses, conditions)}
+            except HTTPException as e:
+                result = {'workflow_id': workflow_id, 'status_code': e.status_code, 'error': e.detail}
+            except ValueError as e:
+                result = {'workflow_id': workflow_id, 'status_code': 400, 'error': str(e)}
+            version = None if isinstance(plan, HTTPException) else plan.version
+            history_writer.record(workflow_id, version, started, result.get('success_path'), conditions, result.get('status_code'), result.get('error'))
+            results.append(result)
+        return results
+
+    def iter_run_batch(workflow_ids: list):
+        """
+        Runs the batch chunk by chunk in its own session, yielding the results as they are ready.
+        """
+        with ReadSessionLocal() as db:
+            for i in range(0, len(workflow_ids), settings.run_batch_chunk_size):
+                yield from WorkflowServices.run_batch_chunk(db, workflow_ids[i:i + settings.run_batch_chunk_size])
+
+
+class AsyncWorkflowServices:
+    """
+    Async counterpart of WorkflowServices, used when the API runs in the async database mode.
+    Multi-step writes reuse the sync implementation through AsyncSession.run_sync.
+    """
+
+    async def create_workflow(data: WorkflowCreateSchema, db: AsyncSession) -> Workflow:
+        if write_queue is not None:
+            return await write_queue.run_async(WorkflowServices.create_workflow, data=data)
+        workflow = Workflow(name=data.name)
+
+        db.add(workflow)
+        await db.commit()
+        await db.refresh(workflow)
+
+        return workflow
+
+    async def get_workflow(db: AsyncSession, workflow_id: int):
+        workflow, _ = await AsyncWorkflowServices.get_versioned_workflow(db, workflow_id)
+        if workflow:
+            return workflow
+        else:
+            return False
+
+    async def get_versioned_workflow(db: AsyncSession, workflow_id: int, version: int = None) -> tuple:
+        if read_cache.sync_due():
+            await db.run_sync(read_cache.sync)
+        key = workflow_key(workflow_id)
+        detail = read_cache.get(key, None if version is None else lambda detail: detail[1] == version)
+        if detail is not None:
+            return detail
+        epoch = read_cache.epoch
+        workflow = (await db.execute(GraphService.workflow_statement(workflow_id))).first()
+        if workflow is None:
+            return None, None
+        nodes = await db.execute(GraphService.workflow_nodes_statement(workflow_id))
+        detail = GraphService.workflow_schema(workflow, nodes), workflow.version
+        read_cache.put(key, detail, epoch)
+        return detail
+
+    async def get_version(db: AsyncSession, workflow_id: int):
+        return await db.scalar(select(Workflow.version).where(Workflow.id == workflow_id))
+
+    async def update_workflow(workflow_id: int, data: WorkflowSchema, db: AsyncSession, if_match: str = None):
+        if write_queue is not None:
+            return await write_queue.run_async(WorkflowServices.update_workflow, workflow_id=workflow_id, data=data, if_match=if_match)
+        return await db.run_sync(lambda session: WorkflowServices.update_workflow(workflow_id=workflow_id, data=data, db=session, if_match=if_match))
+
+    async def delete_workflow(workflow_id: int, db: AsyncSession, if_match: str = None):
+        if write_queue is not None:
+            return await write_queue.run_async(WorkflowServices.delete_workflow, workflow_id=workflow_id, if_match=if_match)
+        return await db.run_sync(lambda session: WorkflowServices.delete_workflow(workflow_id=workflow_id, db=session, if_match=if_match))
+
+    async def create_and_run_graph(db: AsyncSession, workflow_id: int, audience: bool = False, edges: bool = True) -> dict:
+        """
+        Runs the workflow. Only a cache miss of the execution plan goes through the sync loader.
+        """
+        if audience:
+            result = await db.run_sync(AudienceService.run_workflow, workflow_id)
             if not edges:
-                raise HTTPException(status_code=400, detail="Error. Created graph has no edges.")
+                result['edges'] = None
+            return result
+
+        # timed from the start like the sync run: the version lookup, plan load and statuses are part of the run
+        started = time.perf_counter()
+        version = None
+        conditions = []
+        try:
+            version = await db.scalar(select(Workflow.version).where(Workflow.id == workflow_id))
+            if version is None:
+                raise HTTPException(status_code=400, detail= f"Error. Workflow not found")
 
-            sequence = nx.shortest_path(G, target=last_node)[start_node]
+            plan = plan_cache.get(workflow_id, version)
+            if plan is None:
+                plan = await db.run_sync(PlanService.load_plan, workflow_id, version)
 
-            response_data = {
-                'success_path': sequence,
-                'edges': edges
-            }
-            
-            return response_data
-    
+            statement = plan.statuses_statement()
+            statuses = dict((await db.execute(statement)).all()) if statement is not None else {}
+            result = plan.execute(statuses, conditions, edges)
+        except HTTPException as e:
+            history_writer.record(workflow_id, version, started, None, conditions, e.status_code, e.detail)
+            raise
+        history_writer.record(workflow_id, version, started, result['success_path'], conditions)
+        return result
 
+    async def stream_run(db: AsyncSession, workflow_id: int, edges: bool = True):
+        return await db.run_sync(WorkflowServices.stream_run, workflow_id, edges)
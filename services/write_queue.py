@@ -0,0 +1,174 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from sqlalchemy import event
+from sqlalchemy.orm import Session, sessionmaker
+from config import settings
+from database import create_db_engine
+
+
+class GroupSession(Session):
+    """
+    Session shared by the operations of a group commit. Services call commit() as usual,
+    it only flushes: the group is committed once all its operations are done.
+    """
+
+    def commit(self):
+        self.flush()
+
+    def commit_group(self):
+        super().commit()
+
+
+class Operation:
+    __slots__ = ('func', 'kwargs', 'future')
+
+    def __init__(self, func, kwargs: dict):
+        self.func = func
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+def create_group_engine():
+    """
+    Creates the engine of the queue with a single connection. With pysqlite, transactions are
+    emitted by SQLAlchemy, otherwise the savepoints of the operations would commit on release.
+    """
+    engine = create_db_engine(settings.database_url, pool_size=1)
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def begin(connection):
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+    return engine
+
+
+class GroupCommitQueue:
+    """
+    Collects write operations of concurrent requests and commits them together, so a single
+    transaction and fsync is paid for up to `max_batch` operations. A batch starts when an operation
+    arrives and takes everything queued within `max_delay` seconds. Every operation runs in its own
+    savepoint, a failing one is rolled back alone and its error is returned to its caller only.
+    Callers are answered after the commit, so an acknowledged write is durable.
+    """
+
+    def __init__(self, session_factory, max_batch: int = settings.group_commit_max_batch, max_delay: float = settings.group_commit_delay_ms / 1000):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.batches = 0
+        self.operations = 0
+        self.failed_commits = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.commit_time = 0.0
+        self.max_commit_time = 0.0
+
+    def submit(self, func, **kwargs) -> Future:
+        """
+        Queues `func(db=session, **kwargs)`. The returned future is resolved with its result
+        (or exception) once the batch is committed.
+        """
+        operation = Operation(func, kwargs)
+        self._start()
+        self._queue.put(operation)
+        return operation.future
+
+    def run(self, func, **kwargs):
+        return self.submit(func, **kwargs).result()
+
+    async def run_async(self, func, **kwargs):
+        return await asyncio.wrap_future(self.submit(func, **kwargs))
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._serve, name='group-commit', daemon=True)
+                    self._thread.start()
+
+    def _serve(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch: list):
+        results = []
+        try:
+            with self.session_factory() as db:
+                for operation in batch:
+                    savepoint = db.begin_nested()
+                    try:
+                        result = operation.func(db=db, **operation.kwargs)
+                        if savepoint.is_active:
+                            savepoint.commit()
+                    except Exception as e:
+                        savepoint.rollback()
+                        results.append((operation, None, e))
+                    else:
+                        results.append((operation, result, None))
+
+                started = time.perf_counter()
+                db.commit_group()
+                elapsed = time.perf_counter() - started
+        except Exception as e:
+            self.failed_commits += 1
+            for operation in batch:
+                if not operation.future.done():
+                    operation.future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.operations += len(batch)
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.commit_time += elapsed
+        self.max_commit_time = max(self.max_commit_time, elapsed)
+        for operation, result, error in results:
+            if error is None:
+                operation.future.set_result(result)
+            else:
+                operation.future.set_exception(error)
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self._queue.qsize(),
+            'batches': self.batches,
+            'operations': self.operations,
+            'failed_commits': self.failed_commits,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'avg_batch_size': self.operations / self.batches if self.batches else 0,
+            'avg_commit_ms': self.commit_time / self.batches * 1000 if self.batches else 0,
+            'max_commit_ms': self.max_commit_time * 1000,
+        }
+
+
+write_queue = None
+if settings.group_commit:
+    write_queue = GroupCommitQueue(sessionmaker(bind=create_group_engine(), class_=GroupSession, autoflush=False, expire_on_commit=False))
+
+
+def run_write(db: Session, func, **kwargs):
+    """
+    Runs a write service function with the request session, or through the group commit queue
+    when the write-behind mode is enabled.
+    """
+    if write_queue is None:
+        return func(db=db, **kwargs)
+    return write_queue.run(func, **kwargs)
@@ -1,15 +1,25 @@
 import pytest
-from schemas.workflow import WorkflowCreateSchema, StartNodeSchema, ConditionNodeSchema, MessageNodeSchema, EndNodeSchema
+import rule_engine
+from fastapi import HTTPException
+from schemas.workflow import WorkflowCreateSchema, StartNodeSchema, ConditionNodeSchema, MessageNodeSchema, EndNodeSchema, MessageStatusesUpdateSchema
 from routers import workflow as WorkflowRoutes, node as NodeRoutes
+from services.node import NodeService
+from services.write_queue import GroupCommitQueue, GroupSession, create_group_engine
 from sqlalchemy.orm import sessionmaker
 from database import engine
+from migrations import migrate
+from services.rules import compile_rule, _fast_predicate
+from services.validation import ValidationService, WorkflowTopology, TopologyCache, CycleFound, topology_cache
+from models.workflow import ConditionNode
 
 
 @pytest.fixture(scope="session")
 def db():
+    migrate(engine)
     Session = sessionmaker(bind=engine)
     session = Session()
     yield session
+    session.close()
 
 def test_create_start_node(db):
     workflow_data = WorkflowCreateSchema(name="Test")
@@ -65,4 +75,173 @@ def test_create_end_node(db):
 
     db.delete(workflow)
     db.delete(node)
-    db.commit()
\ No newline at end of file
+    db.commit()
+
+
+def test_create_condition_node_with_invalid_rule(db):
+    workflow = WorkflowRoutes.create_workflow(data=WorkflowCreateSchema(name="Test"), db=db)
+    node_data = ConditionNodeSchema(workflow_id=workflow.id, condition='status ==', yes_node_id=0, no_node_id=0)
+
+    with pytest.raises(HTTPException) as e:
+        NodeRoutes.create_condition_node(node_data=node_data, db=db)
+    assert e.value.status_code == 400
+
+    db.delete(workflow)
+    db.commit()
+
+@pytest.mark.parametrize('condition', [
+    'status == "opened"',
+    "status != 'sent'",
+    "status in ['sent', 'opened']",
+    'status not in ["pending"]',
+])
+def test_compiled_rule_fast_path(condition):
+    rule = rule_engine.Rule(condition)
+
+    assert _fast_predicate(condition) is not None
+    for status in ['pending', 'sent', 'opened', 'None']:
+        assert compile_rule(condition)(status) == rule.matches({'status': status})
+
+
+def test_condition_message_node_is_maintained(db):
+    workflow = WorkflowRoutes.create_workflow(data=WorkflowCreateSchema(name="Test"), db=db)
+    second_condition = NodeRoutes.create_condition_node(node_data=ConditionNodeSchema(workflow_id=workflow.id, condition='status == "sent"', yes_node_id=0, no_node_id=0), db=db)
+    first_condition = NodeRoutes.create_condition_node(node_data=ConditionNodeSchema(workflow_id=workflow.id, condition='status == "sent"', yes_node_id=0, no_node_id=0), db=db)
+    message_node = NodeRoutes.create_message_node(node_data=MessageNodeSchema(workflow_id=workflow.id, message_text='test', status='sent', next_node_id=first_condition.id), db=db)
+
+    assert first_condition.message_node_id == message_node.id
+    assert second_condition.message_node_id is None
+
+    # the "no" branch of a condition checks the same message node
+    NodeRoutes.update_condition_node(node_data=ConditionNodeSchema(workflow_id=workflow.id, condition='status == "sent"', yes_node_id=0, no_node_id=second_condition.id), node_id=first_condition.id, db=db)
+    assert second_condition.message_node_id == message_node.id
+
+    NodeRoutes.update_message_node(node_data=MessageNodeSchema(workflow_id=workflow.id, message_text='test', status='sent', next_node_id=0), node_id=message_node.id, db=db)
+    assert first_condition.message_node_id is None
+    assert second_condition.message_node_id is None
+
+    WorkflowRoutes.delete_workflow(workflow_id=workflow.id, db=db)
+
+
+
+def test_topology_keeps_order_and_finds_cycles():
+    topology = WorkflowTopology(1, {1: 'message', 2: 'message', 3: 'message', 4: 'message'}, [(1, 2), (3, 4)])
+    topology.add_edge(4, 1)
+    for source, targets in topology.successors.items():
+        assert all(topology.order[source] < topology.order[target] for target in targets)
+
+    with pytest.raises(CycleFound):
+        topology.add_edge(2, 3)
+    assert 3 not in topology.successors[2]
+
+    # an edge to a node created later joins the graph with it
+    topology.add_edge(2, 5)
+    assert topology.add_node(5, 'end') == [2]
+    topology.remove_node(1)
+    assert topology.dangling == {1: {4: 1}}
+
+    # a writer takes the topology out of the cache, a concurrent writer of the workflow builds its own
+    cache = TopologyCache()
+    cache.put(1, topology)
+    assert cache.take(1, 1) is topology and cache.take(1, 1) is None
+
+
+def test_node_edits_are_validated(db):
+    workflow = WorkflowRoutes.create_workflow(data=WorkflowCreateSchema(name="Test"), db=db)
+    start_node = NodeRoutes.create_start_node(node_data=StartNodeSchema(workflow_id=workflow.id, next_node_id=0), db=db)
+    first_node = NodeRoutes.create_message_node(node_data=MessageNodeSchema(workflow_id=workflow.id, message_text='first', status='sent', next_node_id=0), db=db)
+    second_node = NodeRoutes.create_message_node(node_data=MessageNodeSchema(workflow_id=workflow.id, message_text='second', status='sent', next_node_id=first_node.id), db=db)
+    condition_node = NodeRoutes.create_condition_node(node_data=ConditionNodeSchema(workflow_id=workflow.id, condition='status == "sent"', yes_node_id=0, no_node_id=0), db=db)
+
+    with pytest.raises(HTTPException, match='cycle'):
+        NodeRoutes.update_message_node(node_data=MessageNodeSchema(workflow_id=workflow.id, message_text='first', status='sent', next_node_id=second_node.id), node_id=first_node.id, db=db)
+    with pytest.raises(HTTPException, match='Start node'):
+        NodeRoutes.update_message_node(node_data=MessageNodeSchema(workflow_id=workflow.id, message_text='first', status='sent', next_node_id=start_node.id), node_id=first_node.id, db=db)
+    with pytest.raises(HTTPException, match='Condition node'):
+        NodeRoutes.update_start_node(node_data=StartNodeSchema(workflow_id=workflow.id, next_node_id=condition_node.id), node_id=start_node.id, db=db)
+    with pytest.raises(HTTPException, match='cycle'):
+        NodeRoutes.update_condition_node(node_data=ConditionNodeSchema(workflow_id=workflow.id, condition='status == "sent"', yes_node_id=second_node.id, no_node_id=condition_node.id), node_id=condition_node.id, db=db)
+    db.rollback()
+
+    NodeRoutes.update_start_node(node_data=StartNodeSchema(workflow_id=workflow.id, next_node_id=second_node.id), node_id=start_node.id, db=db)
+    NodeRoutes.update_message_node(node_data=MessageNodeSchema(workflow_id=workflow.id, message_text='first', status='sent', next_node_id=condition_node.id), node_id=first_node.id, db=db)
+    with pytest.raises(HTTPException, match='cycle'):
+        NodeRoutes.update_condition_node(node_data=ConditionNodeSchema(workflow_id=workflow.id, condition='status == "sent"', yes_node_id=0, no_node_id=second_node.id), node_id=condition_node.id, db=db)
+    db.rollback()
+    assert db.get(ConditionNode, condition_node.id).no_node_id == 0
+
+    WorkflowRoutes.delete_workflow(workflow_id=workflow.id, db=db)
+    db.commit()
+
+
+def test_group_commit_queue(db):
+    write_queue = GroupCommitQueue(sessionmaker(bind=create_group_engine(), class_=GroupSession, autoflush=False, expire_on_commit=False), max_delay=0.05)
+    workflow = WorkflowRoutes.create_workflow(data=WorkflowCreateSchema(name="Group commit"), db=db)
+
+    futures = [write_queue.submit(NodeService.create_node, node_type='message', data=MessageNodeSchema(workflow_id=workflow.id, next_node_id=0, message_text=f'message {i}', status='sent')) for i in range(20)]
+    failed = write_queue.submit(NodeService.create_node, node_type='condition', data=ConditionNodeSchema(workflow_id=workflow.id, condition="status ==", yes_node_id=0, no_node_id=0))
+    nodes = [future.result(timeout=10) for future in futures]
+
+    # a failing operation is rolled back alone
+    with pytest.raises(HTTPException):
+        failed.result(timeout=10)
+    stats = write_queue.stats()
+    assert stats['operations'] == 21
+    assert stats['batches'] < stats['operations']
+
+    db.expire_all()
+    assert sorted(node.id for node in workflow.nodes) == sorted(node.id for node in nodes)
+    assert nodes[0].message_text == 'message 0'
+    db.delete(workflow)
+    db.commit()
+
+
+def test_topology_is_cached_on_commit(db):
+    workflow = WorkflowRoutes.create_workflow(data=WorkflowCreateSchema(name="Topology"), db=db)
+    NodeRoutes.create_start_node(node_data=StartNodeSchema(workflow_id=workflow.id, next_node_id=0), db=db)
+    db.refresh(workflow)
+
+    # a change that is rolled back, alone or in a savepoint of a group commit, never reaches the cache
+    ValidationService.committed(db, workflow.id, ValidationService.get_topology(db, workflow.id))
+    db.rollback()
+    assert topology_cache.take(workflow.id, workflow.version) is None
+    savepoint = db.begin_nested()
+    ValidationService.committed(db, workflow.id, ValidationService.get_topology(db, workflow.id))
+    savepoint.rollback()
+    db.commit()
+    assert topology_cache.take(workflow.id, workflow.version) is None
+
+    topology = ValidationService.get_topology(db, workflow.id)
+    savepoint = db.begin_nested()
+    ValidationService.committed(db, workflow.id, topology)
+    savepoint.commit()
+    assert topology_cache.take(workflow.id, workflow.version) is None
+    db.commit()
+    assert topology_cache.take(workflow.id, workflow.version) is topology
+    db.delete(workflow)
+    db.commit()
+
+
+def test_update_message_statuses(db):
+    workflow = WorkflowRoutes.create_workflow(data=WorkflowCreateSchema(name="Statuses"), db=db)
+    nodes = [NodeRoutes.create_message_node(node_data=MessageNodeSchema(workflow_id=workflow.id, next_node_id=0, message_text='test', status=status), db=db) for status in ('pending', 'sent', 'opened')]
+    pending, sent, opened = [node.id for node in nodes]
+    condition = NodeRoutes.create_condition_node(node_data=ConditionNodeSchema(workflow_id=workflow.id, condition="status == 'sent'", yes_node_id=0, no_node_id=0), db=db)
+
+    data = MessageStatusesUpdateSchema(statuses=[
+        {'node_id': pending, 'status': 'opened'},
+        {'node_id': pending, 'status': 'sent'},  # applied before "opened"
+        {'node_id': sent, 'status': 'sent'},
+        {'node_id': sent, 'status': 'sent'},  # counted once
+        {'node_id': opened, 'status': 'pending'},
+        {'node_id': condition.id, 'status': 'sent'},
+        {'node_id': 0, 'status': 'sent'},
+    ])
+    result = NodeRoutes.update_message_statuses(data=data, db=db)
+
+    assert result['updated'] == 3
+    assert sorted(result['rejected']) == sorted([opened, condition.id, 0])
+    db.expire_all()
+    assert [node.status for node in nodes] == ['opened', 'sent', 'opened']
+    db.delete(workflow)
+    db.commit()
@@ -1,14 +1,39 @@
+import asyncio
+import io
+import json
+import zlib
 import pytest
-from services.workflow import WorkflowServices
+from services.workflow import WorkflowServices, AsyncWorkflowServices
 from services.node import NodeService
-from schemas.workflow import WorkflowCreateSchema, StartNodeSchema, ConditionNodeSchema, MessageNodeSchema, EndNodeSchema
-from routers import workflow as WorkflowRoutes, node as NodeRoutes
+from schemas.workflow import WorkflowCreateSchema, StartNodeSchema, ConditionNodeSchema, MessageNodeSchema, EndNodeSchema, RunBatchSchema, ContactSchema, ContactsImportSchema, MessageStatusesUpdateSchema
+from routers import workflow as WorkflowRoutes, node as NodeRoutes, contact as ContactRoutes
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
-from database import engine
+from database import engine, create_db_engine, get_async_sessionmaker, dispose_async_engine
+from migrations import migrate
+from services.plan import plan_cache, PlanService, ExecutionPlan
+from services.results import patch_path
+from services.audience import AudienceService
+from services.importer import GraphImport, import_graph
+from fastapi import HTTPException, Response
+from models.workflow import Workflow, ConditionNode, Contact, WorkflowResult, RunJob, RunHistory, CacheVersion
+from services.run_queue import RunQueue
+from services.history import HistoryWriter, history_writer
+from schemas.workflow import RunStreamFormat, WorkflowCloneSchema
+from services.metrics import Metrics, MetricsMiddleware, request_stats
+from services.health import server_state
+from services.cache import ReadCache, read_cache, node_key, workflow_key
+from services.etag import workflow_etag, node_etag, etag_matches
+from services.snapshot import SnapshotService, SnapshotReader, HEADER, BLOCK, TRAILER, LENGTH_SIZE
+from routers import health as HealthRoutes
+from config import settings
+from benchmarks.generator import SHAPES, creation_order
+from services.executor import CompactGraph, CycleError, DeadEndError, START, MESSAGE, CONDITION, END, walk, partition_walk
 
 
 @pytest.fixture(scope="session")
 def db():
+    migrate(engine)
     Session = sessionmaker(bind=engine)
     session = Session()
     yield session
@@ -80,7 +105,12 @@ def test_create_and_run_graph(db): # Valid data
     yes_node_new_data = MessageNodeSchema(workflow_id=workflow.id, message_text='yes message node', status='sent', next_node_id=end_node.id)
     NodeRoutes.update_message_node(node_data=yes_node_new_data , node_id=yes_node.id, db=db)
 
+    # nothing can point back to the start node, the edit is rejected when it is saved
     no_node_new_data = MessageNodeSchema(workflow_id=workflow.id, message_text='no message node', status='sent', next_node_id=start_node.id)
+    with pytest.raises(HTTPException):
+        NodeRoutes.update_message_node(node_data=no_node_new_data , node_id=no_node.id, db=db)
+
+    no_node_new_data = MessageNodeSchema(workflow_id=workflow.id, message_text='no message node', status='sent', next_node_id=end_node.id)
     NodeRoutes.update_message_node(node_data=no_node_new_data , node_id=no_node.id, db=db)
 
     # Running sequence
@@ -104,3 +134,706 @@ def test_create_and_run_graph(db): # Valid data
 
     WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
     db.commit()
+
+
+def create_chain_workflow(db, messages_count):
+    """
+    Creates a valid workflow: start -> N message nodes -> condition -> yes/no message nodes -> end.
+    """
+    workflow = WorkflowServices.create_workflow(data=WorkflowCreateSchema(name='chain'), db=db)
+    end_node = NodeService.create_node(node_type='end', db=db, data=EndNodeSchema(workflow_id=workflow.id))
+    yes_node = NodeService.create_node(node_type='message', db=db, data=MessageNodeSchema(workflow_id=workflow.id, message_text='yes', status='sent', next_node_id=end_node.id))
+    no_node = NodeService.create_node(node_type='message', db=db, data=MessageNodeSchema(workflow_id=workflow.id, message_text='no', status='sent', next_node_id=end_node.id))
+    condition_node = NodeService.create_node(node_type='condition', db=db, data=ConditionNodeSchema(workflow_id=workflow.id, condition="status == 'sent'", yes_node_id=yes_node.id, no_node_id=no_node.id))
+
+    next_node_id = condition_node.id
+    for i in range(messages_count):
+        message_node = NodeService.create_node(node_type='message', db=db, data=MessageNodeSchema(workflow_id=workflow.id, message_text=f'message {i}', status='sent', next_node_id=next_node_id))
+        next_node_id = message_node.id
+    NodeService.create_node(node_type='start', db=db, data=StartNodeSchema(workflow_id=workflow.id, next_node_id=next_node_id))
+    return workflow
+
+
+def count_queries(func):
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        result = func()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return result, len(queries)
+
+
+def test_run_graph_query_count_does_not_depend_on_size(db, monkeypatch):
+    # the loads are counted, not the read cache
+    monkeypatch.setattr(read_cache, 'enabled', False)
+    small_workflow = create_chain_workflow(db, messages_count=2)
+    large_workflow = create_chain_workflow(db, messages_count=50)
+    db.expire_all()
+
+    small_result, small_queries = count_queries(lambda: WorkflowRoutes.run_sequence(workflow_id=small_workflow.id, db=db))
+    db.expire_all()
+    large_result, large_queries = count_queries(lambda: WorkflowRoutes.run_sequence(workflow_id=large_workflow.id, db=db))
+
+    assert len(small_result['success_path']) == 6
+    assert len(large_result['success_path']) == 54
+    assert small_queries == large_queries
+
+    db.expire_all()
+    _, small_queries = count_queries(lambda: WorkflowRoutes.get_workflow(id=small_workflow.id, db=db))
+    db.expire_all()
+    workflow, large_queries = count_queries(lambda: WorkflowRoutes.get_workflow(id=large_workflow.id, db=db))
+
+    assert len(workflow.nodes) == 55
+    assert small_queries == large_queries
+
+    for workflow in (small_workflow, large_workflow):
+        WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+
+
+def test_ids_are_not_reused(db):
+    # plans, ETags and cache entries are keyed on (id, version), an id must never come back
+    template = create_chain_workflow(db, messages_count=1)
+    deleted = create_chain_workflow(db, messages_count=1)
+    WorkflowRoutes.run_sequence(workflow_id=deleted.id, db=db)
+    deleted_node_ids = [node.id for node in deleted.nodes]
+    WorkflowServices.delete_workflow(workflow_id=deleted.id, db=db)
+
+    workflow = WorkflowServices.create_workflow(data=WorkflowCreateSchema(name='new'), db=db)
+    node = NodeService.create_node(node_type='end', db=db, data=EndNodeSchema(workflow_id=workflow.id))
+    assert workflow.id > deleted.id and node.id > max(deleted_node_ids)
+    with pytest.raises(HTTPException):
+        WorkflowRoutes.run_sequence(workflow_id=workflow.id, db=db)
+
+    copy = WorkflowRoutes.clone_workflow(workflow_id=template.id, db=db)['workflows'][0]
+    assert copy['id'] > workflow.id and min(node.id for node in template.nodes) + copy['node_id_offset'] > node.id
+    for workflow_id in (template.id, workflow.id, copy['id']):
+        WorkflowServices.delete_workflow(workflow_id=workflow_id, db=db)
+    db.commit()
+
+
+def test_autoincrement_migration(tmp_path):
+    # a database created before the ids were AUTOINCREMENT is rebuilt with its rows
+    old_engine = create_db_engine(f"sqlite:///{tmp_path / 'old.db'}", pool_size=1)
+    with old_engine.begin() as connection:
+        connection.exec_driver_sql('CREATE TABLE workflows (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR)')
+        connection.exec_driver_sql("INSERT INTO workflows (id, name) VALUES (1, 'kept')")
+    migrate(old_engine)
+    migrate(old_engine)
+    try:
+        with old_engine.begin() as connection:
+            assert 'AUTOINCREMENT' in connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'workflows'").scalar()
+            assert connection.exec_driver_sql('SELECT id, name, version FROM workflows').all() == [(1, 'kept', 1)]
+            connection.exec_driver_sql("INSERT INTO workflows (name, version) VALUES ('deleted', 1)")
+            connection.exec_driver_sql("DELETE FROM workflows WHERE name = 'deleted'")
+            connection.exec_driver_sql("INSERT INTO workflows (name, version) VALUES ('new', 1)")
+            assert connection.exec_driver_sql("SELECT id FROM workflows WHERE name = 'new'").scalar() == 3
+    finally:
+        old_engine.dispose()
+
+
+def test_run_graph_plan_cache(db):
+    workflow = create_chain_workflow(db, messages_count=1)
+    plan_cache.clear()
+    misses = plan_cache.misses
+
+    first = WorkflowRoutes.run_sequence(workflow_id=workflow.id, db=db)
+    hits = plan_cache.hits
+    second = WorkflowRoutes.run_sequence(workflow_id=workflow.id, db=db)
+
+    assert first == second
+    assert plan_cache.hits == hits + 1
+    assert plan_cache.misses == misses + 1
+
+    # a status change keeps the plan
+    message_node = next(node for node in workflow.nodes if node.node_type == 'message' and node.message_text == 'message 0')
+    NodeService.update_node(node_id=message_node.id, data=MessageNodeSchema(workflow_id=workflow.id, message_text='message 0', status='opened', next_node_id=message_node.next_node_id), db=db)
+    WorkflowRoutes.run_sequence(workflow_id=workflow.id, db=db)
+    assert plan_cache.misses == misses + 1
+
+    # a structure change bumps the version and invalidates the plan
+    condition_node = next(node for node in workflow.nodes if node.node_type == 'condition')
+    NodeService.update_node(node_id=condition_node.id, data=ConditionNodeSchema(workflow_id=workflow.id, condition="status != 'sent'", yes_node_id=condition_node.yes_node_id, no_node_id=condition_node.no_node_id), db=db)
+    WorkflowRoutes.run_sequence(workflow_id=workflow.id, db=db)
+
+    assert plan_cache.misses == misses + 2
+    assert plan_cache.stats()['size'] == 1
+
+    WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+
+
+def test_walk_compact_graph():
+    rows = [
+        (1, START, 2, None, None),
+        (2, MESSAGE, 3, None, None),
+        (3, CONDITION, None, 4, 5),
+        (4, MESSAGE, 6, None, None),
+        (5, MESSAGE, 2, None, None),
+        (6, END, None, None, None),
+    ]
+    graph = CompactGraph(rows)
+
+    assert walk(graph, 0, lambda index: True) == [1, 2, 3, 4, 6]
+    with pytest.raises(CycleError):
+        walk(graph, 0, lambda index: False)
+
+    graph = CompactGraph(rows[:-1])
+    with pytest.raises(DeadEndError):
+        walk(graph, 0, lambda index: True)
+
+
+def test_generated_shapes():
+    for shape, generate in SHAPES.items():
+        rows, conditions = generate(100)
+        ids = {row[0] for row in rows}
+        assert len(ids) == len(rows) and all(target in ids for row in rows for target in row[2:] if target is not None)
+        created = set()
+        for row in creation_order(rows):
+            assert all(target in created for target in row[2:] if target is not None)
+            created.add(row[0])
+        assert len(created) == len(rows)
+        path = walk(CompactGraph(rows), 0, lambda index: True)
+        assert path[0] == 1 and path[-1] == rows[-1][0]
+
+
+def test_import_graph(db):
+    lines = [{'ref': 'start', 'node_type': 'start', 'next': 0}]
+    lines += [{'ref': i, 'node_type': 'message', 'message_text': f'message {i}', 'status': 'sent', 'next': i + 1} for i in range(20)]
+    lines += [
+        {'ref': 20, 'node_type': 'condition', 'condition': "status == 'sent'", 'yes': 'yes', 'no': 'end'},
+        {'ref': 'yes', 'node_type': 'message', 'message_text': 'yes', 'status': 'sent', 'next': 'end'},
+        {'ref': 'end', 'node_type': 'end'},
+    ]
+
+    graph_import = GraphImport(db, {'name': 'imported'})
+    graph_import.add_nodes(lines[:10])
+    graph_import.add_nodes(lines[10:])
+    result = graph_import.finish()
+
+    ids = result['nodes']
+    run = WorkflowRoutes.run_sequence(workflow_id=result['id'], db=db)
+    assert run['success_path'] == [ids['start'], *[ids[str(i)] for i in range(21)], ids['yes'], ids['end']]
+
+    WorkflowServices.delete_workflow(workflow_id=result['id'], db=db)
+
+def test_import_invalid_graph_is_rolled_back(db):
+    graph_import = GraphImport(db, {'name': 'invalid import'})
+    workflow_id = graph_import.workflow.id
+    graph_import.add_nodes([{'ref': 'start', 'node_type': 'start', 'next': 'end'}, {'ref': 'end', 'node_type': 'end'}, {'ref': 'message', 'node_type': 'message', 'message_text': 'test', 'status': 'sent', 'next': 'start'}])
+
+    with pytest.raises(HTTPException):
+        graph_import.finish()
+    db.rollback()
+
+    assert db.get(Workflow, workflow_id) is None
+
+
+def test_async_create_and_run_graph(db):
+    workflow = create_chain_workflow(db, messages_count=3)
+
+    async def run(workflow_id):
+        try:
+            async with get_async_sessionmaker()() as session:
+                return await AsyncWorkflowServices.create_and_run_graph(db=session, workflow_id=workflow_id)
+        finally:
+            await dispose_async_engine()
+
+    assert asyncio.run(run(workflow.id)) == WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow.id)
+
+    # runs of missing workflows are recorded too
+    history_writer.flush()
+    failed_runs = db.query(RunHistory).filter(RunHistory.workflow_id == 0).count()
+    with pytest.raises(HTTPException):
+        asyncio.run(run(0))
+    history_writer.flush()
+    assert db.query(RunHistory).filter(RunHistory.workflow_id == 0).count() == failed_runs + 1
+
+    WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+
+
+def test_run_sequence_batch(db):
+    workflows = [create_chain_workflow(db, messages_count=i) for i in range(1, 4)]
+    empty_workflow = WorkflowServices.create_workflow(data=WorkflowCreateSchema(name='empty'), db=db)
+    workflow_ids = [workflow.id for workflow in workflows] + [empty_workflow.id, 0]
+    plan_cache.clear()
+
+    results, queries = count_queries(lambda: WorkflowRoutes.run_sequence_batch(data=RunBatchSchema(workflow_ids=workflow_ids), db=db)['results'])
+
+    assert [result['workflow_id'] for result in results] == workflow_ids
+    for workflow, result in zip(workflows, results):
+        assert result == {'workflow_id': workflow.id, **WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow.id)}
+    assert results[3]['status_code'] == 400
+    assert results[4] == {'workflow_id': 0, 'status_code': 400, 'error': 'Error. Workflow not found'}
+    assert queries <= 6
+
+    for workflow in workflows + [empty_workflow]:
+        WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+
+
+def test_run_graph_for_audience(db):
+    workflow = create_chain_workflow(db, messages_count=2)
+    plan = PlanService.get_plan(db, workflow.id)
+    (condition, message_id), = plan.conditions.values()
+
+    statuses = ['sent', 'opened', 'pending', None]
+    contacts = [ContactSchema(external_id=f'audience-{workflow.id}-{i}', statuses={message_id: statuses[i % 4]} if statuses[i % 4] else {}) for i in range(10)]
+    assert ContactRoutes.import_contacts(data=ContactsImportSchema(contacts=contacts), db=db) == {'contacts': 10, 'statuses': 8}
+    # statuses are replaced on the next import
+    contacts[1] = ContactSchema(external_id=contacts[1].external_id, statuses={message_id: 'sent'})
+    ContactRoutes.import_contacts(data=ContactsImportSchema(contacts=contacts[:2]), db=db)
+
+    result = AudienceService.run_workflow(db, workflow.id, chunk_size=3)
+
+    # contacts without a status follow the status of the node ('sent')
+    expected = {}
+    for contact in db.query(Contact).order_by(Contact.id):
+        contact_statuses = {status.message_node_id: status.status for status in contact.statuses}
+        path = tuple(plan.execute({message_id: contact_statuses.get(message_id, 'sent')})['success_path'])
+        expected[path] = expected.get(path, 0) + 1
+    assert result['contacts'] == sum(expected.values())
+    assert {tuple(item['success_path']): item['contacts'] for item in result['paths']} == expected
+    assert result == WorkflowRoutes.run_sequence(workflow_id=workflow.id, audience=True, db=db)
+
+    # only the contacts of this test are deleted, with their statuses
+    for contact in db.query(Contact).filter(Contact.external_id.like(f'audience-{workflow.id}-%')):
+        db.delete(contact)
+    db.commit()
+    WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+
+
+def test_partition_walk():
+    rows = [
+        (1, START, 2, None, None),
+        (2, CONDITION, None, 3, 4),
+        (3, MESSAGE, 5, None, None),
+        (4, CONDITION, None, 5, 3),
+        (5, END, None, None, None),
+    ]
+    graph = CompactGraph(rows)
+    # node 2 lets members greater than 2 through, node 4 lets odd members through
+    predicates = {2: lambda member: member > 2, 4: lambda member: member % 2}
+
+    def split(index, members):
+        predicate = predicates[graph.ids[index]]
+        return [m for m in members if predicate(m)], [m for m in members if not predicate(m)]
+
+    paths = partition_walk(graph, 0, range(6), split)
+    assert sorted(paths) == [([1, 2, 3, 5], [3, 4, 5]), ([1, 2, 4, 3, 5], [0, 2]), ([1, 2, 4, 5], [1])]
+    assert partition_walk(graph, 0, range(0), split) == []
+
+    looped = CompactGraph([(1, START, 2, None, None), (2, CONDITION, None, 3, 2), (3, END, None, None, None)])
+    with pytest.raises(CycleError):
+        partition_walk(looped, 0, range(2), lambda index, members: ([0], [1]))
+
+
+def test_stored_result_is_patched_on_status_change(db):
+    workflow = create_chain_workflow(db, messages_count=2)
+    condition_node = next(node for node in workflow.nodes if node.node_type == 'condition')
+    yes_path = WorkflowRoutes.run_sequence(workflow_id=workflow.id, db=db)
+
+    assert WorkflowRoutes.run_sequence_result(workflow_id=workflow.id, db=db, write_db=db) == yes_path
+    version = workflow.version
+
+    # the checked message is "sent", the condition switches to the "no" branch
+    status = MessageStatusesUpdateSchema(statuses=[{'node_id': condition_node.message_node_id, 'status': 'opened'}])
+    NodeRoutes.update_message_statuses(data=status, db=db)
+    no_path = WorkflowRoutes.run_sequence(workflow_id=workflow.id, db=db)
+    assert no_path['success_path'] != yes_path['success_path']
+
+    stored_result, stored_queries = count_queries(lambda: WorkflowRoutes.run_sequence_result(workflow_id=workflow.id, db=db, write_db=db))
+    assert stored_result == no_path
+    assert stored_queries <= 2
+    db.refresh(workflow)
+    assert workflow.version == version
+
+    WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+    assert db.query(WorkflowResult).filter(WorkflowResult.workflow_id == workflow.id).count() == 0
+    db.commit()
+
+
+def test_patch_path():
+    graph = CompactGraph([
+        (1, START, 2, None, None),
+        (2, CONDITION, None, 3, 4),
+        (3, MESSAGE, 5, None, None),
+        (4, CONDITION, None, 5, 3),
+        (5, END, None, None, None),
+    ])
+    plan = ExecutionPlan(1, 1, graph, 0, 4, {1: ("status == 'sent'", 10), 3: ("status == 'sent'", 11)}, [])
+
+    assert patch_path(plan, [1, 2, 3, 5], {2}, {10: 'sent'}) is None
+    assert patch_path(plan, [1, 2, 3, 5], {2}, {10: 'opened', 11: 'sent'}) == [1, 2, 4, 5]
+    assert patch_path(plan, [1, 2, 4, 5], {4}, {10: 'opened', 11: 'opened'}) == [1, 2, 4, 3, 5]
+
+    # a branch to a missing node is a dead end, as in a full run
+    graph = CompactGraph([
+        (1, START, 2, None, None),
+        (2, MESSAGE, 3, None, None),
+        (3, CONDITION, None, 4, 99),
+        (4, MESSAGE, 5, None, None),
+        (5, END, None, None, None),
+    ])
+    plan = ExecutionPlan(1, 1, graph, 0, 4, {2: ("status == 'sent'", 2)}, [])
+    with pytest.raises(HTTPException):
+        plan.execute({2: 'opened'})
+    with pytest.raises(DeadEndError) as error:
+        patch_path(plan, [1, 2, 3, 4, 5], {3}, {2: 'opened'})
+    assert error.value.node_id == 3
+
+
+def test_run_queue(db):
+    workflow = create_chain_workflow(db, messages_count=2)
+    expected = WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow.id)
+    db.commit()
+
+    with pytest.raises(HTTPException) as error:
+        RunQueue(max_size=0).submit(db, workflow.id)
+    assert error.value.status_code == 429
+
+    queue = RunQueue(workers=1, max_size=2)
+    job = queue.submit(db, workflow.id)
+    failed_job = queue.submit(db, 0)
+    assert job['status'] == 'queued'
+
+    job = asyncio.run(queue.wait(job['id'], timeout=10))
+    assert job['status'] == 'done'
+    assert job['result'] == json.loads(json.dumps(expected))
+    failed_job = asyncio.run(queue.wait(failed_job['id'], timeout=10))
+    assert (failed_job['status'], failed_job['status_code']) == ('failed', 400)
+    assert queue.stats()['completed'] == 2
+
+    # results expire
+    queue.ttl = 0
+    with pytest.raises(HTTPException):
+        queue.read(job['id'])
+    queue.purge(db, force=True)
+    assert db.query(RunJob).filter(RunJob.id == job['id']).count() == 0
+    queue.shutdown()
+
+    WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+    db.commit()
+
+
+def test_run_history(db):
+    # ids of deleted workflows are reused, runs of the previous tests are cleared
+    history_writer.flush()
+    db.query(RunHistory).delete()
+    workflow = create_chain_workflow(db, messages_count=2)
+    condition_node = next(node for node in workflow.nodes if node.node_type == 'condition')
+    results = [WorkflowRoutes.run_sequence(workflow_id=workflow.id, db=db) for _ in range(3)]
+    with pytest.raises(HTTPException):
+        WorkflowRoutes.run_sequence(workflow_id=0, db=db)
+    db.commit()
+    history_writer.flush()
+
+    first_page = WorkflowRoutes.run_history(workflow_id=workflow.id, limit=2, db=db)
+    assert len(first_page['items']) == 2
+    second_page = WorkflowRoutes.run_history(workflow_id=workflow.id, before=first_page['next_before'], limit=2, db=db)
+    assert len(second_page['items']) == 1
+    assert second_page['next_before'] is None
+
+    run = second_page['items'][0]
+    assert run['success_path'] == results[0]['success_path']
+    assert run['conditions'] == [[condition_node.id, True]]
+    assert run['version'] == workflow.version
+    assert WorkflowRoutes.run_history(workflow_id=0, limit=1, db=db)['items'][0]['status_code'] == 400
+    db.commit()
+
+    # only the newest records are kept
+    writer = HistoryWriter(max_rows=1)
+    writer.compact()
+    assert db.query(RunHistory).count() == 1
+    writer.close()
+
+    WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+    db.commit()
+
+
+def test_stream_run(db, monkeypatch):
+    workflow = create_chain_workflow(db, messages_count=5)
+    expected = WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow.id)
+    assert WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow.id, edges=False) == {'success_path': expected['success_path'], 'edges': None}
+
+    with monkeypatch.context() as patch:
+        patch.setattr(settings, 'run_stream_chunk_size', 3)
+        events = list(WorkflowServices.stream_run(db=db, workflow_id=workflow.id))
+    assert [node_id for event, data in events if event == 'path' for node_id in data] == expected['success_path']
+    assert [edge for event, data in events if event == 'edges' for edge in data] == expected['edges']
+    assert events[-1] == ('end', {'length': len(expected['success_path'])})
+
+    async def read(response):
+        return b''.join([chunk async for chunk in response.body_iterator])
+
+    response = WorkflowRoutes.run_sequence(workflow_id=workflow.id, edges=False, stream=RunStreamFormat.sse, db=db)
+    body = asyncio.run(read(response))
+    assert body == b'event: path\ndata: %s\n\nevent: end\ndata: {"length":%d}\n\n' % (json.dumps(expected['success_path'], separators=(',', ':')).encode(), len(expected['success_path']))
+
+    WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+    db.commit()
+
+
+def test_metrics(db, monkeypatch):
+    metrics = Metrics(enabled=True)
+    metrics.request_seconds.observe(0.003, 'GET', '/get/{workflow_id}', 200)
+    metrics.request_seconds.observe(20, 'GET', '/get/{workflow_id}', 200)
+    lines = metrics.render().splitlines()
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/get/{workflow_id}",status="200",le="0.0025"} 0' in lines
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/get/{workflow_id}",status="200",le="0.005"} 1' in lines
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/get/{workflow_id}",status="200",le="+Inf"} 2' in lines
+    assert 'http_request_duration_seconds_count{method="GET",route="/get/{workflow_id}",status="200"} 2' in lines
+
+    # runs time their phases through the module-level metrics
+    monkeypatch.setattr('services.plan.metrics', metrics)
+    workflow = create_chain_workflow(db, messages_count=3)
+    plan_cache.clear()
+    WorkflowServices.create_and_run_graph(db=db, workflow_id=workflow.id)
+    phases = metrics.render()
+    for phase in ('load', 'build', 'statuses', 'conditions', 'walk'):
+        assert f'workflow_run_phase_duration_seconds_count{{phase="{phase}"}} 1' in phases
+
+    class Route:
+        path = '/run-sequence/{workflow_id}'
+
+    async def app(scope, receive, send):
+        scope['route'] = Route()
+        request_stats.get().queries += 2
+        await send({'type': 'http.response.start', 'status': 404})
+
+    async def send(message):
+        pass
+
+    asyncio.run(MetricsMiddleware(app, metrics)({'type': 'http', 'method': 'GET'}, None, send))
+    lines = metrics.render().splitlines()
+    assert 'http_request_duration_seconds_count{method="GET",route="/run-sequence/{workflow_id}",status="404"} 1' in lines
+    assert 'http_request_sql_queries_bucket{method="GET",route="/run-sequence/{workflow_id}",le="1"} 0' in lines
+    assert 'http_request_sql_queries_bucket{method="GET",route="/run-sequence/{workflow_id}",le="2"} 1' in lines
+
+    WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+    db.commit()
+
+
+def test_health(db):
+    assert asyncio.run(HealthRoutes.liveness())['status'] == 'alive'
+    ready, draining = server_state.ready, server_state.draining
+    try:
+        server_state.ready = False
+        with pytest.raises(HTTPException) as e:
+            HealthRoutes.readiness(db=db)
+        assert e.value.status_code == 503 and e.value.detail == "Starting."
+
+        server_state.mark_ready()
+        assert HealthRoutes.readiness(db=db)['status'] == 'ready'
+
+        server_state.mark_draining()
+        assert asyncio.run(HealthRoutes.liveness())['status'] == 'draining'
+        with pytest.raises(HTTPException) as e:
+            HealthRoutes.readiness(db=db)
+        assert e.value.detail == "Shutting down."
+    finally:
+        server_state.ready, server_state.draining = ready, draining
+    db.commit()
+
+
+def test_read_cache(db, monkeypatch):
+    workflow = create_chain_workflow(db, messages_count=2)
+    message_id = next(node.id for node in workflow.nodes if node.node_type == 'message')
+    monkeypatch.setattr(read_cache, 'sync_interval', 0)
+    read_cache.clear()
+
+    assert WorkflowRoutes.get_workflow(id=workflow.id, db=db).name == workflow.name
+    _, queries = count_queries(lambda: WorkflowRoutes.get_workflow(id=workflow.id, db=db))
+    assert queries == 1  # the sync of the cache versions only
+    assert NodeRoutes.read_node(node_id=message_id, db=db).status == 'sent'
+    assert read_cache.get(node_key(message_id)) is not None
+
+    # writes drop the entries they change
+    NodeService.update_statuses(db, MessageStatusesUpdateSchema(statuses=[{'node_id': message_id, 'status': 'opened'}]).statuses)
+    assert NodeRoutes.read_node(node_id=message_id, db=db).status == 'opened'
+    WorkflowServices.update_workflow(workflow_id=workflow.id, data=WorkflowCreateSchema(name='renamed'), db=db)
+    assert WorkflowRoutes.get_workflow(id=workflow.id, db=db).name == 'renamed'
+
+    # another worker sees the change on its next sync
+    other = ReadCache(sync_interval=0)
+    other.sync(db)
+    other.load(db, workflow_key(workflow.id), lambda: 'cached')
+    assert other.load(db, workflow_key(workflow.id), lambda: 'loaded') == 'cached'
+    NodeService.update_node(node_id=message_id, data=MessageNodeSchema(workflow_id=workflow.id, message_text='edited', status='opened', next_node_id=read_cache.get(node_key(message_id))[0].next_node_id), db=db)
+    assert other.load(db, node_key(message_id), lambda: 'loaded') == 'loaded'
+    assert other.load(db, workflow_key(workflow.id), lambda: 'loaded') == 'cached'
+    WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+    assert other.load(db, workflow_key(workflow.id), lambda: None) is None
+    assert other.stats()['hits'] == 2 and other.stats()['invalidations'] == 2
+    with pytest.raises(HTTPException):
+        WorkflowRoutes.get_workflow(id=workflow.id, db=db)
+    assert NodeService.get_node(node_id=message_id, db=db) is None
+
+    # a value loaded while an invalidation happened is not cached
+    epoch = other.epoch
+    other.drop([node_key(message_id)])
+    other.put(node_key(message_id), 'stale', epoch)
+    assert other.get(node_key(message_id)) is None
+
+    # a value cached before the commit of the change, from the old row, is dropped by the commit
+    db.commit()
+    read_cache.invalidate(db, 'test:changed')
+    read_cache.put('test:changed', 'stale', read_cache.epoch)
+    db.commit()
+    assert read_cache.get('test:changed') is None
+    savepoint = db.begin_nested()
+    read_cache.invalidate(db, 'test:changed')
+    savepoint.commit()
+    read_cache.put('test:changed', 'stale', read_cache.epoch)
+    db.commit()
+    assert read_cache.get('test:changed') is None
+
+    # old versions are pruned, the newest one is kept
+    monkeypatch.setattr(read_cache, 'ttl', 0)
+    read_cache.invalidate(db, 'test:newest')
+    db.commit()
+    assert [version.key for version in db.query(CacheVersion)] == ['test:newest']
+
+    small = ReadCache(maxsize=2, ttl=0)
+    small.put('a', 1, 0)
+    assert small.get('a') is None and small.stats()['expirations'] == 1
+    small = ReadCache(maxsize=2)
+    for key in 'abc':
+        small.put(key, key, 0)
+    assert small.get('a') is None and small.get('c') == 'c' and small.stats()['evictions'] == 1
+    db.commit()
+
+
+def test_etags(db):
+    workflow = create_chain_workflow(db, messages_count=1)
+    message_id = next(node.id for node in workflow.nodes if node.node_type == 'message')
+    response = Response()
+    WorkflowRoutes.get_workflow(id=workflow.id, response=response, db=db)
+    etag = response.headers['ETag']
+    assert etag == workflow_etag(workflow.id, db.get(Workflow, workflow.id).version)
+    assert etag_matches(f'"x", W/{etag}', etag) and not etag_matches(f'W/{etag}', etag, weak=False)
+
+    # an unchanged workflow is answered with 304, found with a single query
+    not_modified, queries = count_queries(lambda: WorkflowRoutes.get_workflow(id=workflow.id, if_none_match=etag, db=db))
+    assert not_modified.status_code == 304 and not_modified.headers['ETag'] == etag and queries == 1
+
+    # a rename changes the ETag, a write with the previous one is refused
+    response = Response()
+    WorkflowRoutes.update_workflow(workflow_id=workflow.id, data=WorkflowCreateSchema(name='renamed'), response=response, if_match=etag, db=db)
+    assert response.headers['ETag'] != etag
+    assert WorkflowRoutes.get_workflow(id=workflow.id, if_none_match=etag, db=db).name == 'renamed'
+    with pytest.raises(HTTPException) as error:
+        WorkflowRoutes.update_workflow(workflow_id=workflow.id, data=WorkflowCreateSchema(name='lost'), if_match=etag, db=db)
+    assert error.value.status_code == 412 and error.value.headers['ETag'] == response.headers['ETag']
+    renamed_tag = response.headers['ETag']
+    with pytest.raises(HTTPException):
+        WorkflowRoutes.delete_workflow(workflow_id=workflow.id, if_match=etag, db=db)
+
+    # a status change is a new version of the node
+    response = Response()
+    NodeRoutes.read_node(node_id=message_id, response=response, db=db)
+    node_tag = response.headers['ETag']
+    assert node_tag == node_etag(message_id, 1)
+    assert NodeRoutes.read_node(node_id=message_id, if_none_match=node_tag, db=db).status_code == 304
+    NodeService.update_statuses(db, MessageStatusesUpdateSchema(statuses=[{'node_id': message_id, 'status': 'opened'}]).statuses)
+    assert NodeRoutes.read_node(node_id=message_id, if_none_match=node_tag, db=db).status == 'opened'
+    with pytest.raises(HTTPException) as error:
+        NodeRoutes.delete_node(node_id=message_id, if_match=node_tag, db=db)
+    assert error.value.status_code == 412
+    with pytest.raises(HTTPException) as error:
+        NodeRoutes.update_end_node(node_data=EndNodeSchema(workflow_id=workflow.id), node_id=-1, if_match=node_tag, db=db)
+    assert error.value.status_code == 404
+    assert WorkflowRoutes.delete_workflow(workflow_id=workflow.id, if_match='*', db=db)
+
+    # ids aren`t reused, the tag of a deleted workflow never matches a new one
+    other = WorkflowServices.create_workflow(data=WorkflowCreateSchema(name='other'), db=db)
+    response = Response()
+    assert other.id != workflow.id
+    assert WorkflowRoutes.get_workflow(id=other.id, response=response, if_none_match=renamed_tag, db=db).name == 'other'
+    assert response.headers['ETag'] != renamed_tag
+    with pytest.raises(HTTPException) as error:
+        WorkflowRoutes.delete_workflow(workflow_id=other.id, if_match=renamed_tag, db=db)
+    assert error.value.status_code == 412
+    WorkflowServices.delete_workflow(workflow_id=other.id, db=db)
+    db.commit()
+
+
+def test_clone_workflow(db):
+    template = create_chain_workflow(db, messages_count=3)
+    path = WorkflowRoutes.run_sequence(workflow_id=template.id, db=db)['success_path']
+
+    result, queries = count_queries(lambda: WorkflowRoutes.clone_workflow(workflow_id=template.id, data=WorkflowCloneSchema(name='campaign', copies=3), db=db))
+    assert [copy['name'] for copy in result['workflows']] == ['campaign 1', 'campaign 2', 'campaign 3']
+    assert result['nodes'] == len(template.nodes) and queries <= 12
+    for copy in result['workflows']:
+        offset = copy['node_id_offset']
+        assert WorkflowRoutes.run_sequence(workflow_id=copy['id'], db=db)['success_path'] == [node_id + offset for node_id in path]
+        condition = next(node for node in template.nodes if node.node_type == 'condition')
+        assert db.get(ConditionNode, condition.id + offset).message_node_id == condition.message_node_id + offset
+
+    # the copies are independent of the template and of each other
+    first = result['workflows'][0]
+    message_id = path[-4] + first['node_id_offset']
+    NodeService.update_statuses(db, MessageStatusesUpdateSchema(statuses=[{'node_id': message_id, 'status': 'opened'}]).statuses)
+    assert NodeService.get_node(node_id=path[-4], db=db).status == 'sent'
+    WorkflowServices.delete_workflow(workflow_id=first['id'], db=db)
+    assert WorkflowRoutes.run_sequence(workflow_id=result['workflows'][1]['id'], db=db)['success_path'][0] == path[0] + result['workflows'][1]['node_id_offset']
+
+    single = WorkflowRoutes.clone_workflow(workflow_id=template.id, db=db)['workflows']
+    assert len(single) == 1 and single[0]['name'] == 'chain'
+    with pytest.raises(HTTPException) as error:
+        WorkflowRoutes.clone_workflow(workflow_id=-1, db=db)
+    assert error.value.status_code == 404
+    db.commit()
+
+
+def test_snapshot(db):
+    workflow = create_chain_workflow(db, messages_count=3)
+    path = WorkflowRoutes.run_sequence(workflow_id=workflow.id, db=db)['success_path']
+    snapshot = b''.join(SnapshotService.export_snapshot(db, workflow.id))
+    assert snapshot[:4] == b'WFSN'
+
+    # fed byte by byte, blocks come out as soon as they are complete
+    reader = SnapshotReader()
+    blocks = [block for i in range(len(snapshot)) for block in reader.feed(snapshot[i:i + 1])]
+    reader.close()
+    assert reader.header[2] == 'chain' and sum(len(block['ids']) for block in blocks) == len(workflow.nodes)
+    assert len(reader.strings) == len({'yes', 'no', "status == 'sent'", *(f'message {i}' for i in range(3))})
+
+    # what-if runs don`t touch the database
+    condition_id, message_id = path[-3], path[-4]
+    assert SnapshotService.run_snapshot(snapshot)['success_path'] == path
+    what_if, queries = count_queries(lambda: SnapshotService.run_snapshot(snapshot, {message_id: 'opened'}))
+    assert what_if['success_path'][:-2] == path[:-2] and what_if['success_path'][-2] != path[-2] and queries == 0
+    assert NodeService.get_node(node_id=message_id, db=db).status == 'sent'
+
+    lines = SnapshotService.read_import_lines(SnapshotReader(), io.BytesIO(snapshot), chunk_size=7)
+    imported = import_graph(db, {'name': 'restored'}, lines)
+    ids = {int(ref): node_id for ref, node_id in imported['nodes'].items()}
+    assert WorkflowRoutes.run_sequence(workflow_id=imported['id'], db=db)['success_path'] == [ids[node_id] for node_id in path]
+    assert db.get(ConditionNode, ids[condition_id]).message_node_id == ids[message_id]
+
+    for corrupted in (snapshot[:-1], snapshot[:20] + b'x' + snapshot[21:], b'JSON' + snapshot[4:]):
+        with pytest.raises(HTTPException) as error:
+            SnapshotService.run_snapshot(corrupted)
+        assert error.value.status_code == 400
+
+    # contents with a valid checksum are checked too: node type, status, string index
+    count = len(workflow.nodes)
+    kinds = HEADER.size + len('chain') + BLOCK.size + sum(LENGTH_SIZE + len(string.encode()) for string in reader.strings) + 8 * count
+    for position, value in ((kinds, b'\x09'), (kinds + count, b'\x7f'), (kinds + 2 * count, b'\x7f')):
+        body = snapshot[:position] + value + snapshot[position + 1:-TRAILER.size]
+        with pytest.raises(HTTPException) as error:
+            SnapshotService.run_snapshot(body + TRAILER.pack(count, zlib.crc32(body)))
+        assert error.value.status_code == 400
+
+    empty = WorkflowServices.create_workflow(data=WorkflowCreateSchema(name='empty'), db=db)
+    with pytest.raises(HTTPException) as error:
+        SnapshotService.export_snapshot(db, empty.id)
+    assert error.value.status_code == 400
+    WorkflowServices.delete_workflow(workflow_id=empty.id, db=db)
+    WorkflowServices.delete_workflow(workflow_id=imported['id'], db=db)
+    WorkflowServices.delete_workflow(workflow_id=workflow.id, db=db)
+    db.commit()